@@ -0,0 +1,155 @@
+"""
+Admission control for the expensive endpoints and a rate limit for Google calls.
+
+AdmissionController bounds how many Gmail/Maps requests a worker works on at
+once. A request beyond a user's limit is refused right away with 429; beyond
+the global limit it waits in a bounded queue, and is refused with 503 when the
+queue is full or its wait times out. Anonymous requests (user None) are only
+held to the global limit: behind a proxy they all share one client address. Refusals carry a Retry-After estimated
+from recent request durations.
+
+google_bucket is a token bucket shared by all requests in a worker; every
+Google Maps call takes a token, waiting for one at most GOOGLE_CALL_MAX_WAIT
+seconds before failing the call.
+
+Limits are per worker process: with gunicorn the service-wide limits are the
+worker count times these.
+"""
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Hashable, Iterator, Optional
+
+# Weight of the latest request in the running average of request durations
+DURATION_SMOOTHING = 0.2
+
+class AdmissionRejected(Exception):
+    """A request refused by admission control, with its HTTP status and Retry-After seconds"""
+
+    def __init__(self, status: int, retry_after: int, reason: str):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """Global and per-user concurrency limits with a bounded wait queue"""
+
+    def __init__(self, max_concurrent: int, max_per_user: int, queue_size: int, queue_timeout: float):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._per_user: Dict[Hashable, int] = {}
+        self._average_duration = 1.0
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely to free up"""
+        backlog = self._waiting + 1
+        return max(1, math.ceil(self._average_duration * backlog / self.max_concurrent))
+
+    def _over_user_limit(self, user: Optional[Hashable]) -> bool:
+        return user is not None and bool(self.max_per_user) and self._per_user.get(user, 0) >= self.max_per_user
+
+    def _acquire(self, user: Optional[Hashable]):
+        with self._condition:
+            if self._over_user_limit(user):
+                raise AdmissionRejected(429, self.retry_after(), "Too many concurrent requests for this user")
+
+            if self._active >= self.max_concurrent:
+                if self._waiting >= self.queue_size:
+                    raise AdmissionRejected(503, self.retry_after(), "Server is busy, try again later")
+                self._waiting += 1
+                try:
+                    admitted = self._condition.wait_for(lambda: self._active < self.max_concurrent,
+                                                        timeout=self.queue_timeout)
+                finally:
+                    self._waiting -= 1
+                if not admitted:
+                    raise AdmissionRejected(503, self.retry_after(), "Server is busy, try again later")
+                # The user may have started another request while this one waited
+                if self._over_user_limit(user):
+                    self._condition.notify()
+                    raise AdmissionRejected(429, self.retry_after(), "Too many concurrent requests for this user")
+
+            self._active += 1
+            if user is not None:
+                self._per_user[user] = self._per_user.get(user, 0) + 1
+
+    def _release(self, user: Optional[Hashable], duration: float):
+        with self._condition:
+            self._active -= 1
+            if user is not None:
+                remaining = self._per_user[user] - 1
+                if remaining:
+                    self._per_user[user] = remaining
+                else:
+                    del self._per_user[user]
+            self._average_duration += DURATION_SMOOTHING * (duration - self._average_duration)
+            self._condition.notify()
+
+    @contextmanager
+    def admit(self, user: Optional[Hashable]) -> Iterator[None]:
+        """Hold a slot for the block (user None: global limit only); raises AdmissionRejected if none is available"""
+        if self.max_concurrent <= 0:
+            yield
+            return
+        self._acquire(user)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(user, time.monotonic() - start)
+
+class RateLimited(Exception):
+    """A call refused because no token became available in time"""
+    status = 'RATE_LIMITED'
+
+class TokenBucket:
+    """Allow rate calls per second on average, with bursts of up to burst calls"""
+
+    def __init__(self, rate: float, burst: float, max_wait: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def acquire(self, max_wait: Optional[float] = None) -> float:
+        """Take a token, sleeping until one is due; returns the seconds waited
+
+        The token is reserved before sleeping, so concurrent callers queue up
+        in order. Raises RateLimited if the wait would exceed max_wait.
+        """
+        if self.rate <= 0:
+            return 0.0
+        max_wait = self.max_wait if max_wait is None else max_wait
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = (1 - self._tokens) / self.rate if self._tokens < 1 else 0.0
+            if wait > max_wait:
+                raise RateLimited(f"Google API rate limit: no call slot within {max_wait:g}s")
+            self._tokens -= 1
+        if wait:
+            time.sleep(wait)
+        return wait
+
+admission = AdmissionController(
+    max_concurrent=int(os.getenv('ADMISSION_MAX_CONCURRENT', 4)),
+    max_per_user=int(os.getenv('ADMISSION_MAX_PER_USER', 2)),
+    queue_size=int(os.getenv('ADMISSION_QUEUE_SIZE', 2)),
+    queue_timeout=float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 5))
+)
+
+google_bucket = TokenBucket(
+    rate=float(os.getenv('GOOGLE_CALLS_PER_SECOND', 10)),
+    burst=float(os.getenv('GOOGLE_CALL_BURST', 20)),
+    max_wait=float(os.getenv('GOOGLE_CALL_MAX_WAIT', 10))
+)
@@ -0,0 +1,119 @@
+"""
+Precomputed great-circle distances between the airports extract_flight_info recognises.
+
+The table is a compact binary file built by build_airport_table.py and memory-mapped
+at first use, so calculate_flight_distance can answer known routes with an index
+lookup instead of two geocoding calls. Layout (little-endian, 8-byte aligned):
+
+    header     8s magic, uint32 airport count n, uint32 address blob length
+    codes      n * 3 ASCII bytes, zero-padded to a multiple of 8
+    coords     n * 2 float64 (lat, lng)
+    distances  n * n float64 miles, row-major by code index
+    addresses  UTF-8 JSON list of formatted addresses
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+TABLE_MAGIC = b'GRNYAPT1'
+HEADER = struct.Struct('<8sII')
+DEFAULT_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'airport_distances.bin')
+
+def _codes_size(n: int) -> int:
+    """Size of the codes section padded to keep the float sections aligned"""
+    return (n * 3 + 7) // 8 * 8
+
+class AirportTable:
+    """Read-only view over a memory-mapped airport distance table"""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, n, address_size = HEADER.unpack_from(self._mm, 0)
+        if magic != TABLE_MAGIC:
+            raise ValueError(f"{path} is not an airport distance table")
+
+        codes_start = HEADER.size
+        coords_start = codes_start + _codes_size(n)
+        distances_start = coords_start + n * 2 * 8
+        addresses_start = distances_start + n * n * 8
+
+        codes = bytes(self._mm[codes_start:codes_start + n * 3]).decode('ascii')
+        self.codes: List[str] = [codes[i:i + 3] for i in range(0, n * 3, 3)]
+        self.index: Dict[str, int] = {code: i for i, code in enumerate(self.codes)}
+        self._coords = memoryview(self._mm)[coords_start:distances_start].cast('d')
+        self._distances = memoryview(self._mm)[distances_start:addresses_start].cast('d')
+        self.addresses: List[str] = json.loads(bytes(self._mm[addresses_start:addresses_start + address_size]) or b'[]')
+        self.size = n
+
+    def __contains__(self, code: str) -> bool:
+        return code in self.index
+
+    def distance(self, origin: str, destination: str) -> Optional[float]:
+        """Great-circle distance in miles between two airports, or None if either is unknown"""
+        i = self.index.get(origin)
+        j = self.index.get(destination)
+        if i is None or j is None:
+            return None
+        return self._distances[i * self.size + j]
+
+    def airport_info(self, code: str) -> Optional[Dict[str, object]]:
+        """Geocoding-style info (as returned by geocode_airport) for a known airport"""
+        i = self.index.get(code)
+        if i is None:
+            return None
+        return {
+            'lat': self._coords[i * 2],
+            'lng': self._coords[i * 2 + 1],
+            'formatted_address': self.addresses[i] if i < len(self.addresses) else code,
+            'code': code,
+            'status': 'OK'
+        }
+
+def write_table(path: str, airports: Iterable[Tuple[str, float, float, str]], distance_fn) -> int:
+    """Write a table for (code, lat, lng, formatted_address) airports using distance_fn(lat1, lng1, lat2, lng2)"""
+    airports = sorted(airports)
+    n = len(airports)
+    codes = ''.join(code for code, _, _, _ in airports).encode('ascii')
+    addresses = json.dumps([address for _, _, _, address in airports]).encode('utf-8')
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(TABLE_MAGIC, n, len(addresses)))
+        f.write(codes.ljust(_codes_size(n), b'\0'))
+        for _, lat, lng, _ in airports:
+            f.write(struct.pack('<2d', lat, lng))
+        for _, lat1, lng1, _ in airports:
+            row = [distance_fn(lat1, lng1, lat2, lng2) for _, lat2, lng2, _ in airports]
+            f.write(struct.pack(f'<{n}d', *row))
+        f.write(addresses)
+    os.replace(tmp_path, path)
+    return n
+
+_table: Optional[AirportTable] = None
+_table_loaded = False
+_table_lock = threading.Lock()
+
+def get_airport_table() -> Optional[AirportTable]:
+    """Load the shipped airport table once per process (None if it is missing or invalid)"""
+    global _table, _table_loaded
+    if _table_loaded:
+        return _table
+
+    with _table_lock:
+        if not _table_loaded:
+            path = os.getenv('AIRPORT_TABLE_PATH', DEFAULT_TABLE_PATH)
+            try:
+                _table = AirportTable(path)
+                logging.info(f"Loaded airport distance table with {_table.size} airports from {path}")
+            except FileNotFoundError:
+                logging.info(f"No airport distance table at {path}, flights will be geocoded")
+            except (OSError, ValueError, struct.error) as e:
+                logging.warning(f"Could not load airport distance table {path}: {str(e)}")
+            _table_loaded = True
+    return _table
@@ -1,16 +1,38 @@
+import atexit
+import hashlib
+import hmac
 import os
 import logging
-import json
 import sys
-from flask import Flask, render_template, request, jsonify
+import time
+from contextlib import ExitStack
+from functools import wraps
+from flask import Flask, Response, render_template, request, jsonify, g, stream_with_context
 from flask_cors import CORS
 from datetime import datetime
-from quickstart import process_email_info
-from calculator import calculate_emissions, process_quickstart_data, process_flight_segments
 from dotenv import load_dotenv
 
+# Load .env before the modules below read their settings from the environment
 load_dotenv()
 
+from quickstart import process_email_info, deduplicate_receipts
+from calculator import (
+    calculate_emissions, calculation_cache_key, process_quickstart_data, process_flight_segments, trim_results,
+    DETAIL_FULL, DETAIL_LEVELS, DETAIL_SUMMARY
+)
+from history import open_history_store, start_compaction_thread, timestamp_seconds, DEFAULT_PERCENTILES
+from history_writer import HistoryWriter
+import json_codec
+from json_codec import dumps_line, loads as json_loads
+from admission import admission, AdmissionRejected
+from compression import compress_response
+from lookup_cache import LookupCache, lookup_scope, OUTCOME_OK, OUTCOME_TRANSIENT
+from metrics import (
+    begin_timings, count_cache, end_timings, metrics_enabled, observe_request, observe_stage, render_metrics
+)
+from profiling import RequestProfiler, server_timing_header
+from request_log import log_scope
+
 # Set up logging to console
 logging.basicConfig(
     level=logging.INFO,
@@ -30,45 +52,233 @@ if not os.getenv('GOOGLE_MAPS'):
 # Create app with explicit template folder path
 template_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'templates'))
 app = Flask(__name__, template_folder=template_dir)
+# jsonify encodes with orjson when it is installed
+json_codec.init_app(app)
 
 # Create data directory for storing calculations
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 os.makedirs(DATA_DIR, exist_ok=True)
-HISTORY_FILE = os.path.join(DATA_DIR, 'calculations_history.json')
+history_store = open_history_store(os.getenv('HISTORY_BACKEND'), DATA_DIR)
 
-def save_calculation(input_data, results):
-    """Save calculation to history file"""
-    logger.info("Saving calculation to history")
-    
-    # Create entry with timestamp
+# Roll finished periods of the JSONL history into compressed segments (0 disables)
+start_compaction_thread(history_store, float(os.getenv('HISTORY_COMPACT_INTERVAL', 3600)))
+
+# Write history in the background so requests don't wait on disk I/O
+HISTORY_WRITE_BEHIND = os.getenv('HISTORY_WRITE_BEHIND', 'true').lower() in ('1', 'true', 'yes')
+history_writer = HistoryWriter(history_store, os.getenv('HISTORY_FSYNC_EVERY', '1')) if HISTORY_WRITE_BEHIND else None
+if history_writer is not None:
+    atexit.register(history_writer.close)
+
+# /api/calculate responses, keyed by a hash of the canonicalized payload, its
+# detail level and the emission factors. Results with unresolved entries are
+# kept only for RESPONSE_CACHE_PARTIAL_TTL so lookups are retried soon.
+response_cache = LookupCache(
+    maxsize=int(os.getenv('RESPONSE_CACHE_SIZE', 1024)),
+    ttl=float(os.getenv('RESPONSE_CACHE_TTL', 300)),
+    transient_ttl=float(os.getenv('RESPONSE_CACHE_PARTIAL_TTL', 30))
+)
+
+# Don't record a repeated calculation again while its response is cached
+HISTORY_SKIP_DUPLICATES = os.getenv('HISTORY_SKIP_DUPLICATES', 'false').lower() in ('1', 'true', 'yes')
+
+# ?profile=1 runs a request under cProfile for callers presenting PROFILE_TOKEN
+request_profiler = RequestProfiler(
+    os.getenv('PROFILE_TOKEN'),
+    os.path.join(DATA_DIR, 'profiles'),
+    int(os.getenv('PROFILE_TOP_N', 30))
+)
+
+# Most payloads accepted by one POST /api/calculate/batch
+BATCH_MAX_PAYLOADS = int(os.getenv('BATCH_MAX_PAYLOADS', 10000))
+
+# Page size limits for GET /api/history
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 500
+
+# Lets a client read other users' history (?user=, or all users without it) with X-Admin-Token
+HISTORY_ADMIN_TOKEN = os.getenv('HISTORY_ADMIN_TOKEN')
+
+# Shared with the web client, which signs the X-User-Id it forwards with it
+USER_ID_SECRET = os.getenv('USER_ID_SECRET')
+
+# Also collapse receipts of the same type within one Gmail thread
+DEDUP_BY_THREAD = os.getenv('DEDUP_BY_THREAD', 'false').lower() in ('1', 'true', 'yes')
+
+def request_user():
+    """Identify the user a request is made for, if the web client vouched for it
+
+    The web client's server-side proxy sends the signed-in user's id as X-User-Id
+    with X-User-Signature, the hex HMAC-SHA256 of the id under USER_ID_SECRET.
+    An id without a valid signature is ignored, so clients cannot claim to be
+    another user (and no user is trusted while USER_ID_SECRET is unset).
+    """
+    user = request.headers.get('X-User-Id')
+    signature = request.headers.get('X-User-Signature')
+    if not (user and signature and USER_ID_SECRET):
+        return None
+    expected = hmac.new(USER_ID_SECRET.encode('utf-8'), user.encode('utf-8'), hashlib.sha256).hexdigest()
+    return user if hmac.compare_digest(signature.encode('utf-8'), expected.encode('utf-8')) else None
+
+def admission_rejected_response(error):
+    logger.warning(f"Refused {request.path} with {error.status}: {str(error)}")
+    response = jsonify({'error': str(error)})
+    response.status_code = error.status
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def admission_controlled(view):
+    """Run the view within the worker's admission limits, refusing with 429/503 and Retry-After"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method == 'GET':
+            return view(*args, **kwargs)
+        try:
+            with admission.admit(request_user()):
+                return view(*args, **kwargs)
+        except AdmissionRejected as e:
+            return admission_rejected_response(e)
+    return wrapper
+
+def history_entry(input_data, results, user=None):
+    """Build a history entry for a calculation"""
     entry = {
         'timestamp': datetime.now().isoformat(),
         'inputs': input_data,
         'results': results
     }
+    if user:
+        entry['user'] = user
+    return entry
+
+def save_calculation(input_data, results, user=None):
+    """Append calculation to the history store"""
+    logger.info("Saving calculation to history")
+    entry = history_entry(input_data, results, user)
     
-    # Load existing data or create new list
-    if os.path.exists(HISTORY_FILE):
-        try:
-            with open(HISTORY_FILE, 'r') as f:
-                history = json.load(f)
-        except json.JSONDecodeError:
-            logger.warning(f"Could not parse {HISTORY_FILE}, creating new history")
-            history = []
+    # The calculation number is reserved up front, so it is final even when
+    # the entry is still queued for the background writer
+    with observe_stage('history_save'):
+        if history_writer is not None:
+            calculation_number = history_writer.submit(entry)
+        else:
+            calculation_number = history_store.append(entry)
+    
+    logger.info(f"Calculation #{calculation_number} saved to history")
+    return calculation_number
+
+def save_calculations(entries):
+    """Append many history entries in one batched write; returns their calculation numbers"""
+    if not entries:
+        return []
+    with observe_stage('history_save'):
+        if history_writer is not None:
+            numbers = history_writer.submit_many(entries)
+        else:
+            numbers = history_store.append_many(entries)
+    logger.info(f"Calculations #{numbers[0]}-#{numbers[-1]} saved to history")
+    return numbers
+
+def response_etag(key, detail_level):
+    """ETag of a calculation, from its response_cache key, as served at a detail level"""
+    if detail_level == DETAIL_FULL:
+        return key
+    return hashlib.sha256(f"{key}:{detail_level}".encode('utf-8')).hexdigest()
+
+def payload_keys(data, detail_level):
+    """Return (response_cache key, ETag) of a payload served at a detail level"""
+    if detail_level not in DETAIL_LEVELS:
+        raise ValueError(f"Unknown detail_level '{detail_level}', expected one of {', '.join(DETAIL_LEVELS)}")
+    key = calculation_cache_key(data, DETAIL_FULL)
+    return key, response_etag(key, detail_level)
+
+def calculate_payload(data, detail_level, user=None, keys=None):
+    """Calculate one /api/calculate payload, serving repeats from response_cache
+    
+    Returns (ETag, results at detail_level, history entry). Results are
+    calculated, cached and recorded in full detail; only the returned results
+    are trimmed. The entry is None when HISTORY_SKIP_DUPLICATES skips
+    recording a repeat. keys are the payload_keys() if the caller has them.
+    """
+    key, etag = keys or payload_keys(data, detail_level)
+    hit, cached = response_cache.get(key)
+    count_cache('response', hit)
+    
+    if hit:
+        logger.debug("Serving calculation from the response cache")
+        results = trim_results(cached['results'], detail_level)
+        if HISTORY_SKIP_DUPLICATES and user in cached['users']:
+            logger.debug("Skipping history for repeated calculation")
+            return etag, results, None
+        cached['users'].add(user)
+        return etag, results, history_entry(cached['inputs'], cached['results'], user)
+    
+    # Check if data is a list (quickstart.py format) or dictionary (standard format)
+    if isinstance(data, list):
+        # Convert list to dictionary using process_quickstart_data
+        with observe_stage('receipt_parse'):
+            inputs = process_quickstart_data(data)
+    elif isinstance(data, dict):
+        inputs = data
     else:
-        history = []
+        raise ValueError("Payload must be a JSON object or a list of entries")
     
-    # Add new entry and save
-    history.append(entry)
-    with open(HISTORY_FILE, 'w') as f:
-        json.dump(history, f, indent=2)
+    stats = {}
+    with observe_stage('calculation'):
+        results = calculate_emissions(inputs, DETAIL_FULL, stats)
     
-    logger.info(f"Calculation saved. History now contains {len(history)} entries")
-    return len(history)
+    outcome = OUTCOME_TRANSIENT if stats.get('unresolved') else OUTCOME_OK
+    response_cache.set(key, {'inputs': inputs, 'results': results, 'users': {user}}, outcome)
+    return etag, trim_results(results, detail_level), history_entry(inputs, results, user)
 
 CORS(app)  # Enable CORS for all routes
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    begin_timings()
+    
+    if request.args.get('profile') == '1':
+        if not request_profiler.authorized(request.headers.get('X-Profile-Token')):
+            return jsonify({'error': 'Profiling requires a valid X-Profile-Token'}), 403
+        g.profile = request_profiler.start()
+        if g.profile is None:
+            logger.warning("Another request is being profiled; running this one unprofiled")
+
+@app.after_request
+def record_request_latency(response):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        response.headers['X-Profile'] = request_profiler.finish(profile, request.endpoint or 'unmatched')
+    
+    start = g.pop('request_start', None)
+    if start is not None:
+        elapsed = time.perf_counter() - start
+        observe_request(request.endpoint or 'unmatched', request.method, response.status_code, elapsed)
+        response.headers['Server-Timing'] = server_timing_header(end_timings(), elapsed)
+    return response
+
+@app.after_request
+def compress(response):
+    # Registered after record_request_latency so it runs first: total includes compression
+    return compress_response(response, request.accept_encodings)
+
+@app.teardown_request
+def stop_request_profile(error=None):
+    # after_request is skipped when a request fails, don't leave the profiler running
+    profile = g.pop('profile', None)
+    if profile is not None:
+        request_profiler.finish(profile, request.endpoint or 'unmatched')
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics (merged across gunicorn workers in multiprocess mode)"""
+    if not metrics_enabled():
+        return jsonify({'error': 'prometheus_client is not installed'}), 503
+    body, content_type = render_metrics()
+    return body, 200, {'Content-Type': content_type}
+
 @app.route('/', methods=['GET', 'POST'])
+@admission_controlled
 def index():
     """Main route for web interface with unified form for all transportation types"""
     result = None
@@ -128,10 +338,11 @@ def index():
             logger.info(f"Processing form data with {sum(len(v) for v in input_data.values())} total entries")
             
             # Calculate emissions
-            results = calculate_emissions(input_data)
+            with observe_stage('calculation'):
+                results = calculate_emissions(input_data)
             
             # Save calculation
-            history_count = save_calculation(input_data, results)
+            history_count = save_calculation(input_data, results, request_user())
             logger.info(f"Calculation #{history_count} completed")
             
             result = results
@@ -143,8 +354,15 @@ def index():
     return render_template('index.html', result=result)
 
 @app.route('/api/calculate', methods=['POST'])
+@admission_controlled
 def api_calculate():
-    """API endpoint for calculations with multiple entries"""
+    """API endpoint for calculations with multiple entries
+    
+    Responses carry a weak ETag derived from the payload; a request whose
+    If-None-Match matches gets 304 Not Modified without being calculated or
+    recorded in history. Repeated payloads are served from response_cache
+    without recalculating.
+    """
     logger.info("Received API calculation request")
     try:
         # Get JSON data
@@ -153,30 +371,100 @@ def api_calculate():
             logger.warning("No JSON data received")
             return jsonify({'error': 'No data provided'}), 400
         
-        # Check if data is a list (quickstart.py format) or dictionary (standard format)
+        # Calculate emissions (totals only unless the caller asks for entry details
+        # with ?detail_level=per-entry or ?detail_level=full)
         if isinstance(data, list):
             logger.info(f"Processing API request with {len(data)} entries (quickstart.py format)")
-            # Convert list to dictionary using process_quickstart_data
-            data = process_quickstart_data(data)
-        else:
+        elif isinstance(data, dict):
             logger.info(f"Processing API request with {len(data.keys())} categories (standard format)")
+        detail_level = request.args.get('detail_level', DETAIL_SUMMARY)
+        keys = payload_keys(data, detail_level)
+        etag = keys[1]
+        if request.if_none_match.contains_weak(etag):
+            # The client already has these results: neither recalculate nor record them again
+            logger.info("Calculation not modified")
+            response = app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            return response
         
-        # Calculate emissions
-        results = calculate_emissions(data)
+        etag, results, entry = calculate_payload(data, detail_level, request_user(), keys)
         
         # Save calculation
-        history_count = save_calculation(data, results)
-        logger.info(f"API calculation #{history_count} completed")
+        if entry is None:
+            logger.info("Skipping history for repeated calculation")
+        else:
+            history_count = save_calculation(entry['inputs'], entry['results'], entry.get('user'))
+            logger.info(f"API calculation #{history_count} completed")
         
-        # Return JSON response (without entry_details to keep response smaller)
-        response_data = {k: v for k, v in results.items() if k != 'entry_details'}
-        return jsonify(response_data)
+        response = jsonify(results)
+        response.set_etag(etag, weak=True)
+        return response
     
     except Exception as e:
         logger.error(f"API error: {str(e)}", exc_info=True)
         return jsonify({'error': str(e)}), 400
 
+@app.route('/api/calculate/batch', methods=['POST'])
+def api_calculate_batch():
+    """Calculate many independent payloads sent as NDJSON, streaming one NDJSON result per line
+    
+    Each input line is a payload in the standard or quickstart list format.
+    Result lines come back in input order as {"line", "etag", "results"} or
+    {"line", "error"}. Payloads share lookups and the response cache, and
+    their history entries are written in one batch once the stream ends.
+    """
+    detail_level = request.args.get('detail_level', DETAIL_SUMMARY)
+    if detail_level not in DETAIL_LEVELS:
+        return jsonify({'error': f"Unknown detail_level '{detail_level}', expected one of {', '.join(DETAIL_LEVELS)}"}), 400
+    user = request_user()
+    
+    # The whole stream runs in one admission slot, released when the response closes
+    slot = ExitStack()
+    try:
+        slot.enter_context(admission.admit(user))
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    
+    def results_stream():
+        entries = []
+        payloads = 0
+        try:
+            with log_scope('Batch'), lookup_scope():
+                for line_number, line in enumerate(request.stream, 1):
+                    if not line.strip():
+                        continue
+                    if payloads == BATCH_MAX_PAYLOADS:
+                        yield dumps_line({'line': line_number, 'error': f"Batch is limited to {BATCH_MAX_PAYLOADS} payloads"})
+                        break
+                    payloads += 1
+                    try:
+                        data = json_loads(line)
+                        if not data:
+                            # Rejected like an empty /api/calculate request, and not recorded
+                            yield dumps_line({'line': line_number, 'error': 'No data provided'})
+                            continue
+                        etag, results, entry = calculate_payload(data, detail_level, user)
+                    except Exception as e:
+                        yield dumps_line({'line': line_number, 'error': str(e)})
+                        continue
+                    if entry is not None:
+                        entries.append(entry)
+                    yield dumps_line({'line': line_number, 'etag': f'W/"{etag}"', 'results': results})
+        finally:
+            # Also runs when the client disconnects mid-stream
+            try:
+                save_calculations(entries)
+            except Exception as e:
+                logger.error(f"Failed to save {len(entries)} batch calculations: {str(e)}", exc_info=True)
+            logger.info(f"Batch of {payloads} payloads completed")
+    
+    logger.info("Received API batch calculation request")
+    response = Response(stream_with_context(results_stream()), mimetype='application/x-ndjson')
+    response.call_on_close(slot.close)
+    return response
+
 @app.route('/calculate-emissions', methods=['POST'])
+@admission_controlled
 def calculate_emissions_from_gmail():
     """Calculate emissions based on Gmail data using provided auth token."""
     logger.info("Received request to calculate emissions from Gmail data")
@@ -205,8 +493,13 @@ def calculate_emissions_from_gmail():
         
         logger.info(f"Extracted {len(email_data)} transportation entries from Gmail")
         
-        # Use process_quickstart_data to convert to standard format
-        categorized_data = process_quickstart_data(email_data)
+        with observe_stage('receipt_parse'):
+            # Collapse confirmation/update/receipt emails for the same trip or order
+            email_data = deduplicate_receipts(email_data, group_by_thread=DEDUP_BY_THREAD)
+            logger.info(f"{len(email_data)} entries remain after removing duplicate receipts")
+            
+            # Use process_quickstart_data to convert to standard format
+            categorized_data = process_quickstart_data(email_data)
         
         # Log summary of categorized data
         for category, entries in categorized_data.items():
@@ -215,10 +508,11 @@ def calculate_emissions_from_gmail():
         
         # Calculate emissions
         if any(len(entries) > 0 for entries in categorized_data.values()):
-            results = calculate_emissions(categorized_data)
+            with observe_stage('calculation'):
+                results = calculate_emissions(categorized_data)
             
             # Save calculation
-            save_calculation(categorized_data, results)
+            save_calculation(categorized_data, results, request_user())
             
             # Build enhanced flight data structure with coordinates using the process_flight_segments function
             flight_data = []
@@ -258,7 +552,9 @@ def calculate_emissions_from_gmail():
                 'context': {
                     'trees_needed': results.get('trees_needed', 0),
                     'london_ny_percentage': results.get('london_ny_percentage', 0)
-                }
+                },
+                # Per-day/week/month emissions per category for trend charts
+                'rollups': results.get('rollups', {})
             })
         else:
             return jsonify({"error": "No transportation data could be processed"}), 404
@@ -267,6 +563,75 @@ def calculate_emissions_from_gmail():
         logger.error(f"Error processing Gmail data: {str(e)}", exc_info=True)
         return jsonify({'error': f"Failed to process Gmail data: {str(e)}"}), 500
 
+class HistoryAccessDenied(Exception):
+    """A history query for a user the request may not read, with its HTTP status"""
+
+    def __init__(self, status: int, reason: str):
+        super().__init__(reason)
+        self.status = status
+
+def history_admin():
+    token = request.headers.get('X-Admin-Token')
+    return (bool(HISTORY_ADMIN_TOKEN) and token is not None
+            and hmac.compare_digest(token.encode('utf-8'), HISTORY_ADMIN_TOKEN.encode('utf-8')))
+
+def history_user():
+    """The user whose history a request may read (None for all users, admins only)"""
+    if history_admin():
+        return request.args.get('user') or None
+    user = request_user()
+    if user is None:
+        raise HistoryAccessDenied(401, "History requires an X-User-Id signed by the web client")
+    if request.args.get('user') not in (None, user):
+        raise HistoryAccessDenied(403, "History of other users requires a valid X-Admin-Token")
+    return user
+
+def history_window_args():
+    """Parse the start/end (ISO date or datetime, end exclusive) filters and the user to read"""
+    user = history_user()
+    start = request.args.get('start')
+    end = request.args.get('end')
+    return (
+        timestamp_seconds(start) if start else None,
+        timestamp_seconds(end) if end else None,
+        user
+    )
+
+@app.route('/api/history', methods=['GET'])
+def api_history():
+    """Newest-first page of saved calculations, continued with ?cursor=<next_cursor>"""
+    try:
+        start, end, user = history_window_args()
+        limit = min(max(int(request.args.get('limit', HISTORY_PAGE_SIZE)), 1), MAX_HISTORY_PAGE_SIZE)
+        include_results = request.args.get('include') == 'results'
+        entries, next_cursor = history_store.query(
+            start, end, user, cursor=request.args.get('cursor'), limit=limit, include_results=include_results
+        )
+    except HistoryAccessDenied as e:
+        return jsonify({'error': str(e)}), e.status
+    except ValueError as e:
+        return jsonify({'error': f"Invalid history query: {str(e)}"}), 400
+
+    return jsonify({'entries': entries, 'next_cursor': next_cursor})
+
+@app.route('/api/history/aggregate', methods=['GET'])
+def api_history_aggregate():
+    """Emission sums and percentiles per category over a time window"""
+    try:
+        start, end, user = history_window_args()
+        percentiles = request.args.get('percentiles')
+        percentiles = [float(q) for q in percentiles.split(',')] if percentiles else DEFAULT_PERCENTILES
+        if any(not 0 <= q <= 100 for q in percentiles):
+            raise ValueError("percentiles must be between 0 and 100")
+        summary = history_store.aggregate(start, end, user, percentiles)
+    except HistoryAccessDenied as e:
+        return jsonify({'error': str(e)}), e.status
+    except ValueError as e:
+        return jsonify({'error': f"Invalid history query: {str(e)}"}), 400
+
+    summary.update({'start': request.args.get('start'), 'end': request.args.get('end'), 'user': user})
+    return jsonify(summary)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 3001))
     app.run(host='0.0.0.0', port=port)
\ No newline at end of file
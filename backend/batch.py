@@ -0,0 +1,269 @@
+"""
+Columnar batch emissions engine for backfills and reports.
+
+Instead of calling calculate_emissions once per user payload, entries from many
+users are flattened into columnar arrays (user, category, distance, minutes) and
+emission factors are applied with NumPy in one pass. Entries that still need an
+external lookup (restaurant names, airport codes, pickup/dropoff addresses) are
+resolved first through calculator.process_entry, so they share its lookup and
+entry caches.
+
+Per-user totals match calculate_emissions: group sums are accumulated in entry
+order with np.bincount, which adds values in the same sequence as the per-entry loop.
+"""
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import calculator
+from calculator import (
+    calculate_distance_between_addresses, DETAIL_SUMMARY, lookup_scope, parse_time_string, process_entry,
+    process_quickstart_data
+)
+
+# Category order matches the order calculate_emissions processes (and sums) them in
+CATEGORIES = ['uber_rides', 'lyft', 'uber_eats', 'doordash', 'flights']
+CATEGORY_CODES = {category: code for code, category in enumerate(CATEGORIES)}
+LYFT_CODE = CATEGORY_CODES['lyft']
+
+# Result keys written by calculate_emissions for each category
+RESULT_KEYS = {
+    'uber_rides': ('uber_distance', 'uber_emissions'),
+    'lyft': ('lyft_distance', 'lyft_emissions'),
+    'uber_eats': ('uber_eats_distance', 'uber_eats_emissions'),
+    'doordash': ('doordash_distance', 'doordash_emissions'),
+    'flights': ('flight_distance', 'flight_emissions'),
+}
+
+# Average speed used to estimate ride distance from its duration
+ESTIMATED_RIDE_MPH = 30
+
+def emission_factors() -> np.ndarray:
+    """Return the current emission factor for each category code"""
+    return np.array([
+        calculator.UBER_EMISSION_FACTOR,
+        calculator.LYFT_EMISSION_FACTOR,
+        calculator.FOOD_DELIVERY_EMISSION_FACTOR,
+        calculator.FOOD_DELIVERY_EMISSION_FACTOR,
+        calculator.FLIGHT_EMISSION_FACTOR,
+    ], dtype=np.float64)
+
+def _parse_distance(distance: Any) -> float:
+    """Parse a directly provided distance the way calculate_emissions does"""
+    if isinstance(distance, str):
+        try:
+            return float(distance)
+        except ValueError:
+            return 0.0
+    return float(distance)
+
+def _as_list(entries: Any) -> List[Any]:
+    return entries if isinstance(entries, list) else [entries]
+
+def _lyft_distance(ride: Dict[str, Any]) -> float:
+    """Resolve a Lyft ride's distance; NaN means estimate it from the ride time"""
+    if 'distance' in ride:
+        return _parse_distance(ride.get('distance', 0))
+    if 'pickup_location' in ride and 'dropoff_location' in ride and calculator.get_gmaps():
+        try:
+            distance_result = calculate_distance_between_addresses(
+                ride['pickup_location'], ride['dropoff_location'], calculator.get_gmaps()
+            )
+            if distance_result and distance_result['status'] == 'OK':
+                return distance_result['distance_exact']
+        except Exception:
+            pass
+    return np.nan
+
+def _delivery_distance(delivery: Dict[str, Any], delivery_type: str) -> float:
+    """Resolve a food delivery's distance, looking it up only when not provided"""
+    if delivery and 'error' not in delivery and 'distance' in delivery:
+        return float(delivery.get('distance', 0))
+    distance, _ = process_entry(delivery_type, delivery, DETAIL_SUMMARY)
+    return distance
+
+def _flight_distance(flight: Dict[str, Any]) -> float:
+    """Resolve a flight's total distance across its segments"""
+    if 'distance' in flight and 'segments' not in flight and 'airport_a' not in flight:
+        return float(flight.get('distance', 0))
+    distance, _ = process_entry('flights', flight, DETAIL_SUMMARY)
+    return distance
+
+def flatten_payloads(payloads: Dict[Hashable, Any]) -> Tuple[Dict[str, np.ndarray], List[Hashable], np.ndarray]:
+    """Flatten many users' payloads into columnar arrays
+
+    Returns (columns, user_ids, present) where columns holds 'user', 'category',
+    'distance' and 'minutes' arrays, user_ids maps user codes back to ids and
+    present[user, category] marks categories each payload provided.
+    """
+    user_ids = list(payloads.keys())
+    present = np.zeros((len(user_ids), len(CATEGORIES)), dtype=bool)
+    users: List[int] = []
+    categories: List[int] = []
+    distances: List[float] = []
+    minutes: List[float] = []
+
+    def add(user_code: int, category_code: int, distance: float, time_minutes: float):
+        users.append(user_code)
+        categories.append(category_code)
+        distances.append(distance)
+        minutes.append(time_minutes)
+
+    with lookup_scope():
+        for user_code, user_id in enumerate(user_ids):
+            data = payloads[user_id]
+            if isinstance(data, list):
+                data = process_quickstart_data(data)
+            elif 'type' in data:
+                data = process_quickstart_data([data])
+
+            if data.get('uber_rides'):
+                present[user_code, 0] = True
+                for ride in _as_list(data['uber_rides']):
+                    if ride:
+                        add(user_code, 0, _parse_distance(ride.get('distance', 0)),
+                            parse_time_string(ride.get('time', '0 minutes')))
+
+            if data.get('lyft'):
+                present[user_code, 1] = True
+                for ride in _as_list(data['lyft']):
+                    if ride:
+                        add(user_code, 1, _lyft_distance(ride), parse_time_string(ride.get('time', 0)))
+
+            for category_code, category in ((2, 'uber_eats'), (3, 'doordash')):
+                if data.get(category):
+                    present[user_code, category_code] = True
+                    for delivery in _as_list(data[category]):
+                        add(user_code, category_code, _delivery_distance(delivery, category), 0)
+
+            if data.get('flights'):
+                present[user_code, 4] = True
+                for flight in _as_list(data['flights']):
+                    if flight:
+                        add(user_code, 4, _flight_distance(flight), 0)
+
+    columns = {
+        'user': np.asarray(users, dtype=np.int64),
+        'category': np.asarray(categories, dtype=np.int64),
+        'distance': np.asarray(distances, dtype=np.float64),
+        'minutes': np.asarray(minutes, dtype=np.float64),
+    }
+    return columns, user_ids, present
+
+def compute_columns(user: np.ndarray, category: np.ndarray, distance: np.ndarray,
+                    minutes: Optional[np.ndarray] = None,
+                    n_users: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Apply emission factors to pre-resolved entry columns
+
+    Returns (distance, emissions, group_totals). Lyft distances given as NaN are
+    estimated from minutes. group_totals has shape (n_users, n_categories, 2)
+    holding the distance and emissions sums per user and category.
+    """
+    distance = np.asarray(distance, dtype=np.float64)
+    if minutes is not None:
+        estimate = np.isnan(distance) & (category == LYFT_CODE)
+        if estimate.any():
+            distance = distance.copy()
+            distance[estimate] = (np.asarray(minutes, dtype=np.float64)[estimate] / 60) * ESTIMATED_RIDE_MPH
+    distance = np.nan_to_num(distance, nan=0.0)
+    emissions = distance * emission_factors()[category]
+
+    if n_users is None:
+        n_users = int(user.max()) + 1 if len(user) else 0
+    n_groups = n_users * len(CATEGORIES)
+    group = user * len(CATEGORIES) + category
+    group_totals = np.stack([
+        np.bincount(group, weights=distance, minlength=n_groups),
+        np.bincount(group, weights=emissions, minlength=n_groups),
+    ], axis=-1).reshape(n_users, len(CATEGORIES), 2)
+    return distance, emissions, group_totals
+
+def _results_by_user(user_ids: List[Hashable], group_totals: np.ndarray,
+                     present: np.ndarray) -> Dict[Hashable, Dict[str, Any]]:
+    """Build the calculate_emissions summary of every user from its group sums
+
+    Totals and the derived metrics are computed for all users at once, with the
+    same operations in the same order as calculate_emissions (so the floats are
+    equal); only building the result dicts is left to Python.
+    """
+    n_users = len(user_ids)
+    total_emissions = np.zeros(n_users)
+    for code in range(len(CATEGORIES)):
+        total_emissions = total_emissions + group_totals[:, code, 1]
+    trees_needed = np.rint(total_emissions / calculator.TREE_SEQUESTRATION).astype(np.int64)
+    london_ny = (total_emissions / (calculator.LONDON_NY_MILES * calculator.FLIGHT_EMISSION_FACTOR)) * 100
+    values = np.concatenate([group_totals.reshape(n_users, -1), total_emissions[:, None]], axis=1)
+
+    # Users providing the same categories share one key list
+    results: Dict[Hashable, Dict[str, Any]] = dict.fromkeys(user_ids)
+    patterns = present.astype(np.int64) @ (1 << np.arange(len(CATEGORIES)))
+    for pattern in np.unique(patterns).tolist():
+        keys, columns = [], []
+        for code, category in enumerate(CATEGORIES):
+            if pattern >> code & 1:
+                keys.extend(RESULT_KEYS[category])
+                columns.extend((2 * code, 2 * code + 1))
+        keys.append('total_emissions')
+        columns.append(values.shape[1] - 1)
+        users = np.flatnonzero(patterns == pattern)
+        for user, row, trees, london in zip(users.tolist(), values[users][:, columns].tolist(),
+                                            trees_needed[users].tolist(), london_ny[users].tolist()):
+            user_results = dict(zip(keys, row))
+            user_results['trees_needed'] = trees
+            user_results['london_ny_percentage'] = london
+            results[user_ids[user]] = user_results
+    return results
+
+def calculate_emissions_batch(payloads: Dict[Hashable, Any]) -> Tuple[Dict[Hashable, Dict[str, Any]], pd.DataFrame]:
+    """Calculate emissions for many users' payloads at once
+
+    payloads maps a user id to a payload in the standard (categorized) or quickstart
+    list format. Returns per-user results equal to calculate_emissions (without
+    entry_details) and a frame with one row per entry.
+    """
+    columns, user_ids, present = flatten_payloads(payloads)
+    distance, emissions, group_totals = compute_columns(
+        columns['user'], columns['category'], columns['distance'], columns['minutes'], n_users=len(user_ids)
+    )
+
+    results = _results_by_user(user_ids, group_totals, present)
+    entries = pd.DataFrame({
+        'user_id': pd.Categorical.from_codes(columns['user'], categories=pd.Index(user_ids, dtype=object))
+            if user_ids else pd.Categorical([]),
+        'category': pd.Categorical.from_codes(columns['category'], categories=CATEGORIES),
+        'distance': distance,
+        'minutes': columns['minutes'],
+        'emissions': emissions,
+    })
+    return results, entries
+
+def calculate_emissions_columns(user_ids: Iterable[Hashable], categories: Iterable[str], distances: Iterable[float],
+                                minutes: Optional[Iterable[float]] = None) -> Tuple[Dict[Hashable, Dict[str, Any]], pd.DataFrame]:
+    """Calculate emissions for entries that are already columnar with resolved distances
+
+    Every user id gets totals for the categories it has entries in. Lyft distances
+    may be NaN to estimate them from minutes.
+    """
+    # Let pandas infer the id dtype: integer ids factorize several times faster than as objects
+    user_codes, unique_users = pd.factorize(pd.Series(user_ids), sort=False)
+    category_codes = pd.Index(CATEGORIES).get_indexer(pd.Series(categories, dtype=object)).astype(np.int64)
+    if (category_codes < 0).any():
+        raise ValueError(f"Unknown category; expected one of {CATEGORIES}")
+    minutes_array = None if minutes is None else np.asarray(minutes, dtype=np.float64)
+
+    distance, emissions, group_totals = compute_columns(
+        user_codes.astype(np.int64), category_codes, distances, minutes_array, n_users=len(unique_users)
+    )
+    present = np.zeros((len(unique_users), len(CATEGORIES)), dtype=bool)
+    present[user_codes, category_codes] = True
+
+    results = _results_by_user(unique_users.tolist(), group_totals, present)
+    entries = pd.DataFrame({
+        'user_id': pd.Categorical.from_codes(user_codes, categories=unique_users),
+        'category': pd.Categorical.from_codes(category_codes, categories=CATEGORIES),
+        'distance': distance,
+        'minutes': np.full(len(distance), np.nan) if minutes_array is None else minutes_array,
+        'emissions': emissions,
+    })
+    return results, entries
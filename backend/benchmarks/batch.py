@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Benchmark the columnar batch engine: a calculate_emissions call per payload
+against calculate_emissions_batch over the same payloads, and
+calculate_emissions_columns over pre-resolved entry columns.
+
+Usage: python benchmarks/batch.py [--users N] [--entries N] [--rounds N]
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from batch import CATEGORIES, calculate_emissions_batch, calculate_emissions_columns
+from calculator import DETAIL_SUMMARY, calculate_emissions
+
+def make_payloads(users, seed=29):
+    """Payloads with directly provided distances (no Google lookups), ~8 entries each"""
+    rng = random.Random(seed)
+    payloads = {}
+    for user in range(users):
+        payload = {'uber_rides': [{'distance': round(rng.uniform(0.5, 30), 2), 'time': f"{rng.randint(3, 60)} minutes"}
+                                  for _ in range(rng.randint(2, 6))]}
+        if rng.random() < 0.5:
+            payload['lyft'] = [{'distance': round(rng.uniform(0.5, 20), 1)} if rng.random() < 0.7
+                               else {'time': f"{rng.randint(5, 45)} minutes"} for _ in range(rng.randint(1, 3))]
+        for category in ('uber_eats', 'doordash'):
+            if rng.random() < 0.5:
+                payload[category] = [{'distance': round(rng.uniform(0.3, 8), 2)} for _ in range(rng.randint(1, 3))]
+        payloads[f"user{user}"] = payload
+    return payloads
+
+def count_entries(payloads):
+    return sum(len(entries) for payload in payloads.values() for entries in payload.values())
+
+def best_of(rounds, fn, *args):
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000, help="payloads for the per-payload comparison")
+    parser.add_argument('--entries', type=int, default=2_000_000, help="pre-resolved entries for the columnar run")
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+    # Each calculation logs a summary record; keep it out of the timings
+    logging.disable(logging.INFO)
+
+    payloads = make_payloads(args.users)
+    entries = count_entries(payloads)
+    print(f"{args.users} payloads, {entries} entries")
+
+    def per_payload():
+        for payload in payloads.values():
+            calculate_emissions(payload, DETAIL_SUMMARY)
+
+    baseline = best_of(args.rounds, per_payload)
+    print(f"{'calculate_emissions loop':<28} {entries / baseline:>14,.0f} entries/s")
+    elapsed = best_of(args.rounds, calculate_emissions_batch, payloads)
+    print(f"{'calculate_emissions_batch':<28} {entries / elapsed:>14,.0f} entries/s  ({baseline / elapsed:.1f}x)")
+
+    rng = np.random.default_rng(29)
+    users = rng.integers(0, max(args.entries // 8, 1), args.entries)
+    categories = np.array(CATEGORIES, dtype=object)[rng.integers(0, len(CATEGORIES), args.entries)]
+    distances = rng.uniform(0.3, 30, args.entries)
+    elapsed = best_of(args.rounds, calculate_emissions_columns, users, categories, distances)
+    print(f"{'calculate_emissions_columns':<28} {args.entries / elapsed:>14,.0f} entries/s  "
+          f"({args.entries} entries, {len(np.unique(users))} users)")
+
+if __name__ == '__main__':
+    main()
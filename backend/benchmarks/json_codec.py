@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Benchmark JSON encode/decode of real history entries: the stdlib encoder as the
+legacy history file used it (indent=2), compact stdlib JSON, and json_codec
+(orjson when installed).
+
+Usage: python benchmarks/json_codec.py [--source FILE] [--rounds N]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json_codec
+
+DEFAULT_SOURCE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              'data', 'calculations_history.json')
+
+def bench(fn, items, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for item in items:
+            fn(item)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--source', default=DEFAULT_SOURCE, help="legacy calculations_history.json")
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    with open(args.source, 'r') as f:
+        entries = json.load(f)
+    operations = args.rounds * len(entries)
+    print(f"{len(entries)} history entries x {args.rounds} rounds, codec: {json_codec.CODEC}")
+
+    encoders = {
+        'stdlib indent=2': lambda entry: json.dumps(entry, indent=2).encode('utf-8'),
+        'stdlib compact': lambda entry: json.dumps(entry, separators=(',', ':')).encode('utf-8'),
+        'json_codec': json_codec.dumps,
+    }
+    baseline = None
+    for name, encode in encoders.items():
+        elapsed = bench(encode, entries, args.rounds)
+        baseline = baseline or elapsed
+        size = sum(len(encode(entry)) for entry in entries) / len(entries)
+        print(f"encode {name:<16} {elapsed / operations * 1e6:8.2f} us/entry  {size:8.0f} bytes/entry  {baseline / elapsed:5.1f}x")
+
+    lines = [json_codec.dumps(entry) for entry in entries]
+    baseline = bench(json.loads, lines, args.rounds)
+    print(f"decode {'stdlib':<16} {baseline / operations * 1e6:8.2f} us/entry")
+    elapsed = bench(json_codec.loads, lines, args.rounds)
+    print(f"decode {'json_codec':<16} {elapsed / operations * 1e6:8.2f} us/entry  {baseline / elapsed:5.1f}x")
+
+if __name__ == '__main__':
+    main()
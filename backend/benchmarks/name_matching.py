@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Benchmark Places candidate name scoring: the built-in calculate_name_similarity
+loop against the batched rapidfuzz scorers used by find_nearest_restaurant_location.
+
+Usage: python benchmarks/name_matching.py [--rounds N]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from calculator import NAME_SCORERS, calculate_name_similarity, score_name_candidates, fuzz
+
+# Restaurant names as they come out of the receipt regexes, paired with the kind of
+# candidate list a Places Nearby search returns (up to 20 results, mostly other brands)
+NEARBY_PLACES = [
+    "McDonald's", "Burger King", "Taco Bell", "Wendy's", "Subway", "Jimmy John's",
+    "Chipotle Mexican Grill", "Panda Express", "Domino's Pizza", "Pizza Hut",
+    "Starbucks", "Dutch Bros Coffee", "The Chicken Shanty", "Local Boyz Hawaiian Cafe",
+    "Qdoba Mexican Eats", "Thai Orchid", "Burgerville", "Red Robin Gourmet Burgers",
+    "Sweet Red Bistro", "Bell Tower Cafe",
+]
+RESTAURANTS = [
+    "McDonalds", "Chicken Shanty Corvallis", "Burgerville USA", "Panda Express",
+    "Taco Bell", "Local Boyz", "Chipotle", "Qdoba", "Thai Chili", "Pizza Hut",
+]
+
+def bench_legacy(rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for restaurant in RESTAURANTS:
+            [calculate_name_similarity(restaurant, name) for name in NEARBY_PLACES]
+    return time.perf_counter() - start
+
+def bench_batched(rounds, scorer):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for restaurant in RESTAURANTS:
+            score_name_candidates(restaurant, NEARBY_PLACES, scorer)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+
+    searches = args.rounds * len(RESTAURANTS)
+    print(f"{searches} searches x {len(NEARBY_PLACES)} candidates")
+
+    baseline = bench_legacy(args.rounds)
+    print(f"{'legacy loop':<18} {baseline / searches * 1e6:8.2f} us/search")
+
+    if fuzz is None:
+        print("rapidfuzz not installed, skipping batched scorers")
+        return
+
+    for scorer in NAME_SCORERS:
+        if scorer == 'legacy':
+            continue
+        elapsed = bench_batched(args.rounds, scorer)
+        print(f"{scorer:<18} {elapsed / searches * 1e6:8.2f} us/search  ({baseline / elapsed:.1f}x)")
+
+    # Show that each scorer's cutoff keeps or drops the same candidates as the legacy 0.1 cutoff
+    print("\nAgreement with legacy accept/skip decisions:")
+    legacy_cutoff = NAME_SCORERS['legacy'][1]
+    for scorer in NAME_SCORERS:
+        if scorer == 'legacy':
+            continue
+        agree = total = 0
+        for restaurant in RESTAURANTS:
+            scores, cutoff = score_name_candidates(restaurant, NEARBY_PLACES, scorer)
+            for name, score in zip(NEARBY_PLACES, scores):
+                legacy = calculate_name_similarity(restaurant, name) >= legacy_cutoff
+                agree += (score >= cutoff) == legacy
+                total += 1
+        print(f"{scorer:<18} {agree}/{total}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Benchmark cold start: the time to import the Flask app and the time from a
+fresh interpreter to the first /api/calculate response (test client, no
+Google calls). Each run is a new process; medians are reported.
+
+Usage: python benchmarks/startup.py [--runs N] [--importtime]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in a fresh interpreter; history goes to a throwaway store
+_PROBE = """
+import json, sys, tempfile, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+from history import JsonlHistoryStore
+app.history_store = JsonlHistoryStore(tempfile.mktemp(suffix='.jsonl'))
+app.history_writer = None
+response = app.app.test_client().post('/api/calculate', data=sys.argv[1], content_type='application/json')
+responded = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({'import': imported - start, 'first_response': responded - start,
+                  'modules': sorted(name for name in ('googleapiclient', 'google_auth_oauthlib', 'googlemaps')
+                                    if name in sys.modules)}))
+"""
+
+SAMPLE_PAYLOAD = {
+    'uber_rides': [{'distance': 4.2, 'time': '14'}],
+    'flights': [{'airport_a': 'SFO', 'airport_b': 'JFK'}],
+}
+
+def probe() -> dict:
+    env = dict(os.environ, HISTORY_WRITE_BEHIND='false', HISTORY_COMPACT_INTERVAL='0', LOG_SAMPLE_RATE='0')
+    result = subprocess.run([sys.executable, '-c', _PROBE, json.dumps(SAMPLE_PAYLOAD)], cwd=BACKEND_DIR,
+                            env=env, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def import_breakdown(top: int = 15):
+    """Print the modules with the largest cumulative import time (python -X importtime)"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=BACKEND_DIR,
+                            capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), name.rstrip()))
+    for cumulative, name in sorted(rows, reverse=True)[:top]:
+        print(f"{cumulative / 1000:8.1f} ms  {name}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--importtime', action='store_true', help="also show the slowest imports")
+    args = parser.parse_args()
+
+    probe()  # warm the filesystem and bytecode caches
+    runs = [probe() for _ in range(args.runs)]
+    print(f"{args.runs} cold starts (median)")
+    print(f"import app          {statistics.median(run['import'] for run in runs) * 1000:8.1f} ms")
+    print(f"first response      {statistics.median(run['first_response'] for run in runs) * 1000:8.1f} ms")
+    print(f"google libs loaded  {', '.join(runs[-1]['modules']) or 'none'}")
+
+    if args.importtime:
+        print()
+        import_breakdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Build data/airport_distances.bin, the precomputed great-circle distance table for
+every pair of airports in quickstart.VALID_AIRPORTS.
+
+Coordinates are taken from airports already geocoded in the calculation history,
+so the table gives the same distances as the geocoding path in
+calculate_flight_distance, then from data/airport_coordinates.csv (published
+airport reference points, within a mile or so of the geocoded locations), and
+finally from the Google Geocoding API (requires GOOGLE_MAPS) for the rest.
+Airports that cannot be resolved are left out and keep using that path.
+
+Usage: python build_airport_table.py [--history FILE] [--coordinates FILE] [--no-geocode] [--output FILE]
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+
+from dotenv import load_dotenv
+
+from airport_table import DEFAULT_TABLE_PATH, write_table
+from calculator import geocode_airport, haversine_distance
+from quickstart import VALID_AIRPORTS
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+DEFAULT_HISTORY = os.path.join(DATA_DIR, 'calculations_history.json')
+DEFAULT_COORDINATES = os.path.join(DATA_DIR, 'airport_coordinates.csv')
+
+def coordinates_from_history(path, codes):
+    """Collect airport coordinates from geocoded flight segments in the history file"""
+    found = {}
+    if not os.path.exists(path):
+        return found
+
+    with open(path, 'r') as f:
+        history = json.load(f)
+
+    for entry in history:
+        flights = entry.get('results', {}).get('entry_details', {}).get('flights', [])
+        for flight in flights:
+            for segment in flight.get('segments', []):
+                for key in ('origin_info', 'destination_info'):
+                    info = segment.get(key) or {}
+                    code = str(info.get('code', '')).upper()
+                    if code in codes and code not in found and info.get('status') == 'OK' and 'lat' in info:
+                        found[code] = (info['lat'], info['lng'], info.get('formatted_address', code))
+    return found
+
+def coordinates_from_file(path, codes):
+    """Read airport coordinates from a code,lat,lng,name CSV file"""
+    found = {}
+    if not path or not os.path.exists(path):
+        return found
+
+    with open(path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            code = row['code'].strip().upper()
+            if code in codes:
+                found[code] = (float(row['lat']), float(row['lng']), row.get('name') or code)
+    return found
+
+def main():
+    # GOOGLE_MAPS for the Geocoding fallback usually lives in .env
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Build the precomputed airport distance table")
+    parser.add_argument('--history', default=DEFAULT_HISTORY, help="history file to reuse geocoded airports from")
+    parser.add_argument('--coordinates', default=DEFAULT_COORDINATES, help="CSV of airport coordinates for airports not in history")
+    parser.add_argument('--no-geocode', action='store_true', help="only use coordinates from the history and coordinates files")
+    parser.add_argument('--output', default=DEFAULT_TABLE_PATH)
+    args = parser.parse_args()
+
+    codes = set(VALID_AIRPORTS)
+    coordinates = coordinates_from_history(args.history, codes)
+    print(f"{len(coordinates)} airports found in {args.history}")
+    listed = coordinates_from_file(args.coordinates, codes - set(coordinates))
+    coordinates.update(listed)
+    print(f"{len(listed)} more airports found in {args.coordinates}")
+
+    if not args.no_geocode:
+        for code in sorted(codes - set(coordinates)):
+            info = geocode_airport(code)
+            if info and info.get('status') == 'OK':
+                coordinates[code] = (info['lat'], info['lng'], info['formatted_address'])
+            else:
+                print(f"Could not geocode {code}: {(info or {}).get('error', 'Google Maps client not initialized')}")
+
+    if not coordinates:
+        print("No airport coordinates available, table not written")
+        return 1
+
+    airports = [(code, lat, lng, address) for code, (lat, lng, address) in coordinates.items()]
+    n = write_table(args.output, airports, haversine_distance)
+    print(f"Wrote {n} airports ({n * n} routes, {os.path.getsize(args.output)} bytes) to {args.output}")
+    missing = sorted(codes - set(coordinates))
+    if missing:
+        print(f"{len(missing)} airports not in the table: {' '.join(missing)}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,26 +7,63 @@ Currently calculaets for transportation activities:
 - Air flights
 Uber Eats, Doordash and Air Flights require Google API integration to calculate distances.
 """
+import hashlib
+import json
 import math
 import os
 import logging
 import re
+import threading
+import time
+from datetime import date, datetime
+from functools import lru_cache
 from typing import List, Dict, Any, Tuple, Optional, Union
-from dotenv import load_dotenv
+from admission import RateLimited
+from airport_table import get_airport_table
+from metrics import count_cache, google_call, observe_stage
+import request_log
+from request_log import log_scope
+from lookup_cache import (
+    SingleFlight, LookupCache, lookup_scope, note_unresolved, normalize_key,
+    OUTCOME_OK, OUTCOME_PERMANENT, OUTCOME_TRANSIENT
+)
 
-load_dotenv()
-# Initialize Google Maps client if API key is available
+# For import-time messages: a root logging call here would configure the root
+# logger before app.py's basicConfig runs
+logger = logging.getLogger('carbon_emissions')
+
+# Google Maps client, built by get_gmaps() on first use: importing googlemaps
+# (and requests) is left off the startup path. The key is read from GOOGLE_MAPS,
+# which app.py loads from .env.
+gmaps = None
+_gmaps_checked = False
+_gmaps_lock = threading.Lock()
+
+def get_gmaps():
+    """Return the Google Maps client, building it on first use (None without an API key)"""
+    global gmaps, _gmaps_checked
+    if gmaps is not None or _gmaps_checked:
+        return gmaps
+    with _gmaps_lock:
+        if not _gmaps_checked:
+            try:
+                import googlemaps
+                api_key = os.getenv('GOOGLE_MAPS')
+                if api_key:
+                    gmaps = googlemaps.Client(key=api_key)
+                else:
+                    logging.warning("GOOGLE_MAPS api key not found in environment variables. Distance calculations will not work.")
+            except ImportError:
+                logging.warning("googlemaps library not installed. Please install with 'pip install googlemaps'")
+            _gmaps_checked = True
+    return gmaps
+
+# rapidfuzz scores all Places candidates for a restaurant in a single batched call
 try:
-    import googlemaps
-    GOOGLE_API_KEY = os.getenv('GOOGLE_MAPS')
-    if GOOGLE_API_KEY:
-        gmaps = googlemaps.Client(key=GOOGLE_API_KEY)
-    else:
-        gmaps = None
-        logging.warning("GOOGLE_API_KEY not found in environment variables. Distance calculations will not work.")
+    from rapidfuzz import fuzz, process as fuzz_process, utils as fuzz_utils
 except ImportError:
-    gmaps = None
-    logging.warning("googlemaps library not installed. Please install with 'pip install googlemaps'")
+    fuzz = fuzz_process = fuzz_utils = None
+    logger.warning("rapidfuzz library not installed. Falling back to built-in name matching.")
 
 # Emission factors
 UBER_EMISSION_FACTOR = 0.4  # kg CO₂ per mile
@@ -36,6 +73,69 @@ FLIGHT_EMISSION_FACTOR = 0.25  # kg CO₂ per mile
 TREE_SEQUESTRATION = 22  # kg CO₂ per tree per year
 LONDON_NY_MILES = 3500  # miles
 
+def _memoizable(result: Any) -> bool:
+    """Whether a lookup result may be reused for the rest of a calculation (not a transient failure)"""
+    return not (isinstance(result, dict) and 'status' in result and _lookup_outcome(result) == OUTCOME_TRANSIENT)
+
+# Concurrent callers asking for the same geocode/place/distance share one Google call
+_lookups = SingleFlight(memoize=_memoizable)
+
+# Resolved airports and restaurants are cached per worker. Failures get their own,
+# shorter TTLs: permanent ones (NOT_FOUND) for an hour, transient ones for a minute.
+_lookup_results = LookupCache(
+    maxsize=int(os.getenv('LOOKUP_CACHE_SIZE', 2048)),
+    ttl=float(os.getenv('LOOKUP_CACHE_TTL', 86400)),
+    negative_ttl=float(os.getenv('LOOKUP_NEGATIVE_TTL', 3600)),
+    transient_ttl=float(os.getenv('LOOKUP_TRANSIENT_TTL', 60))
+)
+# Name scorers for matching Places candidates to a restaurant name. Each is paired with
+# the minimum similarity (0-1) that plays the role of the legacy matcher's 0.1 cutoff:
+# candidates sharing no meaningful word with the restaurant name fall below it.
+NAME_SCORERS = {
+    'legacy': (None, 0.1),
+    'token_set_ratio': (fuzz.token_set_ratio if fuzz else None, 0.55),
+    'partial_ratio': (fuzz.partial_ratio if fuzz else None, 0.65),
+    'WRatio': (fuzz.WRatio if fuzz else None, 0.65),
+}
+NAME_MATCH_SCORER = os.getenv('NAME_MATCH_SCORER', 'token_set_ratio')
+
+# How much per-entry detail calculate_emissions returns: totals only, entry distances
+# and emissions without restaurant/airport metadata, or everything
+DETAIL_SUMMARY = 'summary'
+DETAIL_ENTRY = 'per-entry'
+DETAIL_FULL = 'full'
+DETAIL_LEVELS = (DETAIL_SUMMARY, DETAIL_ENTRY, DETAIL_FULL)
+
+# Statuses meaning the input itself cannot be resolved
+PERMANENT_FAILURE_STATUSES = {'NOT_FOUND', 'ZERO_RESULTS', 'INVALID_REQUEST'}
+
+def _lookup_outcome(result: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Classify a lookup result for caching (None means do not cache)"""
+    if not result:
+        return None
+    status = result.get('status')
+    if status == 'OK':
+        return OUTCOME_OK
+    if status in PERMANENT_FAILURE_STATUSES:
+        return OUTCOME_PERMANENT
+    return OUTCOME_TRANSIENT
+
+def _resolve_and_cache(key, fn, *args):
+    """Run a lookup and store its result under the outcome's TTL"""
+    result = fn(*args)
+    outcome = _lookup_outcome(result)
+    if outcome:
+        _lookup_results.set(key, result, outcome)
+    return result
+
+def _cached_lookup(key, fn, *args):
+    """Resolve a lookup from the cache, or through a single coalesced call"""
+    hit, result = _lookup_results.get(key)
+    count_cache('lookup', hit)
+    if hit:
+        return result
+    return _lookups.do(key, _resolve_and_cache, key, fn, *args)
+
 def calculate_uber_emissions(miles: float) -> float:
     """Calculate emissions from Uber ride given distance in miles"""
     return miles * UBER_EMISSION_FACTOR
@@ -54,13 +154,25 @@ def calculate_flight_emissions(miles: float) -> float:
 
 def geocode_airport(airport_code: str) -> Optional[Dict[str, Any]]:
     """Geocode an airport by its IATA code"""
-    if not gmaps:
+    if not get_gmaps():
+        return _geocode_airport(airport_code)
+
+    result = _cached_lookup(('airport', normalize_key(airport_code)), _geocode_airport, airport_code)
+    if result and result.get('code') != airport_code:
+        # Shared result from a caller that spelled the code differently
+        result = dict(result, code=airport_code)
+    return result
+
+def _geocode_airport(airport_code: str) -> Optional[Dict[str, Any]]:
+    """Geocode an airport by its IATA code (uncoalesced)"""
+    client = get_gmaps()
+    if not client:
         logging.error("Google Maps client not initialized. Cannot geocode airport.")
         return None
     
     try:
         # Search for "<code> airport" to get more accurate results
-        result = gmaps.geocode(f"{airport_code} airport")
+        result = google_call('geocode', client.geocode, f"{airport_code} airport")
         
         if result and len(result) > 0:
             # Extract coordinates from the first result
@@ -112,6 +224,30 @@ def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
 
 def calculate_flight_distance(origin: str, destination: str) -> Optional[Dict[str, Any]]:
     """Calculate distance between two airports using Haversine formula"""
+    start = time.perf_counter()
+    try:
+        with observe_stage('flight_lookup'):
+            return _calculate_flight_distance(origin, destination)
+    finally:
+        request_log.count('flight_lookups')
+        request_log.add_time('flight_lookup', time.perf_counter() - start)
+
+def _calculate_flight_distance(origin: str, destination: str) -> Optional[Dict[str, Any]]:
+    """Calculate distance between two airports using Haversine formula (untimed)"""
+    # Routes between known airports are read from the precomputed distance table
+    table = get_airport_table()
+    if table is not None:
+        origin_code = origin.strip().upper()
+        destination_code = destination.strip().upper()
+        distance = table.distance(origin_code, destination_code)
+        if distance is not None:
+            return {
+                'distance_miles': distance,
+                'origin_info': dict(table.airport_info(origin_code), code=origin),
+                'destination_info': dict(table.airport_info(destination_code), code=destination),
+                'status': 'OK'
+            }
+    
     # Get coordinates for both airports
     origin_info = geocode_airport(origin)
     destination_info = geocode_airport(destination)
@@ -151,10 +287,23 @@ def calculate_flight_distance(origin: str, destination: str) -> Optional[Dict[st
             'error': error_message
         }
 
+def driving_distance_matrix(client, origin: str, destination: str) -> Dict[str, Any]:
+    """Call the Distance Matrix API for a single driving route, coalescing identical requests"""
+    return _lookups.do(
+        ('distance_matrix', normalize_key(origin), normalize_key(destination)),
+        google_call,
+        'distance_matrix',
+        client.distance_matrix,
+        origins=[origin],
+        destinations=[destination],
+        mode="driving",
+        units="imperial"  # Get results in miles
+    )
+
 def calculate_distance_between_addresses(origin: str, destination: str, client=None) -> Dict[str, Any]:
     """Calculate driving distance between two addresses using Google Maps API"""
-    if not client and gmaps:
-        client = gmaps
+    if not client:
+        client = get_gmaps()
         
     if not client:
         logging.error("Google Maps client not initialized. Cannot calculate distance.")
@@ -172,16 +321,11 @@ def calculate_distance_between_addresses(origin: str, destination: str, client=N
         # If this looks like a food delivery (origin might be a restaurant name),
         # use the specialized restaurant finder
         if len(origin.split(',')) == 1 and 'restaurant' not in origin.lower():
-            logging.info(f"Origin '{origin}' appears to be a restaurant name. Using restaurant finder.")
+            request_log.detail("Origin '%s' appears to be a restaurant name. Using restaurant finder.", origin)
             return calculate_food_delivery_distance(origin, destination, client)
             
         # Standard distance calculation using Distance Matrix API
-        result = client.distance_matrix(
-            origins=[origin],
-            destinations=[destination],
-            mode="driving",
-            units="imperial"  # Get results in miles
-        )
+        result = driving_distance_matrix(client, origin, destination)
         
         # Check if we got a valid result
         if result['status'] == 'OK' and result['rows'][0]['elements'][0]['status'] == 'OK':
@@ -258,15 +402,10 @@ def calculate_food_delivery_distance(restaurant: str, delivery_address: str, gma
         # Step 2: Use the specific restaurant address to calculate the driving distance
         restaurant_address = nearest_result['restaurant_address']
         
-        logging.info(f"Found nearest {restaurant} location at {restaurant_address} to {delivery_address}")
+        request_log.detail("Found nearest %s location at %s to %s", restaurant, restaurant_address, delivery_address)
         
         # Calculate driving distance using Distance Matrix API
-        result = gmaps_client.distance_matrix(
-            origins=[restaurant_address],
-            destinations=[delivery_address],
-            mode="driving",
-            units="imperial"  # Get results in miles
-        )
+        result = driving_distance_matrix(gmaps_client, restaurant_address, delivery_address)
         
         # Check if we got a valid result
         if result['status'] == 'OK' and result['rows'][0]['elements'][0]['status'] == 'OK':
@@ -277,7 +416,7 @@ def calculate_food_delivery_distance(restaurant: str, delivery_address: str, gma
             # Extract duration
             duration_text = result['rows'][0]['elements'][0]['duration']['text']
             
-            logging.info(f"Driving distance from {restaurant_address} to {delivery_address} is {distance_value:.2f} miles")
+            request_log.detail("Driving distance from %s to %s is %.2f miles", restaurant_address, delivery_address, distance_value)
             
             return {
                 'distance_miles': float(distance_text.split()[0]),
@@ -317,6 +456,30 @@ def calculate_food_delivery_distance(restaurant: str, delivery_address: str, gma
 
 def find_nearest_restaurant_location(restaurant_name: str, delivery_address: str, gmaps_client=None) -> Dict[str, Any]:
     """Find the nearest location of a restaurant to a delivery address"""
+    if not gmaps_client:
+        return _find_nearest_restaurant_location(restaurant_name, delivery_address, gmaps_client)
+
+    result = _cached_lookup(
+        ('restaurant', normalize_key(restaurant_name), normalize_key(delivery_address)),
+        _search_restaurant_location,
+        restaurant_name, delivery_address, gmaps_client
+    )
+    if result.get('restaurant_name') != restaurant_name or result.get('delivery_address') != delivery_address:
+        # Shared result from a caller that spelled the inputs differently
+        result = dict(result, restaurant_name=restaurant_name, delivery_address=delivery_address)
+    return result
+
+def _search_restaurant_location(restaurant_name: str, delivery_address: str, gmaps_client) -> Dict[str, Any]:
+    """Uncached restaurant search, counted and timed in the calculation's log summary"""
+    start = time.perf_counter()
+    try:
+        return _find_nearest_restaurant_location(restaurant_name, delivery_address, gmaps_client)
+    finally:
+        request_log.count('restaurant_searches')
+        request_log.add_time('restaurant_search', time.perf_counter() - start)
+
+def _find_nearest_restaurant_location(restaurant_name: str, delivery_address: str, gmaps_client=None) -> Dict[str, Any]:
+    """Find the nearest location of a restaurant to a delivery address (uncoalesced)"""
     if not gmaps_client:
         logging.error("Google Maps client not initialized. Cannot find nearest restaurant location.")
         return {
@@ -328,7 +491,10 @@ def find_nearest_restaurant_location(restaurant_name: str, delivery_address: str
     
     try:
         # First geocode the delivery address to get its coordinates
-        geocode_result = gmaps_client.geocode(delivery_address)
+        geocode_result = _lookups.do(
+            ('geocode', normalize_key(delivery_address)),
+            google_call, 'geocode', gmaps_client.geocode, delivery_address
+        )
         if not geocode_result:
             logging.error(f"Could not geocode delivery address: {delivery_address}")
             return {
@@ -344,7 +510,7 @@ def find_nearest_restaurant_location(restaurant_name: str, delivery_address: str
         
         # Generate name variations to try (primary logic for fixing "Burgerville USA" issue)
         name_variations = generate_name_variations(restaurant_name)
-        logging.info(f"Trying with name variations: {name_variations}")
+        request_log.detail("Trying with name variations: %s", name_variations)
         
         # Define search radii to try (in meters), progressively larger
         # Starting with 14000m (~8.7 miles), then adding ~10 miles increments
@@ -352,6 +518,8 @@ def find_nearest_restaurant_location(restaurant_name: str, delivery_address: str
         
         # Stores all restaurant locations found across all attempts
         all_restaurant_locations = []
+        # Last failed search: with no results it makes the outcome an error, not NOT_FOUND
+        search_error = None
         
         # Try each name variation with each search radius until we find something
         for name_var in name_variations:
@@ -359,11 +527,13 @@ def find_nearest_restaurant_location(restaurant_name: str, delivery_address: str
                 if all_restaurant_locations:
                     break  # Stop if we've already found locations
                 
-                logging.info(f"Searching for '{name_var}' within {radius/1609:.1f} miles of {delivery_address}")
+                request_log.detail("Searching for '%s' within %.1f miles of %s", name_var, radius / 1609, delivery_address)
                 
                 # Try Places Nearby API first (more specific to location)
                 try:
-                    places_result = gmaps_client.places_nearby(
+                    request_log.count('places_calls')
+                    places_result = google_call(
+                        'places_nearby', gmaps_client.places_nearby,
                         location=(delivery_lat, delivery_lng),
                         radius=radius,
                         keyword=name_var,
@@ -372,34 +542,50 @@ def find_nearest_restaurant_location(restaurant_name: str, delivery_address: str
                     
                     results = places_result.get('results', [])
                     if results:
-                        logging.info(f"Found {len(results)} places for '{name_var}' within {radius/1609:.1f} miles")
+                        request_log.detail("Found %d places for '%s' within %.1f miles", len(results), name_var, radius / 1609)
                         all_restaurant_locations.extend(results)
                         break
                     else:
-                        logging.info(f"No results from Places Nearby for '{name_var}' within {radius/1609:.1f} miles")
+                        request_log.detail("No results from Places Nearby for '%s' within %.1f miles", name_var, radius / 1609)
                 except Exception as e:
+                    search_error = e
                     logging.warning(f"Error in Places Nearby search: {str(e)}")
                 
                 # If Places Nearby failed, try Text Search (more flexible with names)
                 if not all_restaurant_locations:
                     try:
-                        places_result = gmaps_client.places(
+                        request_log.count('places_calls')
+                        places_result = google_call(
+                            'places', gmaps_client.places,
                             query=f"{name_var} near {delivery_address}"
                         )
                         
                         results = places_result.get('results', [])
                         if results:
-                            logging.info(f"Found {len(results)} places from text search for '{name_var}'")
+                            request_log.detail("Found %d places from text search for '%s'", len(results), name_var)
                             all_restaurant_locations.extend(results)
                             break
                         else:
-                            logging.info(f"No results from text search for '{name_var}'")
+                            request_log.detail("No results from text search for '%s'", name_var)
                     except Exception as e:
+                        search_error = e
                         logging.warning(f"Error in text search: {str(e)}")
             
             if all_restaurant_locations:
                 break  # Found locations with this name variation, no need to try others
         
+        # A search that failed (timeout, rate limit) may have missed the restaurant:
+        # report it as transient so the result is retried rather than cached as NOT_FOUND
+        if not all_restaurant_locations and search_error is not None:
+            logging.warning(f"No locations found for '{restaurant_name}' near {delivery_address}; "
+                            f"a Places search failed: {str(search_error)}")
+            return {
+                'status': 'RATE_LIMITED' if isinstance(search_error, RateLimited) else 'ERROR',
+                'error': f"Could not search for restaurant '{restaurant_name}': {str(search_error)}",
+                'restaurant_name': restaurant_name,
+                'delivery_address': delivery_address
+            }
+
         # If we still don't have results after trying all variations and radii
         if not all_restaurant_locations:
             logging.warning(f"No locations found for any variation of '{restaurant_name}' near {delivery_address}")
@@ -415,17 +601,22 @@ def find_nearest_restaurant_location(restaurant_name: str, delivery_address: str
         closest_distance = float('inf')
         matched_name = None
         
-        for location in all_restaurant_locations:
-            location_name = location.get('name', '')
-            
+        # Score every candidate name in one batch
+        location_names = [location.get('name', '') for location in all_restaurant_locations]
+        similarities, min_similarity = score_name_candidates(restaurant_name, location_names)
+        request_log.count('candidates', len(location_names))
+        
+        for location, location_name, name_similarity in zip(all_restaurant_locations, location_names, similarities):
             # Skip locations with very low name similarity instead of strict matching
-            name_similarity = calculate_name_similarity(restaurant_name, location_name)
-            if name_similarity < 0.1:  # Lowered threshold from 0.2 to 0.1 for more flexible matching
-                logging.info(f"Skipping '{location_name}' - too dissimilar to '{restaurant_name}' (similarity: {name_similarity:.2f})")
+            if name_similarity < min_similarity:
+                request_log.count('candidates_skipped')
+                request_log.detail("Skipping '%s' - too dissimilar to '%s' (similarity: %.2f)",
+                                   location_name, restaurant_name, name_similarity)
                 continue
                 
             # Log what we're considering
-            logging.info(f"Considering '{location_name}' as match for '{restaurant_name}' (similarity: {name_similarity:.2f})")
+            request_log.detail("Considering '%s' as match for '%s' (similarity: %.2f)",
+                               location_name, restaurant_name, name_similarity)
             
             restaurant_lat = location['geometry']['location']['lat']
             restaurant_lng = location['geometry']['location']['lng']
@@ -451,13 +642,13 @@ def find_nearest_restaurant_location(restaurant_name: str, delivery_address: str
             # Calculate distance
             distance = earth_radius * c
             
-            logging.info(f"Location '{location_name}' is {distance:.2f} miles away (straight-line distance)")
+            request_log.detail("Location '%s' is %.2f miles away (straight-line distance)", location_name, distance)
             
             if distance < closest_distance:
                 closest_distance = distance
                 closest_restaurant = location
                 matched_name = location_name
-                logging.info(f"New closest: '{location_name}' at {distance:.2f} miles (straight-line distance)")
+                request_log.detail("New closest: '%s' at %.2f miles (straight-line distance)", location_name, distance)
         
         if not closest_restaurant:
             logging.warning(f"No suitable location found for '{restaurant_name}' near '{delivery_address}'")
@@ -469,7 +660,8 @@ def find_nearest_restaurant_location(restaurant_name: str, delivery_address: str
             }
         
         # Get the full address of the closest restaurant
-        place_details = gmaps_client.place(
+        place_details = google_call(
+            'place', gmaps_client.place,
             place_id=closest_restaurant['place_id'],
             fields=['name', 'formatted_address', 'geometry']
         )
@@ -478,7 +670,8 @@ def find_nearest_restaurant_location(restaurant_name: str, delivery_address: str
         restaurant_address = restaurant_details.get('formatted_address', 
                                                   closest_restaurant.get('vicinity', 'Unknown address'))
         
-        logging.info(f"Selected restaurant: {matched_name} at {restaurant_address}")
+        request_log.detail("Selected restaurant: %s at %s", matched_name, restaurant_address)
+        request_log.count('restaurants_found')
         
         return {
             'status': 'OK',
@@ -527,11 +720,36 @@ def generate_name_variations(restaurant_name: str) -> List[str]:
     # Remove duplicates and return
     return list(dict.fromkeys(variations))  # Preserves order while removing duplicates
 
+def score_name_candidates(restaurant_name: str, candidate_names: List[str],
+                          scorer: Optional[str] = None) -> Tuple[List[float], float]:
+    """Score candidate place names against a restaurant name (0-1 scale) in one batch
+    
+    Returns the scores and the minimum similarity a candidate needs for the chosen scorer.
+    """
+    scorer = scorer or NAME_MATCH_SCORER
+    if scorer not in NAME_SCORERS:
+        logging.warning(f"Unknown NAME_MATCH_SCORER '{scorer}', using legacy name matching")
+        scorer = 'legacy'
+    scorer_fn, min_similarity = NAME_SCORERS[scorer]
+    
+    if scorer_fn is None or not candidate_names:
+        return [calculate_name_similarity(restaurant_name, name) for name in candidate_names], NAME_SCORERS['legacy'][1]
+    
+    scores = fuzz_process.cdist(
+        [restaurant_name], candidate_names,
+        scorer=scorer_fn,
+        processor=fuzz_utils.default_process,
+        workers=1
+    )[0]
+    return (scores / 100.0).tolist(), min_similarity
+
+_NON_WORD_CHARS = re.compile(r'[^\w\s]')
+
 def calculate_name_similarity(name1: str, name2: str) -> float:
     """Calculate similarity between two restaurant names"""
     # Normalize names by removing punctuation and converting to lowercase
-    name1 = re.sub(r'[^\w\s]', '', name1.lower())
-    name2 = re.sub(r'[^\w\s]', '', name2.lower())
+    name1 = _NON_WORD_CHARS.sub('', name1.lower())
+    name2 = _NON_WORD_CHARS.sub('', name2.lower())
     
     # Method 1: Check if one is a prefix of the other
     if name1.startswith(name2) or name2.startswith(name1):
@@ -601,9 +819,17 @@ def parse_time_string(time_str: Union[str, int, float]) -> int:
     
     return total_minutes
 
-def process_food_delivery(delivery: Dict[str, Any], delivery_type: str="uber_eats") -> Tuple[float, Dict[str, Any]]:
-    """Process food delivery data to calculate distance and emissions"""
+def process_food_delivery(delivery: Dict[str, Any], delivery_type: str="uber_eats",
+                          detail_level: str=DETAIL_FULL) -> Tuple[float, Optional[Dict[str, Any]]]:
+    """Process food delivery data to calculate distance and emissions
+    
+    With DETAIL_SUMMARY only the distance is returned (detail is None); with
+    DETAIL_ENTRY the detail omits restaurant metadata.
+    """
+    summary = detail_level == DETAIL_SUMMARY
     if not delivery or 'error' in delivery:  # Skip empty or error entries
+        if summary:
+            return 0, None
         return 0, {
             'distance': 0,
             'emissions': 0,
@@ -613,6 +839,8 @@ def process_food_delivery(delivery: Dict[str, Any], delivery_type: str="uber_eat
     # Check if distance is directly provided
     if 'distance' in delivery:
         distance = float(delivery.get('distance', 0))
+        if summary:
+            return distance, None
         detail = {
             'distance': distance,
             'emissions': calculate_food_delivery_emissions(distance),
@@ -625,9 +853,12 @@ def process_food_delivery(delivery: Dict[str, Any], delivery_type: str="uber_eat
         distance_result = calculate_food_delivery_distance(
             delivery['restaurant'], 
             delivery['delivery_address'],
-            gmaps
+            get_gmaps()
         )
         
+        if summary:
+            return (distance_result['distance_exact'] if distance_result and distance_result['status'] == 'OK' else 0), None
+        
         if distance_result and distance_result['status'] == 'OK':
             distance = distance_result['distance_exact']
             detail = {
@@ -640,7 +871,7 @@ def process_food_delivery(delivery: Dict[str, Any], delivery_type: str="uber_eat
                 'status': 'OK'
             }
             # Add restaurant details if available
-            if 'nearest_restaurant_details' in distance_result:
+            if 'nearest_restaurant_details' in distance_result and detail_level == DETAIL_FULL:
                 detail['restaurant_details'] = distance_result['nearest_restaurant_details']
                 
             return distance, detail
@@ -663,9 +894,12 @@ def process_food_delivery(delivery: Dict[str, Any], delivery_type: str="uber_eat
         distance_result = calculate_food_delivery_distance(
             delivery['ordered_from'], 
             delivery['address'],
-            gmaps
+            get_gmaps()
         )
         
+        if summary:
+            return (distance_result['distance_exact'] if distance_result and distance_result['status'] == 'OK' else 0), None
+        
         if distance_result and distance_result['status'] == 'OK':
             distance = distance_result['distance_exact']
             detail = {
@@ -678,7 +912,7 @@ def process_food_delivery(delivery: Dict[str, Any], delivery_type: str="uber_eat
                 'status': 'OK'
             }
             # Add restaurant details if available
-            if 'nearest_restaurant_details' in distance_result:
+            if 'nearest_restaurant_details' in distance_result and detail_level == DETAIL_FULL:
                 detail['restaurant_details'] = distance_result['nearest_restaurant_details']
                 
             return distance, detail
@@ -695,6 +929,8 @@ def process_food_delivery(delivery: Dict[str, Any], delivery_type: str="uber_eat
             }
             return distance, detail
     else:
+        if summary:
+            return 0, None
         distance = 0
         detail = {
             'distance': 0,
@@ -703,28 +939,426 @@ def process_food_delivery(delivery: Dict[str, Any], delivery_type: str="uber_eat
         }
         return distance, detail
 
-def calculate_emissions(data: Dict[str, Any]) -> Dict[str, Any]:
-    """Calculate emissions from various transportation activities"""
+def _parse_distance(distance: Union[str, int, float]) -> float:
+    """Handle string or numeric distance (unparseable strings count as 0)"""
+    if isinstance(distance, str):
+        try:
+            return float(distance)
+        except ValueError:
+            return 0
+    return distance
+
+def process_uber_ride(ride: Dict[str, Any], detail_level: str=DETAIL_FULL) -> Tuple[float, Optional[Dict[str, Any]]]:
+    """Process an Uber ride to calculate its distance and emissions"""
+    distance = _parse_distance(ride.get('distance', 0))
+    if detail_level == DETAIL_SUMMARY:
+        return distance, None
+    
+    time = ride.get('time', '0 minutes')
+    time_minutes = parse_time_string(time)
+    
+    return distance, {
+        'distance': distance,
+        'time_minutes': time_minutes,
+        'emissions': calculate_uber_emissions(distance)
+    }
+
+def process_lyft_ride(ride: Dict[str, Any], detail_level: str=DETAIL_FULL) -> Tuple[float, Optional[Dict[str, Any]]]:
+    """Process a Lyft ride to calculate its distance (estimated from time if needed) and emissions"""
+    estimated = False
+    # Check if distance is provided
+    if 'distance' in ride:
+        distance = _parse_distance(ride.get('distance', 0))
+    # If no distance but pickup/dropoff locations are available, calculate distance
+    elif 'pickup_location' in ride and 'dropoff_location' in ride and get_gmaps():
+        try:
+            distance_result = calculate_distance_between_addresses(
+                ride['pickup_location'],
+                ride['dropoff_location'],
+                get_gmaps()
+            )
+            if distance_result and distance_result['status'] == 'OK':
+                distance = distance_result['distance_exact']
+            else:
+                # If distance calculation failed, estimate based on time
+                time_minutes = parse_time_string(ride.get('time', 0))
+                # Assume average speed of 30 mph
+                distance = (time_minutes / 60) * 30
+                estimated = True
+        except Exception as e:
+            logging.error(f"Error calculating Lyft distance: {str(e)}")
+            # Estimate based on time
+            time_minutes = parse_time_string(ride.get('time', 0))
+            distance = (time_minutes / 60) * 30
+            estimated = True
+    else:
+        # Estimate based on time if available
+        time_minutes = parse_time_string(ride.get('time', 0))
+        # Assume average speed of 30 mph
+        distance = (time_minutes / 60) * 30
+        estimated = True
+    
+    if detail_level == DETAIL_SUMMARY:
+        return distance, None
+    
+    time_minutes = parse_time_string(ride.get('time', 0))
+    
+    # Add entry details
+    details = {
+        'distance': distance,
+        'time_minutes': time_minutes,
+        'emissions': calculate_lyft_emissions(distance)
+    }
+    if estimated:
+        details['distance_estimated'] = True
+    
+    # Add pickup/dropoff locations if available
+    if 'pickup_location' in ride:
+        details['pickup_location'] = ride['pickup_location']
+    if 'dropoff_location' in ride:
+        details['dropoff_location'] = ride['dropoff_location']
+    
+    return distance, details
+
+def process_flight(flight: Dict[str, Any], detail_level: str=DETAIL_FULL) -> Tuple[float, Optional[Dict[str, Any]]]:
+    """Process a flight (segments, airport pair or direct distance) to calculate distance and emissions"""
+    # Check if segments array is provided (primary format)
+    if 'segments' in flight and isinstance(flight['segments'], list):
+        total_segment_distance = 0
+        segment_details = []
+        
+        for segment in flight['segments']:
+            if 'origin' in segment and 'destination' in segment:
+                distance_result = calculate_flight_distance(
+                    segment['origin'],
+                    segment['destination']
+                )
+                
+                if distance_result and distance_result['status'] == 'OK':
+                    segment_distance = distance_result['distance_miles']
+                    segment_detail = {
+                        'distance': segment_distance,
+                        'emissions': calculate_flight_emissions(segment_distance),
+                        'origin': segment['origin'],
+                        'destination': segment['destination'],
+                        'origin_info': distance_result['origin_info'],
+                        'destination_info': distance_result['destination_info'],
+                        'status': 'OK'
+                    }
+                    request_log.detail("Flight segment %s to %s: %.2f miles",
+                                       segment['origin'], segment['destination'], segment_distance)
+                else:
+                    # Error in distance calculation
+                    segment_distance = 0
+                    segment_detail = {
+                        'distance': 0,
+                        'emissions': 0,
+                        'origin': segment.get('origin', 'Unknown'),
+                        'destination': segment.get('destination', 'Unknown'),
+                        'status': 'ERROR',
+                        'error': distance_result.get('error', 'Failed to calculate distance') if distance_result else 'Failed to calculate distance'
+                    }
+                
+                total_segment_distance += segment_distance
+                segment_details.append(segment_detail)
+                request_log.count('flight_segments')
+                if segment_detail['status'] != 'OK':
+                    request_log.count('flight_segment_errors')
+        
+        distance = total_segment_distance
+        detail = {
+            'distance': distance,
+            'emissions': calculate_flight_emissions(distance),
+            'segments': segment_details,
+            'segment_count': len(segment_details)
+        }
+        request_log.detail("Total flight distance across %d segments: %.2f miles", len(segment_details), distance)
+        
+    # Check if legacy airport_a/airport_b format is provided (convert to segments format)
+    elif 'airport_a' in flight and 'airport_b' in flight:
+        # Convert to segments format
+        origin = flight['airport_a']
+        destination = flight['airport_b']
+        
+        distance_result = calculate_flight_distance(origin, destination)
+        
+        if distance_result and distance_result['status'] == 'OK':
+            distance = distance_result['distance_miles']
+            segment_detail = {
+                'distance': distance,
+                'emissions': calculate_flight_emissions(distance),
+                'origin': origin,
+                'destination': destination,
+                'origin_info': distance_result['origin_info'],
+                'destination_info': distance_result['destination_info'],
+                'status': 'OK'
+            }
+            
+            detail = {
+                'distance': distance,
+                'emissions': calculate_flight_emissions(distance),
+                'segments': [segment_detail],
+                'segment_count': 1
+            }
+            request_log.detail("Flight from %s to %s: %.2f miles", origin, destination, distance)
+        else:
+            # Error in distance calculation
+            distance = 0
+            detail = {
+                'distance': 0,
+                'emissions': 0,
+                'segments': [],
+                'segment_count': 0,
+                'status': distance_result['status'] if distance_result else 'ERROR',
+                'error': distance_result.get('error', 'Unknown error') if distance_result else 'Failed to calculate distance'
+            }
+    # Check if distance is directly provided
+    elif 'distance' in flight:
+        distance = float(flight.get('distance', 0))
+        if detail_level == DETAIL_SUMMARY:
+            return distance, None
+        detail = {
+            'distance': distance,
+            'emissions': calculate_flight_emissions(distance),
+            'direct_distance': True,
+            'segments': [],
+            'segment_count': 0
+        }
+    else:
+        distance = 0
+        detail = {
+            'distance': 0,
+            'emissions': 0,
+            'error': 'No distance or flight information provided',
+            'segments': [],
+            'segment_count': 0
+        }
+    
+    return distance, trim_detail('flights', detail, detail_level)
+
+# Fields that determine an entry's computed detail, per category
+ENTRY_CACHE_FIELDS = {
+    'uber_rides': ('distance', 'time'),
+    'lyft': ('distance', 'time', 'pickup_location', 'dropoff_location'),
+    'uber_eats': ('distance', 'restaurant', 'delivery_address', 'ordered_from', 'address', 'error'),
+    'doordash': ('distance', 'restaurant', 'delivery_address', 'ordered_from', 'address', 'error'),
+    'flights': ('distance', 'segments', 'airport_a', 'airport_b'),
+}
+
+# Computed entry details, keyed by a hash of the entry's relevant fields and the
+# emission factors in effect, so recalculations only compute entries not seen before
+_entry_results = LookupCache(
+    maxsize=int(os.getenv('ENTRY_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('ENTRY_CACHE_TTL', 86400))
+)
+
+def emission_factor_version() -> Tuple[float, ...]:
+    """Return the emission factors currently in effect (part of every entry cache key)"""
+    return (UBER_EMISSION_FACTOR, LYFT_EMISSION_FACTOR, FOOD_DELIVERY_EMISSION_FACTOR, FLIGHT_EMISSION_FACTOR)
+
+def entry_cache_key(category: str, entry: Dict[str, Any]) -> str:
+    """Hash an entry's relevant fields together with its category and the emission factors"""
+    fields = {field: entry[field] for field in ENTRY_CACHE_FIELDS[category] if field in entry}
+    payload = json.dumps([category, emission_factor_version(), fields], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def canonical_value(value: Any) -> Any:
+    """Normalize a JSON value for hashing: integral floats become ints (5.0 -> 5)"""
+    if isinstance(value, dict):
+        return {str(key): canonical_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [canonical_value(item) for item in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def calculation_cache_key(data: Any, detail_level: str) -> str:
+    """Hash a whole calculation payload (canonicalized) with its detail level and the emission factors"""
+    payload = json.dumps([emission_factor_version(), detail_level, canonical_value(data)],
+                         sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _is_resolved(detail: Dict[str, Any]) -> bool:
+    return 'error' not in detail and detail.get('status', 'OK') == 'OK' and not detail.get('distance_estimated')
+
+def _is_cacheable(detail: Dict[str, Any]) -> bool:
+    """Only fully resolved details are cached (every flight segment included); failures are left to the lookup cache"""
+    return _is_resolved(detail) and all(_is_resolved(segment) for segment in detail.get('segments') or ())
+
+ENTRY_PROCESSORS = {
+    'uber_rides': process_uber_ride,
+    'lyft': process_lyft_ride,
+    'uber_eats': lambda delivery, detail_level=DETAIL_FULL: process_food_delivery(delivery, "uber_eats", detail_level),
+    'doordash': lambda delivery, detail_level=DETAIL_FULL: process_food_delivery(delivery, "doordash", detail_level),
+    'flights': process_flight,
+}
+
+# Metadata left out of entry details below DETAIL_FULL
+RESTAURANT_METADATA_FIELDS = ('restaurant_details',)
+AIRPORT_METADATA_FIELDS = ('origin_info', 'destination_info')
+
+def trim_detail(category: str, detail: Dict[str, Any], detail_level: str) -> Optional[Dict[str, Any]]:
+    """Reduce a full entry detail to the requested detail level (returns a copy when trimming)"""
+    if detail_level == DETAIL_FULL:
+        return detail
+    if detail_level == DETAIL_SUMMARY:
+        return None
+    
+    if category == 'flights' and detail.get('segments'):
+        trimmed = dict(detail)
+        trimmed['segments'] = [
+            {k: v for k, v in segment.items() if k not in AIRPORT_METADATA_FIELDS}
+            for segment in detail['segments']
+        ]
+        return trimmed
+    if category in ('uber_eats', 'doordash') and 'restaurant_details' in detail:
+        return {k: v for k, v in detail.items() if k not in RESTAURANT_METADATA_FIELDS}
+    return detail
+
+def trim_results(results: Dict[str, Any], detail_level: str) -> Dict[str, Any]:
+    """Reduce full calculate_emissions results to the requested detail level (returns a copy when trimming)"""
+    if detail_level == DETAIL_FULL or 'entry_details' not in results:
+        return results
+    if detail_level == DETAIL_SUMMARY:
+        return {k: v for k, v in results.items() if k != 'entry_details'}
+    
+    trimmed = dict(results)
+    trimmed['entry_details'] = {
+        category: [trim_detail(category, detail, detail_level) if isinstance(detail, dict) else detail
+                   for detail in details]
+        for category, details in results['entry_details'].items()
+    }
+    return trimmed
+
+def _needs_lookup(category: str, entry: Dict[str, Any]) -> bool:
+    """Whether computing an entry calls an external API (only those are worth caching in summary mode)"""
+    if category == 'uber_rides':
+        return False
+    if category == 'lyft':
+        return 'distance' not in entry and 'pickup_location' in entry and 'dropoff_location' in entry
+    if category in ('uber_eats', 'doordash'):
+        return 'error' not in entry and 'distance' not in entry
+    return isinstance(entry.get('segments'), list) or ('airport_a' in entry and 'airport_b' in entry)
+
+def process_entry(category: str, entry: Dict[str, Any],
+                  detail_level: str=DETAIL_FULL) -> Tuple[float, Optional[Dict[str, Any]]]:
+    """Process one entry of a category, reusing the cached detail for entries seen before"""
+    processor = ENTRY_PROCESSORS[category]
+    if not isinstance(entry, dict) or not entry:
+        return processor(entry, detail_level)
+    if detail_level == DETAIL_SUMMARY and not _needs_lookup(category, entry):
+        # Cheap entries: compute the distance only, without hashing or building a detail
+        return processor(entry, DETAIL_SUMMARY)
+    
+    key = entry_cache_key(category, entry)
+    hit, detail = _entry_results.get(key)
+    count_cache('entry', hit)
+    if hit:
+        return detail['distance'], trim_detail(category, detail, detail_level)
+    
+    # Cache the full detail so any detail level can be served from it later
+    distance, detail = processor(entry)
+    if _is_cacheable(detail):
+        _entry_results.set(key, detail, OUTCOME_OK)
+    else:
+        note_unresolved()
+    return distance, trim_detail(category, detail, detail_level)
+
+# Date formats seen in receipts (process_email_info lowercases the snippet it reads dates from)
+RECEIPT_DATE_FORMATS = (
+    '%b %d, %Y', '%B %d, %Y', '%d %b %Y', '%d %B %Y', '%b %d %Y', '%B %d %Y',
+    '%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y'
+)
+
+@lru_cache(maxsize=4096)
+def parse_receipt_date(date_str: str) -> Optional[date]:
+    """Parse a receipt date string, returning None if it is not recognised"""
+    text = ' '.join(date_str.replace('.', ' ').split())
+    if 'T' in text and text[:4].isdigit():
+        text = text.split('T')[0]  # ISO timestamp
+    for date_format in RECEIPT_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date()
+        except ValueError:
+            continue
+    return None
+
+def _rollup_buckets(entry_date: date) -> Tuple[Tuple[str, str], ...]:
+    """Return the (granularity, bucket key) pairs a date falls into"""
+    iso_year, iso_week, _ = entry_date.isocalendar()
+    return (
+        ('day', entry_date.isoformat()),
+        ('week', f"{iso_year}-W{iso_week:02d}"),
+        ('month', entry_date.strftime('%Y-%m')),
+    )
+
+def _add_to_rollups(rollups: Dict[str, Any], entry: Any, category: str, distance: float, emissions: float):
+    """Add one entry's distance and emissions to the day/week/month buckets of its receipt date"""
+    date_str = entry.get('date') if isinstance(entry, dict) else None
+    entry_date = parse_receipt_date(date_str) if isinstance(date_str, str) else None
+    if entry_date is None:
+        rollups['undated_entries'] += 1
+        return
+    
+    for granularity, key in _rollup_buckets(entry_date):
+        bucket = rollups[granularity].get(key)
+        if bucket is None:
+            bucket = rollups[granularity][key] = {'total_emissions': 0}
+        totals = bucket.get(category)
+        if totals is None:
+            totals = bucket[category] = {'distance': 0, 'emissions': 0, 'count': 0}
+        totals['distance'] += distance
+        totals['emissions'] += emissions
+        totals['count'] += 1
+        bucket['total_emissions'] += emissions
+
+def calculate_emissions(data: Dict[str, Any], detail_level: str=DETAIL_FULL,
+                        stats: Optional[Dict[str, int]]=None) -> Dict[str, Any]:
+    """Calculate emissions from various transportation activities
+    
+    detail_level controls entry_details: DETAIL_SUMMARY leaves it out entirely,
+    DETAIL_ENTRY keeps per-entry figures without restaurant/airport metadata.
+    When entries carry a receipt 'date', per-day/week/month rollups per category
+    are added under 'rollups'. If stats is given it receives the number of
+    entries that could not be fully resolved as 'unresolved'.
+    """
+    if detail_level not in DETAIL_LEVELS:
+        raise ValueError(f"Unknown detail_level '{detail_level}', expected one of {', '.join(DETAIL_LEVELS)}")
+    
+    # Repeated lookups within one calculation are resolved once; candidate and
+    # segment logs are sampled and summarized in one record per calculation
+    with log_scope(), lookup_scope() as scope:
+        # An enclosing scope (e.g. a batch) counts across calculations, report only this one
+        unresolved = scope['unresolved']
+        results = _calculate_emissions(data, detail_level)
+        if stats is not None:
+            stats['unresolved'] = scope['unresolved'] - unresolved
+        return results
+
+def _calculate_emissions(data: Dict[str, Any], detail_level: str=DETAIL_FULL) -> Dict[str, Any]:
+    """Calculate emissions from various transportation activities (inside a lookup scope)"""
     # Initialize results dictionary
-    results = {
-        'entry_details': {
+    results = {}
+    rollups = {'day': {}, 'week': {}, 'month': {}, 'undated_entries': 0}
+    entry_details = None
+    if detail_level != DETAIL_SUMMARY:
+        entry_details = results['entry_details'] = {
             'uber_rides': [],
             'lyft': [],
             'uber_eats': [],
             'doordash': [],
             'flights': []
         }
-    }
     
     # Check for direct entries via quickstart.py format (entries with 'type' field)
     if isinstance(data, list) and len(data) > 0 and 'type' in data[0]:
         # List of entries in quickstart.py format
         processed_data = process_quickstart_data(data)
-        return calculate_emissions(processed_data)
+        return calculate_emissions(processed_data, detail_level)
     elif 'type' in data:
         # Single entry in quickstart.py format
         processed_data = process_quickstart_data([data])
-        return calculate_emissions(processed_data)
+        return calculate_emissions(processed_data, detail_level)
     
     # Process Uber rides
     uber_total_distance = 0
@@ -733,27 +1367,15 @@ def calculate_emissions(data: Dict[str, Any]) -> Dict[str, Any]:
         uber_rides = data['uber_rides'] if isinstance(data['uber_rides'], list) else [data['uber_rides']]
         for ride in uber_rides:
             if ride:  # Skip empty entries
-                # Handle string or numeric distance
-                distance = ride.get('distance', 0)
-                if isinstance(distance, str):
-                    try:
-                        distance = float(distance)
-                    except ValueError:
-                        distance = 0
-                
-                time = ride.get('time', '0 minutes')
-                time_minutes = parse_time_string(time)
-                
-                emissions = calculate_uber_emissions(distance)
+                distance, detail = process_entry('uber_rides', ride, detail_level)
+                emissions = detail['emissions'] if detail is not None else calculate_uber_emissions(distance)
                 uber_total_distance += distance
                 uber_total_emissions += emissions
+                _add_to_rollups(rollups, ride, 'uber_rides', distance, emissions)
                 
                 # Add entry details
-                results['entry_details']['uber_rides'].append({
-                    'distance': distance,
-                    'time_minutes': time_minutes,
-                    'emissions': emissions
-                })
+                if entry_details is not None:
+                    entry_details['uber_rides'].append(detail)
         
         results['uber_distance'] = uber_total_distance
         results['uber_emissions'] = uber_total_emissions
@@ -765,60 +1387,15 @@ def calculate_emissions(data: Dict[str, Any]) -> Dict[str, Any]:
         lyft_rides = data['lyft'] if isinstance(data['lyft'], list) else [data['lyft']]
         for ride in lyft_rides:
             if ride:  # Skip empty entries
-                # Check if distance is provided
-                if 'distance' in ride:
-                    distance = ride.get('distance', 0)
-                    if isinstance(distance, str):
-                        try:
-                            distance = float(distance)
-                        except ValueError:
-                            distance = 0
-                # If no distance but pickup/dropoff locations are available, calculate distance
-                elif 'pickup_location' in ride and 'dropoff_location' in ride and gmaps:
-                    try:
-                        distance_result = calculate_distance_between_addresses(
-                            ride['pickup_location'],
-                            ride['dropoff_location'],
-                            gmaps
-                        )
-                        if distance_result and distance_result['status'] == 'OK':
-                            distance = distance_result['distance_exact']
-                        else:
-                            # If distance calculation failed, estimate based on time
-                            time_minutes = parse_time_string(ride.get('time', 0))
-                            # Assume average speed of 30 mph
-                            distance = (time_minutes / 60) * 30
-                    except Exception as e:
-                        logging.error(f"Error calculating Lyft distance: {str(e)}")
-                        # Estimate based on time
-                        time_minutes = parse_time_string(ride.get('time', 0))
-                        distance = (time_minutes / 60) * 30
-                else:
-                    # Estimate based on time if available
-                    time_minutes = parse_time_string(ride.get('time', 0))
-                    # Assume average speed of 30 mph
-                    distance = (time_minutes / 60) * 30
-                
-                time_minutes = parse_time_string(ride.get('time', 0))
-                
-                emissions = calculate_lyft_emissions(distance)
+                distance, detail = process_entry('lyft', ride, detail_level)
+                emissions = detail['emissions'] if detail is not None else calculate_lyft_emissions(distance)
                 lyft_total_distance += distance
                 lyft_total_emissions += emissions
+                _add_to_rollups(rollups, ride, 'lyft', distance, emissions)
                 
                 # Add entry details
-                details = {
-                    'distance': distance,
-                    'time_minutes': time_minutes,
-                    'emissions': emissions
-                }
-                
-                # Add pickup/dropoff locations if available
-                if 'pickup_location' in ride:
-                    details['pickup_location'] = ride['pickup_location']
-                if 'dropoff_location' in ride:
-                    details['dropoff_location'] = ride['dropoff_location']
-                
-                results['entry_details']['lyft'].append(details)
+                if entry_details is not None:
+                    entry_details['lyft'].append(detail)
         
         results['lyft_distance'] = lyft_total_distance
         results['lyft_emissions'] = lyft_total_emissions
@@ -829,12 +1406,15 @@ def calculate_emissions(data: Dict[str, Any]) -> Dict[str, Any]:
     if 'uber_eats' in data and data['uber_eats']:
         uber_eats_deliveries = data['uber_eats'] if isinstance(data['uber_eats'], list) else [data['uber_eats']]
         for delivery in uber_eats_deliveries:
-            distance, detail = process_food_delivery(delivery, "uber_eats")
+            distance, detail = process_entry('uber_eats', delivery, detail_level)
+            emissions = detail['emissions'] if detail is not None else calculate_food_delivery_emissions(distance)
             uber_eats_total_distance += distance
-            uber_eats_total_emissions += detail['emissions']
+            uber_eats_total_emissions += emissions
+            _add_to_rollups(rollups, delivery, 'uber_eats', distance, emissions)
             
             # Add entry details
-            results['entry_details']['uber_eats'].append(detail)
+            if entry_details is not None:
+                entry_details['uber_eats'].append(detail)
         
         results['uber_eats_distance'] = uber_eats_total_distance
         results['uber_eats_emissions'] = uber_eats_total_emissions
@@ -845,12 +1425,15 @@ def calculate_emissions(data: Dict[str, Any]) -> Dict[str, Any]:
     if 'doordash' in data and data['doordash']:
         doordash_deliveries = data['doordash'] if isinstance(data['doordash'], list) else [data['doordash']]
         for delivery in doordash_deliveries:
-            distance, detail = process_food_delivery(delivery, "doordash")
+            distance, detail = process_entry('doordash', delivery, detail_level)
+            emissions = detail['emissions'] if detail is not None else calculate_food_delivery_emissions(distance)
             doordash_total_distance += distance
-            doordash_total_emissions += detail['emissions']
+            doordash_total_emissions += emissions
+            _add_to_rollups(rollups, delivery, 'doordash', distance, emissions)
             
             # Add entry details
-            results['entry_details']['doordash'].append(detail)
+            if entry_details is not None:
+                entry_details['doordash'].append(detail)
         
         results['doordash_distance'] = doordash_total_distance
         results['doordash_emissions'] = doordash_total_emissions
@@ -863,122 +1446,21 @@ def calculate_emissions(data: Dict[str, Any]) -> Dict[str, Any]:
         for flight in flights:
             if not flight:  # Skip empty entries
                 continue
-                
-            # Check if segments array is provided (primary format)
-            if 'segments' in flight and isinstance(flight['segments'], list):
-                total_segment_distance = 0
-                segment_details = []
-                
-                for segment in flight['segments']:
-                    if 'origin' in segment and 'destination' in segment:
-                        distance_result = calculate_flight_distance(
-                            segment['origin'],
-                            segment['destination']
-                        )
-                        
-                        if distance_result and distance_result['status'] == 'OK':
-                            segment_distance = distance_result['distance_miles']
-                            segment_detail = {
-                                'distance': segment_distance,
-                                'emissions': calculate_flight_emissions(segment_distance),
-                                'origin': segment['origin'],
-                                'destination': segment['destination'],
-                                'origin_info': distance_result['origin_info'],
-                                'destination_info': distance_result['destination_info'],
-                                'status': 'OK'
-                            }
-                            logging.info(f"Flight segment {segment['origin']} to {segment['destination']}: {segment_distance:.2f} miles")
-                        else:
-                            # Error in distance calculation
-                            segment_distance = 0
-                            segment_detail = {
-                                'distance': 0,
-                                'emissions': 0,
-                                'origin': segment.get('origin', 'Unknown'),
-                                'destination': segment.get('destination', 'Unknown'),
-                                'status': 'ERROR',
-                                'error': distance_result.get('error', 'Failed to calculate distance') if distance_result else 'Failed to calculate distance'
-                            }
-                        
-                        total_segment_distance += segment_distance
-                        segment_details.append(segment_detail)
-                
-                distance = total_segment_distance
-                detail = {
-                    'distance': distance,
-                    'emissions': calculate_flight_emissions(distance),
-                    'segments': segment_details,
-                    'segment_count': len(segment_details)
-                }
-                logging.info(f"Total flight distance across {len(segment_details)} segments: {distance:.2f} miles")
-                
-            # Check if legacy airport_a/airport_b format is provided (convert to segments format)
-            elif 'airport_a' in flight and 'airport_b' in flight:
-                # Convert to segments format
-                origin = flight['airport_a']
-                destination = flight['airport_b']
-                
-                distance_result = calculate_flight_distance(origin, destination)
-                
-                if distance_result and distance_result['status'] == 'OK':
-                    distance = distance_result['distance_miles']
-                    segment_detail = {
-                        'distance': distance,
-                        'emissions': calculate_flight_emissions(distance),
-                        'origin': origin,
-                        'destination': destination,
-                        'origin_info': distance_result['origin_info'],
-                        'destination_info': distance_result['destination_info'],
-                        'status': 'OK'
-                    }
-                    
-                    detail = {
-                        'distance': distance,
-                        'emissions': calculate_flight_emissions(distance),
-                        'segments': [segment_detail],
-                        'segment_count': 1
-                    }
-                    logging.info(f"Flight from {origin} to {destination}: {distance:.2f} miles")
-                else:
-                    # Error in distance calculation
-                    distance = 0
-                    detail = {
-                        'distance': 0,
-                        'emissions': 0,
-                        'segments': [],
-                        'segment_count': 0,
-                        'status': distance_result['status'] if distance_result else 'ERROR',
-                        'error': distance_result.get('error', 'Unknown error') if distance_result else 'Failed to calculate distance'
-                    }
-            # Check if distance is directly provided
-            elif 'distance' in flight:
-                distance = float(flight.get('distance', 0))
-                detail = {
-                    'distance': distance,
-                    'emissions': calculate_flight_emissions(distance),
-                    'direct_distance': True,
-                    'segments': [],
-                    'segment_count': 0
-                }
-            else:
-                distance = 0
-                detail = {
-                    'distance': 0,
-                    'emissions': 0,
-                    'error': 'No distance or flight information provided',
-                    'segments': [],
-                    'segment_count': 0
-                }
-                
+            
+            distance, detail = process_entry('flights', flight, detail_level)
+            emissions = calculate_flight_emissions(distance)
             flight_total_distance += distance
-            flight_total_emissions += calculate_flight_emissions(distance)
+            flight_total_emissions += emissions
+            _add_to_rollups(rollups, flight, 'flights', distance, emissions)
             
             # Add entry details
-            results['entry_details']['flights'].append(detail)
+            if entry_details is not None:
+                entry_details['flights'].append(detail)
         
         results['flight_distance'] = flight_total_distance
         results['flight_emissions'] = flight_total_emissions
     
+    
     # Calculate total emissions from all categories
     total_emissions = (
         uber_total_emissions + 
@@ -993,6 +1475,10 @@ def calculate_emissions(data: Dict[str, Any]) -> Dict[str, Any]:
     results['trees_needed'] = calculate_trees_needed(total_emissions)
     results['london_ny_percentage'] = calculate_london_ny_comparison(total_emissions)
     
+    # Precomputed trend data, only when some entries carried a receipt date
+    if rollups['day']:
+        results['rollups'] = rollups
+    
     return results
 
 def process_quickstart_data(entries: List[Dict[str, Any]]) -> Dict[str, Any]:
@@ -1010,37 +1496,47 @@ def process_quickstart_data(entries: List[Dict[str, Any]]) -> Dict[str, Any]:
         entry_type = entry.get('type', '').lower()
         
         if entry_type == 'uber ride':
-            processed_data['uber_rides'].append({
+            category = 'uber_rides'
+            processed_entry = {
                 'distance': entry.get('distance', 0),
                 'time': entry.get('time', 0)
-            })
+            }
         elif entry_type == 'lyft ride':
-            lyft_entry = {
+            category = 'lyft'
+            processed_entry = {
                 'time': entry.get('time', 0)
             }
             
             # Add optional fields if available
             if 'pickup_location' in entry:
-                lyft_entry['pickup_location'] = entry['pickup_location']
+                processed_entry['pickup_location'] = entry['pickup_location']
             if 'dropoff_location' in entry:
-                lyft_entry['dropoff_location'] = entry['dropoff_location']
+                processed_entry['dropoff_location'] = entry['dropoff_location']
             if 'distance' in entry:
-                lyft_entry['distance'] = entry['distance']
-                
-            processed_data['lyft'].append(lyft_entry)
+                processed_entry['distance'] = entry['distance']
         elif entry_type == 'uber eats':
-            processed_data['uber_eats'].append({
+            category = 'uber_eats'
+            processed_entry = {
                 'restaurant': entry.get('restaurant', ''),
                 'delivery_address': entry.get('delivery_address', '')
-            })
+            }
         elif entry_type == 'door dash order':
-            processed_data['doordash'].append({
+            category = 'doordash'
+            processed_entry = {
                 'restaurant': entry.get('restaurant', ''),
                 'delivery_address': entry.get('delivery_address', '')
-            })
+            }
         elif entry_type == 'flight':
             # Pass through as is, maintaining segments format
             processed_data['flights'].append(entry)
+            continue
+        else:
+            continue
+        
+        # Keep the receipt date for time-bucketed rollups
+        if entry.get('date'):
+            processed_entry['date'] = entry['date']
+        processed_data[category].append(processed_entry)
     
     return processed_data
 
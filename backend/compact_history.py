@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Compact data/calculations_history.jsonl: roll entries from finished periods into
+compressed segments under data/history_segments/ (see history_segments.py).
+
+Safe to run while the app is serving requests; appends wait for the rotation.
+The app also compacts in the background every HISTORY_COMPACT_INTERVAL seconds.
+
+Usage: python compact_history.py [--history FILE] [--period day|week|month] [--codec zstd|gzip]
+"""
+import argparse
+import os
+import sys
+
+from dotenv import load_dotenv
+
+from history_segments import CODEC_EXTENSIONS, compact_log, DEFAULT_CODEC, read_index, SEGMENT_PERIODS
+
+DEFAULT_HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'calculations_history.jsonl')
+
+def main():
+    # HISTORY_SEGMENT_PERIOD and HISTORY_SEGMENT_CODEC usually live in .env
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Roll calculation history into compressed time-based segments")
+    parser.add_argument('--history', default=DEFAULT_HISTORY, help="active JSONL history log")
+    parser.add_argument('--period', choices=SEGMENT_PERIODS, default=os.getenv('HISTORY_SEGMENT_PERIOD', 'month'))
+    parser.add_argument('--codec', choices=tuple(CODEC_EXTENSIONS), default=os.getenv('HISTORY_SEGMENT_CODEC', DEFAULT_CODEC))
+    args = parser.parse_args()
+
+    if not os.path.exists(args.history):
+        print(f"No history log at {args.history}")
+        return 1
+
+    size_before = os.path.getsize(args.history)
+    segments = compact_log(args.history, args.period, args.codec)
+    for segment in segments:
+        print(f"{segment['file']}: {segment['count']} entries ({segment['first_id']}-{segment['last_id']}), "
+              f"{segment['payloads']} unique payloads, {segment['bytes']} bytes")
+
+    sealed = read_index(args.history)['segments']
+    print(f"Active log: {os.path.getsize(args.history)} bytes (was {size_before}), "
+          f"{len(sealed)} segments holding {sum(segment['count'] for segment in sealed)} entries")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+Negotiated gzip/brotli compression of JSON and HTML responses.
+
+compress_response() picks the best encoding the client accepts (brotli when
+the brotli package is installed, else gzip) and compresses:
+
+    buffered responses  when the body is at least COMPRESS_MIN_SIZE bytes
+    streamed responses  chunk by chunk, flushing after each chunk so NDJSON
+                        lines still reach the client as they are produced
+
+COMPRESS_LEVEL is the gzip level (1-9, 0 turns compression off) and
+COMPRESS_BROTLI_LEVEL the brotli quality (0-11). Strong ETags are weakened,
+since the compressed bytes differ per encoding; weak ETags are kept as is.
+"""
+import logging
+import os
+import zlib
+from typing import Iterable, Iterator, Optional
+
+logger = logging.getLogger('carbon_emissions')
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+    logger.warning("brotli library not installed. Responses will be compressed with gzip only.")
+
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))
+COMPRESS_BROTLI_LEVEL = int(os.getenv('COMPRESS_BROTLI_LEVEL', 5))
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/html'}
+
+# Preferred first when the client weighs encodings equally
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+# wbits for zlib to write a gzip header and trailer
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+def choose_encoding(accept_encodings) -> Optional[str]:
+    """Best supported encoding from a parsed Accept-Encoding header (None for identity)"""
+    return accept_encodings.best_match(ENCODINGS) if COMPRESS_LEVEL > 0 else None
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compress a whole body"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=COMPRESS_BROTLI_LEVEL)
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def compress_stream(chunks: Iterable, encoding: str) -> Iterator[bytes]:
+    """Compress a streamed body, flushing after every chunk"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESS_BROTLI_LEVEL)
+        compress_chunk = lambda chunk: compressor.process(chunk) + compressor.flush()
+        finish = compressor.finish
+    else:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, _GZIP_WBITS)
+        compress_chunk = lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        if chunk:
+            yield compress_chunk(chunk)
+    yield finish()
+
+def compress_response(response, accept_encodings):
+    """Compress a Flask/Werkzeug response in place if it and the client qualify"""
+    if (response.mimetype not in COMPRESSIBLE_MIMETYPES or response.direct_passthrough
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    # Caches must keep the compressed and uncompressed variants apart
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        chunks = response.response
+        response.response = compress_stream(chunks, encoding)
+        response.headers.pop('Content-Length', None)
+        if hasattr(chunks, 'close'):
+            # The wrapper is what the server closes; the wrapped iterable needs closing too
+            # (stream_with_context releases the request context there)
+            response.call_on_close(chunks.close)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Export calculation history as flat columnar tables for analysis:
+
+    calculations.<ext>      one row per calculation (totals per category)
+    entries.<ext>           one row per entry detail (ride, delivery, flight)
+    flight_segments.<ext>   one row per flight segment, with airport coordinates
+
+History is streamed from the configured store (or a legacy JSON array with
+--source) and written in chunks of --chunk-size calculations, so memory stays
+bounded by one chunk. Tables are written as Parquet (row group per chunk) or
+Feather when pyarrow is installed. Feather needs pyarrow too, so without it the
+export falls back to gzip-compressed CSV appended chunk by chunk.
+
+Usage: python export_history.py [--format auto|parquet|feather|csv] [--output-dir DIR] [--source FILE]
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List
+
+import pandas as pd
+from dotenv import load_dotenv
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from history import open_history_store
+from migrate_history import JsonArrayReader
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+CHUNK_SIZE = 5000
+
+CATEGORIES = ('uber_rides', 'lyft', 'uber_eats', 'doordash', 'flights')
+
+# Result key prefix of each category's distance/emissions totals
+RESULT_PREFIXES = {
+    'uber_rides': 'uber', 'lyft': 'lyft', 'uber_eats': 'uber_eats',
+    'doordash': 'doordash', 'flights': 'flight',
+}
+
+CALCULATION_COLUMNS = {
+    'calculation_id': 'Int64',
+    'timestamp': 'datetime64[ns]',
+    'user': 'string',
+    'total_emissions': 'float64',
+    'trees_needed': 'Int64',
+    'london_ny_percentage': 'float64',
+    **{f"{prefix}_{measure}": 'float64' for prefix in RESULT_PREFIXES.values() for measure in ('distance', 'emissions')},
+    **{f"{category}_count": 'Int64' for category in CATEGORIES},
+}
+
+ENTRY_COLUMNS = {
+    'calculation_id': 'Int64',
+    'timestamp': 'datetime64[ns]',
+    'category': 'string',
+    'entry_index': 'Int64',
+    'date': 'string',
+    'distance': 'float64',
+    'emissions': 'float64',
+    'time_minutes': 'float64',
+    'distance_estimated': 'boolean',
+    'status': 'string',
+    'error': 'string',
+    'origin': 'string',
+    'origin_address': 'string',
+    'destination': 'string',
+    'duration': 'string',
+    'found_name': 'string',
+    'restaurant_place_id': 'string',
+    'restaurant_lat': 'float64',
+    'restaurant_lng': 'float64',
+    'delivery_lat': 'float64',
+    'delivery_lng': 'float64',
+    'straight_line_distance': 'float64',
+    'segment_count': 'Int64',
+}
+
+FLIGHT_SEGMENT_COLUMNS = {
+    'calculation_id': 'Int64',
+    'timestamp': 'datetime64[ns]',
+    'entry_index': 'Int64',
+    'segment_index': 'Int64',
+    'origin': 'string',
+    'destination': 'string',
+    'origin_lat': 'float64',
+    'origin_lng': 'float64',
+    'destination_lat': 'float64',
+    'destination_lng': 'float64',
+    'distance': 'float64',
+    'emissions': 'float64',
+    'status': 'string',
+}
+
+TABLES = {
+    'calculations': CALCULATION_COLUMNS,
+    'entries': ENTRY_COLUMNS,
+    'flight_segments': FLIGHT_SEGMENT_COLUMNS,
+}
+
+RESTAURANT_FIELDS = ('found_name', 'restaurant_place_id', 'restaurant_lat', 'restaurant_lng',
+                     'delivery_lat', 'delivery_lng', 'straight_line_distance')
+
+def _segment_row(calculation_id, timestamp, entry_index, segment_index, segment) -> Dict[str, Any]:
+    origin_info = segment.get('origin_info') or {}
+    destination_info = segment.get('destination_info') or {}
+    return {
+        'calculation_id': calculation_id,
+        'timestamp': timestamp,
+        'entry_index': entry_index,
+        'segment_index': segment_index,
+        'origin': segment.get('origin') or origin_info.get('code'),
+        'destination': segment.get('destination') or destination_info.get('code'),
+        'origin_lat': origin_info.get('lat'),
+        'origin_lng': origin_info.get('lng'),
+        'destination_lat': destination_info.get('lat'),
+        'destination_lng': destination_info.get('lng'),
+        'distance': segment.get('distance'),
+        'emissions': segment.get('emissions'),
+        'status': segment.get('status'),
+    }
+
+def flatten_entry(position: int, entry: Dict[str, Any], rows: Dict[str, List[Dict[str, Any]]]):
+    """Append the table rows of one history entry to rows"""
+    calculation_id = entry.get('id', position)
+    timestamp = datetime.fromisoformat(entry['timestamp']) if entry.get('timestamp') else None
+    results = entry.get('results') or {}
+    details = results.get('entry_details') or {}
+
+    calculation = {
+        'calculation_id': calculation_id,
+        'timestamp': timestamp,
+        'user': entry.get('user'),
+        'total_emissions': results.get('total_emissions'),
+        'trees_needed': results.get('trees_needed'),
+        'london_ny_percentage': results.get('london_ny_percentage'),
+    }
+    for category, prefix in RESULT_PREFIXES.items():
+        calculation[f"{prefix}_distance"] = results.get(f"{prefix}_distance")
+        calculation[f"{prefix}_emissions"] = results.get(f"{prefix}_emissions")
+        calculation[f"{category}_count"] = len(details.get(category) or []) if details else None
+    rows['calculations'].append(calculation)
+
+    for category in CATEGORIES:
+        for entry_index, detail in enumerate(details.get(category) or []):
+            if not isinstance(detail, dict):
+                continue
+            row = {column: detail.get(column) for column in ENTRY_COLUMNS if column in detail}
+            restaurant = detail.get('restaurant_details') or {}
+            row.update({field: restaurant.get(field) for field in RESTAURANT_FIELDS if field in restaurant})
+            row.update(calculation_id=calculation_id, timestamp=timestamp, category=category, entry_index=entry_index)
+            rows['entries'].append(row)
+
+            if category != 'flights':
+                continue
+            segments = detail.get('segments')
+            if not segments and 'origin_info' in detail and 'destination_info' in detail:
+                # Older single-leg flights keep the airports on the flight itself
+                segments = [detail]
+            for segment_index, segment in enumerate(segments or []):
+                rows['flight_segments'].append(_segment_row(calculation_id, timestamp, entry_index, segment_index, segment))
+
+def to_frame(rows: List[Dict[str, Any]], columns: Dict[str, str]) -> pd.DataFrame:
+    """Build a chunk frame with the table's fixed column order and dtypes"""
+    frame = pd.DataFrame.from_records(rows, columns=list(columns))
+    return frame.astype(columns)
+
+class ParquetWriter:
+    extension = '.parquet'
+
+    def __init__(self, path: str):
+        self.path = path
+        self._writer = None
+
+    def write(self, frame: pd.DataFrame):
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, table.schema, compression='zstd')
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+class FeatherWriter:
+    extension = '.feather'
+
+    def __init__(self, path: str):
+        self.path = path
+        self._writer = None
+
+    def write(self, frame: pd.DataFrame):
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        if self._writer is None:
+            options = pa.ipc.IpcWriteOptions(compression='zstd')
+            self._writer = pa.ipc.new_file(self.path, table.schema, options=options)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+class CsvWriter:
+    extension = '.csv.gz'
+
+    def __init__(self, path: str):
+        self.path = path
+        self._header = True
+
+    def write(self, frame: pd.DataFrame):
+        # Each chunk is its own gzip member; readers see one continuous file
+        frame.to_csv(self.path, mode='w' if self._header else 'a', header=self._header,
+                     index=False, compression='gzip')
+        self._header = False
+
+    def close(self):
+        pass
+
+WRITERS = {'parquet': ParquetWriter, 'feather': FeatherWriter, 'csv': CsvWriter}
+
+def resolve_format(name: str) -> str:
+    if name == 'auto':
+        return 'parquet' if pa is not None else 'csv'
+    if name in ('parquet', 'feather') and pa is None:
+        raise ValueError(f"{name} export needs pyarrow (pip install pyarrow), or use --format csv")
+    return name
+
+def export(entries: Iterable[Dict[str, Any]], output_dir: str, file_format: str = 'auto',
+           chunk_size: int = CHUNK_SIZE) -> Dict[str, Dict[str, Any]]:
+    """Write the history tables chunk by chunk; returns rows and path per table"""
+    file_format = resolve_format(file_format)
+    writer_class = WRITERS[file_format]
+    os.makedirs(output_dir, exist_ok=True)
+    writers = {name: writer_class(os.path.join(output_dir, name + writer_class.extension)) for name in TABLES}
+    counts = {name: 0 for name in TABLES}
+
+    def flush(rows):
+        for name, columns in TABLES.items():
+            # Always write the first chunk, so empty tables still get a schema
+            if rows[name] or counts[name] == 0:
+                writers[name].write(to_frame(rows[name], columns))
+                counts[name] += len(rows[name])
+            rows[name].clear()
+
+    rows: Dict[str, List[Dict[str, Any]]] = {name: [] for name in TABLES}
+    pending = 0
+    try:
+        for position, entry in enumerate(entries, 1):
+            flatten_entry(position, entry, rows)
+            pending += 1
+            if pending == chunk_size:
+                flush(rows)
+                pending = 0
+        flush(rows)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return {name: {'rows': counts[name], 'path': writers[name].path} for name in TABLES}
+
+def legacy_entries(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path, 'rb') as f:
+        for _, entry in JsonArrayReader(f):
+            yield entry
+
+def main():
+    # HISTORY_BACKEND and HISTORY_DB usually live in .env
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Export calculation history as columnar tables")
+    parser.add_argument('--format', choices=('auto', *WRITERS), default='auto')
+    parser.add_argument('--output-dir', default=os.path.join(DATA_DIR, 'export'))
+    parser.add_argument('--source', help="legacy calculations_history.json to export instead of the history store")
+    parser.add_argument('--backend', default=os.getenv('HISTORY_BACKEND', 'jsonl'), choices=('jsonl', 'sqlite'))
+    parser.add_argument('--data-dir', default=DATA_DIR, help="directory of the history store")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="calculations per written chunk")
+    args = parser.parse_args()
+
+    try:
+        file_format = resolve_format(args.format)
+    except ValueError as e:
+        print(str(e))
+        return 1
+    if args.format == 'auto' and file_format == 'csv':
+        print("pyarrow is not installed, writing gzip-compressed CSV instead of Parquet")
+
+    entries = legacy_entries(args.source) if args.source else open_history_store(args.backend, args.data_dir).iter_entries()
+    start = time.perf_counter()
+    tables = export(entries, args.output_dir, file_format, args.chunk_size)
+    elapsed = time.perf_counter() - start
+
+    for name, table in tables.items():
+        print(f"{name}: {table['rows']} rows, {os.path.getsize(table['path'])} bytes -> {table['path']}")
+    print(f"Exported in {elapsed:.2f}s")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,2 +1,28 @@
+import os
+
 bind = "0.0.0.0:8080"
 workers = 2
+# Threads let a worker queue and refuse requests itself (see admission.py)
+# instead of leaving them in the listen backlog until they time out
+worker_class = "gthread"
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+def on_starting(server):
+    """Start metrics from a clean PROMETHEUS_MULTIPROC_DIR (files of old workers would be merged in)"""
+    import shutil
+    directory = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+def worker_exit(server, worker):
+    """Write out queued history entries before a worker exits"""
+    import sys
+    app = sys.modules.get('app')
+    if app is not None and app.history_writer is not None:
+        app.history_writer.close()
+
+def child_exit(server, worker):
+    """Let the metrics of an exited worker stop counting as live"""
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
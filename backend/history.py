@@ -0,0 +1,665 @@
+"""
+Calculation history storage.
+
+By default history is an append-only newline-delimited JSON log: each calculation
+is written with a single O_APPEND write, so saving costs the same no matter how much
+history exists and concurrent gunicorn workers never overwrite each other's entries.
+Readers stream the log line by line instead of loading it whole. Finished periods
+are compacted into compressed segments (see history_segments.py).
+
+Setting HISTORY_BACKEND=sqlite stores history in a SQLite database in WAL mode
+instead, with the numbers worth querying (timestamp, user, emissions per category)
+extracted into indexed columns next to the JSON inputs and results.
+
+Both stores answer paginated history queries and windowed aggregates from an
+index rather than by reading every entry: SQL indexes for SQLite, and for the
+JSONL log an in-memory column index that only parses lines appended since it
+was last refreshed.
+"""
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left, insort
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import json_codec
+from history_segments import (
+    compact_log, DEFAULT_CODEC, entry_id, history_lock, INDEX_FILE, needs_compaction, parse_base_header,
+    read_index, read_log_base, read_segment, sealed_segments, segments_dir, validate_segment_options
+)
+
+logger = logging.getLogger('carbon_emissions')
+
+# Digits (plus newline) of the last reserved number in the JSONL sequence file
+SEQUENCE_WIDTH = 21
+
+# Result keys indexed for history queries and aggregates
+EMISSION_COLUMNS = (
+    'total_emissions', 'uber_emissions', 'lyft_emissions',
+    'uber_eats_emissions', 'doordash_emissions', 'flight_emissions'
+)
+
+DEFAULT_PERCENTILES = (50, 90, 95, 99)
+
+def timestamp_seconds(timestamp: str) -> float:
+    """Convert an entry's ISO timestamp to epoch seconds"""
+    return datetime.fromisoformat(timestamp).timestamp()
+
+def encode_cursor(ts: float, entry_id: int) -> str:
+    """Cursor pointing just past (ts, entry_id) in newest-first order"""
+    return f"{ts!r}:{entry_id}"
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    """Parse a cursor returned by a history query (ValueError if malformed)"""
+    ts, _, entry_id = cursor.partition(':')
+    return float(ts), int(entry_id)
+
+def percentile(sorted_values: Sequence[float], q: float) -> Optional[float]:
+    """Linearly interpolated q-th percentile of already sorted values"""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+def summarize_columns(count: int, columns: Dict[str, List[float]],
+                      percentiles: Iterable[float] = DEFAULT_PERCENTILES) -> Dict[str, Any]:
+    """Sums and percentiles per category for the emission values of a window
+
+    columns maps each EMISSION_COLUMNS key to the values of the calculations that
+    reported it; categories a calculation did not include are left out, not zeroed.
+    """
+    percentiles = list(percentiles)
+    categories = {}
+    for column in EMISSION_COLUMNS:
+        values = sorted(columns.get(column, []))
+        categories[column[:-len('_emissions')]] = {
+            'count': len(values),
+            'sum': sum(values),
+            'percentiles': {f"p{q:g}": percentile(values, q) for q in percentiles},
+        }
+    return {'count': count, 'categories': categories}
+
+def _summary_record(entry_id: int, timestamp: str, user: Optional[str], values: Sequence[Optional[float]]) -> Dict[str, Any]:
+    record = {'id': entry_id, 'timestamp': timestamp, 'user': user}
+    record.update(zip(EMISSION_COLUMNS, values))
+    return record
+
+class JsonlHistoryIndex:
+    """In-memory column index over a JSONL history log and its sealed segments
+
+    Entry ids match the numbers JsonlHistoryStore.append returns. refresh()
+    parses only the bytes appended to the active log since the last refresh;
+    sealed segments are decompressed only when a query reaches their time range.
+    Only ids, timestamps, users and emission totals are kept: results are read
+    back from the log or segment holding the entry when a query asks for them.
+    Callers hold the history's shared flock around refresh() and reads.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self._index_stamp = None
+        self._segment_index = read_index(path)
+        self._reset()
+
+    def _reset(self):
+        self._inode = None
+        self._offset = 0
+        self._lines = 0
+        self.base = 0
+        self.segments: List[Dict[str, Any]] = []
+        self.loaded = set()
+        self.timestamps: Dict[int, str] = {}
+        self.users: Dict[int, Optional[str]] = {}
+        self.offsets: Dict[int, int] = {}
+        self.segment_files: Dict[int, str] = {}
+        self.values: Dict[int, Tuple[Optional[float], ...]] = {}
+        # (ts, id) kept sorted, overall and per user
+        self.by_time: List[Tuple[float, int]] = []
+        self.by_user: Dict[Optional[str], List[Tuple[float, int]]] = {}
+
+    def _read_segment_index(self) -> Dict[str, Any]:
+        """index.json, reloaded only when compaction rewrote it"""
+        try:
+            st = os.stat(os.path.join(segments_dir(self.path), INDEX_FILE))
+            stamp = (st.st_ino, st.st_mtime_ns)
+        except FileNotFoundError:
+            stamp = None
+        if stamp != self._index_stamp:
+            self._segment_index = read_index(self.path)
+            self._index_stamp = stamp
+        return self._segment_index
+
+    def refresh(self):
+        """Index entries appended to the active log since the last refresh"""
+        try:
+            st = os.stat(self.path)
+            inode, size = st.st_ino, st.st_size
+        except FileNotFoundError:
+            inode, size = None, 0
+        if inode != self._inode or size < self._offset:
+            # The log was rotated or replaced underneath us; rebuild
+            self._reset()
+            self._inode = inode
+        if size > self._offset:
+            self._read_appended()
+        self.segments = sealed_segments(self._read_segment_index(), self.base)
+
+    def _read_appended(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # partially written entry, pick it up next time
+                line_offset = self._offset
+                self._offset += len(line)
+                if line_offset == 0 and parse_base_header(line) is not None:
+                    self.base = parse_base_header(line)
+                    continue
+                self._lines += 1
+                if not line.strip():
+                    continue
+                try:
+                    entry = json_codec.loads(line)
+                    number = entry_id(entry, self.base, self._lines)
+                except (json.JSONDecodeError, AttributeError):
+                    logger.warning(f"Skipping unreadable history line {self._lines} in {self.path}")
+                    continue
+                if self._add(number, entry):
+                    self.offsets[number] = line_offset
+
+    def _add(self, entry_id: int, entry: Dict[str, Any]) -> bool:
+        try:
+            ts = timestamp_seconds(entry['timestamp'])
+        except (KeyError, TypeError, ValueError):
+            logger.warning(f"Skipping history entry {entry_id} without a valid timestamp")
+            return False
+        results = entry.get('results') or {}
+        user = entry.get('user')
+        self.timestamps[entry_id] = entry['timestamp']
+        self.users[entry_id] = user
+        self.values[entry_id] = tuple(results.get(column) for column in EMISSION_COLUMNS)
+        # Entries arrive in nearly sorted order, so insort is an append in practice
+        insort(self.by_time, (ts, entry_id))
+        insort(self.by_user.setdefault(user, []), (ts, entry_id))
+        return True
+
+    def pending_segments(self, start: Optional[float], end: Optional[float]) -> List[Dict[str, Any]]:
+        """Sealed segments overlapping [start, end) that are not loaded yet, newest first"""
+        pending = [
+            segment for segment in self.segments
+            if segment['file'] not in self.loaded
+            and (start is None or timestamp_seconds(segment['end']) >= start)
+            and (end is None or timestamp_seconds(segment['start']) < end)
+        ]
+        return sorted(pending, key=lambda segment: segment['last_id'], reverse=True)
+
+    def load_segment(self, segment: Dict[str, Any]):
+        """Decompress a sealed segment into the index"""
+        for entry_id, entry in read_segment(os.path.join(segments_dir(self.path), segment['file'])):
+            if self._add(entry_id, entry):
+                self.segment_files[entry_id] = segment['file']
+        self.loaded.add(segment['file'])
+
+    def window(self, start: Optional[float], end: Optional[float], user: Optional[str] = None) -> List[Tuple[float, int]]:
+        """Sorted (ts, id) keys of loaded entries with start <= ts < end"""
+        keys = self.by_user.get(user, []) if user is not None else self.by_time
+        lo = bisect_left(keys, (start,)) if start is not None else 0
+        hi = bisect_left(keys, (end,)) if end is not None else len(keys)
+        return keys[lo:hi]
+
+class JsonlHistoryStore:
+    """Append-only JSONL history log, compacted into time-based segments"""
+
+    def __init__(self, path: str, segment_period: str = 'month', segment_codec: str = DEFAULT_CODEC):
+        validate_segment_options(segment_period, segment_codec)
+        self.path = path
+        self.sequence_path = f"{path}.seq"
+        self.segment_period = segment_period
+        self.segment_codec = segment_codec
+        self._index = JsonlHistoryIndex(path)
+
+    def reserve_ids(self, n: int = 1) -> int:
+        """Reserve n consecutive calculation numbers and return the first
+
+        The last reserved number lives in <log>.seq, updated under an exclusive
+        flock so every worker draws from the same sequence.
+        """
+        fd = os.open(self.sequence_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            raw = os.pread(fd, SEQUENCE_WIDTH, 0)
+            last = int(raw) if raw.strip() else self._last_id()
+            # Fixed width, so the number is always rewritten in place
+            os.pwrite(fd, f"{last + n:0{SEQUENCE_WIDTH - 1}d}\n".encode('ascii'), 0)
+            return last + 1
+        finally:
+            os.close(fd)
+
+    def _last_id(self) -> int:
+        """Highest calculation number in history, used to start the sequence"""
+        last = 0
+        with history_lock(self.path):
+            try:
+                f = open(self.path, 'rb')
+            except FileNotFoundError:
+                f = None
+            base = (read_log_base(f.fileno()) if f else None) or 0
+            for segment in sealed_segments(read_index(self.path), base):
+                last = max(last, segment['last_id'])
+            if f is None:
+                return last
+            with f:
+                line_number = 0
+                for line in f:
+                    if parse_base_header(line) is not None:
+                        continue
+                    line_number += 1
+                    try:
+                        last = max(last, entry_id(json_codec.loads(line), base, line_number))
+                    except (json.JSONDecodeError, AttributeError):
+                        last = max(last, base + line_number)
+        return last
+
+    def append(self, entry: Dict[str, Any]) -> int:
+        """Append one entry and return its calculation number"""
+        return self.append_many([entry])[0]
+
+    def append_many(self, entries: List[Dict[str, Any]]) -> List[int]:
+        """Append entries with one write, numbering those without an id"""
+        missing = sum(1 for entry in entries if 'id' not in entry)
+        next_id = self.reserve_ids(missing) if missing else None
+        numbered = []
+        for entry in entries:
+            if 'id' not in entry:
+                entry = dict(entry, id=next_id)
+                next_id += 1
+            numbered.append(entry)
+        data = b''.join(json_codec.dumps_line(entry) for entry in numbered)
+
+        # Shared lock: appends run concurrently, compaction waits for them
+        with history_lock(self.path):
+            fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                # A failed write may have left a torn last line: start a new one so the
+                # first entry is not glued onto it (a blank line is skipped by readers)
+                size = os.fstat(fd).st_size
+                if size and os.pread(fd, 1, size - 1) != b'\n':
+                    data = b'\n' + data
+                written = os.write(fd, data)
+                if written != len(data):
+                    raise OSError(f"Short write to {self.path}: {written} of {len(data)} bytes")
+            finally:
+                os.close(fd)
+        return [entry['id'] for entry in numbered]
+
+    def sync(self):
+        """fsync the log and the sequence file"""
+        for path in (self.path, self.sequence_path):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def iter_entries(self) -> Iterator[Dict[str, Any]]:
+        """Stream entries from oldest to newest, sealed segments first"""
+        with history_lock(self.path):
+            try:
+                active = open(self.path, 'rb')
+                base = read_log_base(active.fileno()) or 0
+            except FileNotFoundError:
+                active, base = None, 0
+            segments = sealed_segments(read_index(self.path), base)
+
+        try:
+            for segment in segments:
+                for number, entry in read_segment(os.path.join(segments_dir(self.path), segment['file'])):
+                    entry['id'] = number
+                    yield entry
+            if active is None:
+                return
+            line_number = 0
+            for line in active:
+                if line_number == 0 and parse_base_header(line) is not None:
+                    continue
+                line_number += 1
+                if not line.strip():
+                    continue
+                try:
+                    entry = json_codec.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping unreadable history line {line_number} in {self.path}")
+                    continue
+                entry['id'] = entry_id(entry, base, line_number)
+                yield entry
+        finally:
+            if active is not None:
+                active.close()
+
+    def existing_ids(self, ids: Iterable[int]) -> set:
+        """The subset of ids already in history"""
+        ids = set(ids)
+        if not ids:
+            return set()
+        with self._index.lock, history_lock(self.path):
+            index = self._index
+            index.refresh()
+            for segment in index.segments:
+                if segment['file'] not in index.loaded and segment['first_id'] <= max(ids) and segment['last_id'] >= min(ids):
+                    index.load_segment(segment)
+            return {number for number in ids if number in index.timestamps}
+
+    def needs_compaction(self) -> bool:
+        return needs_compaction(self.path, self.segment_period)
+
+    def compact(self, blocking: bool = True) -> List[Dict[str, Any]]:
+        """Roll finished periods out of the active log into compressed segments"""
+        return compact_log(self.path, self.segment_period, self.segment_codec, blocking=blocking)
+
+    def _results(self, entry_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        """Results of indexed entries, read from the active log or their segments"""
+        index = self._index
+        results: Dict[int, Dict[str, Any]] = {}
+        by_segment: Dict[str, set] = {}
+        active = []
+        for number in entry_ids:
+            if number in index.segment_files:
+                by_segment.setdefault(index.segment_files[number], set()).add(number)
+            else:
+                active.append(number)
+        if active:
+            with open(self.path, 'rb') as f:
+                for number in active:
+                    f.seek(index.offsets[number])
+                    results[number] = json_codec.loads(f.readline()).get('results') or {}
+        for name, wanted in by_segment.items():
+            for number, entry in read_segment(os.path.join(segments_dir(self.path), name)):
+                if number in wanted:
+                    results[number] = entry.get('results') or {}
+                    wanted.discard(number)
+                    if not wanted:
+                        break
+        return results
+
+    def query(self, start: Optional[float] = None, end: Optional[float] = None, user: Optional[str] = None,
+              cursor: Optional[str] = None, limit: int = 50,
+              include_results: bool = False) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Return a newest-first page of entries in [start, end) and the cursor of the next page"""
+        cursor_key = decode_cursor(cursor) if cursor else None
+        with self._index.lock, history_lock(self.path):
+            index = self._index
+            index.refresh()
+            while True:
+                keys = index.window(start, end, user)
+                hi = bisect_left(keys, cursor_key) if cursor_key else len(keys)
+                # Only segments that could hold entries of this page (or the
+                # next one's first entry) need decompressing
+                floor = keys[hi - limit - 1][0] if hi > limit else start
+                pending = [
+                    segment for segment in index.pending_segments(floor, end)
+                    if cursor_key is None or timestamp_seconds(segment['start']) <= cursor_key[0]
+                ]
+                if not pending:
+                    break
+                index.load_segment(pending[0])
+
+            page = keys[max(hi - limit, 0):hi][::-1]
+            results = self._results(entry_id for _, entry_id in page) if include_results else None
+            items = []
+            for _, entry_id in page:
+                record = _summary_record(entry_id, index.timestamps[entry_id], index.users[entry_id], index.values[entry_id])
+                if include_results:
+                    record['results'] = results[entry_id]
+                items.append(record)
+
+        next_cursor = encode_cursor(*page[-1]) if page and hi > limit else None
+        return items, next_cursor
+
+    def aggregate(self, start: Optional[float] = None, end: Optional[float] = None, user: Optional[str] = None,
+                  percentiles: Iterable[float] = DEFAULT_PERCENTILES) -> Dict[str, Any]:
+        """Sums and percentiles of emissions per category for entries in [start, end)"""
+        with self._index.lock, history_lock(self.path):
+            index = self._index
+            index.refresh()
+            for segment in index.pending_segments(start, end):
+                index.load_segment(segment)
+            keys = index.window(start, end, user)
+            columns: Dict[str, List[float]] = {column: [] for column in EMISSION_COLUMNS}
+            for _, entry_id in keys:
+                for column, value in zip(EMISSION_COLUMNS, index.values[entry_id]):
+                    if value is not None:
+                        columns[column].append(value)
+        return summarize_columns(len(keys), columns, percentiles)
+
+def start_compaction_thread(store, interval: float) -> Optional[threading.Thread]:
+    """Periodically compact a JSONL store in the background (interval in seconds, 0 disables)"""
+    if interval <= 0 or not hasattr(store, 'compact'):
+        return None
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                # Another worker may be compacting already; skip this round then
+                if store.needs_compaction():
+                    store.compact(blocking=False)
+            except Exception as e:
+                logger.error(f"History compaction failed: {str(e)}", exc_info=True)
+
+    thread = threading.Thread(target=run, name='history-compaction', daemon=True)
+    thread.start()
+    return thread
+
+# One index per emission column, for filtering and sorting calculations by category
+_EMISSION_INDEXES = '\n'.join(
+    f"CREATE INDEX IF NOT EXISTS idx_calculations_{column} ON calculations ({column});" for column in EMISSION_COLUMNS
+)
+
+SQLITE_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS calculations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    ts REAL NOT NULL,
+    user TEXT,
+    {', '.join(f'{column} REAL' for column in EMISSION_COLUMNS)},
+    inputs TEXT NOT NULL,
+    results TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_calculations_ts ON calculations (ts);
+CREATE INDEX IF NOT EXISTS idx_calculations_user_ts ON calculations (user, ts);
+{_EMISSION_INDEXES}
+CREATE TABLE IF NOT EXISTS history_sequence (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+class SqliteHistoryStore:
+    """SQLite history store (WAL mode, safe for concurrent gunicorn workers)"""
+
+    def __init__(self, path: str, timeout: float = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(SQLITE_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _row(entry: Dict[str, Any]) -> tuple:
+        results = entry.get('results') or {}
+        return (
+            entry['id'],
+            entry['timestamp'],
+            timestamp_seconds(entry['timestamp']),
+            entry.get('user'),
+            *(results.get(column) for column in EMISSION_COLUMNS),
+            json_codec.dumps(entry.get('inputs')).decode('utf-8'),
+            json_codec.dumps(results).decode('utf-8'),
+        )
+
+    @staticmethod
+    def _reserve(conn: sqlite3.Connection, n: int) -> int:
+        """Advance the calculation sequence by n inside conn's transaction, return the first number"""
+        conn.execute(
+            "INSERT OR IGNORE INTO history_sequence (name, value) "
+            "SELECT 'calculations', COALESCE(MAX(id), 0) FROM calculations"
+        )
+        conn.execute("UPDATE history_sequence SET value = value + ? WHERE name = 'calculations'", (n,))
+        last = conn.execute("SELECT value FROM history_sequence WHERE name = 'calculations'").fetchone()[0]
+        return last - n + 1
+
+    def reserve_ids(self, n: int = 1) -> int:
+        """Reserve n consecutive calculation numbers and return the first"""
+        conn = self._connection()
+        with conn:
+            return self._reserve(conn, n)
+
+    def append(self, entry: Dict[str, Any]) -> int:
+        """Insert one entry and return its calculation number"""
+        return self.append_many([entry])[0]
+
+    def append_many(self, entries: List[Dict[str, Any]]) -> List[int]:
+        """Insert entries in one transaction, numbering those without an id"""
+        placeholders = ', '.join('?' * (6 + len(EMISSION_COLUMNS)))
+        conn = self._connection()
+        with conn:
+            missing = sum(1 for entry in entries if 'id' not in entry)
+            next_id = self._reserve(conn, missing) if missing else None
+            numbered = []
+            for entry in entries:
+                if 'id' not in entry:
+                    entry = dict(entry, id=next_id)
+                    next_id += 1
+                numbered.append(entry)
+            conn.executemany(
+                f"INSERT INTO calculations (id, timestamp, ts, user, {', '.join(EMISSION_COLUMNS)}, inputs, results) "
+                f"VALUES ({placeholders})",
+                [self._row(entry) for entry in numbered]
+            )
+        return [entry['id'] for entry in numbered]
+
+    def existing_ids(self, ids: Iterable[int]) -> set:
+        """The subset of ids already in history"""
+        ids = list(ids)
+        found = set()
+        conn = self._connection()
+        # Stay well under SQLite's bound parameter limit
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows = conn.execute(
+                f"SELECT id FROM calculations WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            found.update(row[0] for row in rows)
+        return found
+
+    def sync(self):
+        """Checkpoint the WAL into the database file (synced to disk)"""
+        self._connection().execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def iter_entries(self) -> Iterator[Dict[str, Any]]:
+        """Stream entries from oldest to newest"""
+        cursor = self._connection().execute(
+            "SELECT id, timestamp, user, inputs, results FROM calculations ORDER BY id"
+        )
+        for entry_id, timestamp, user, inputs, results in cursor:
+            entry = {'id': entry_id, 'timestamp': timestamp, 'inputs': json_codec.loads(inputs), 'results': json_codec.loads(results)}
+            if user is not None:
+                entry['user'] = user
+            yield entry
+
+    @staticmethod
+    def _window_clause(start: Optional[float], end: Optional[float], user: Optional[str]) -> Tuple[List[str], List[Any]]:
+        clauses, params = [], []
+        if user is not None:
+            clauses.append('user = ?')
+            params.append(user)
+        if start is not None:
+            clauses.append('ts >= ?')
+            params.append(start)
+        if end is not None:
+            clauses.append('ts < ?')
+            params.append(end)
+        return clauses, params
+
+    def query(self, start: Optional[float] = None, end: Optional[float] = None, user: Optional[str] = None,
+              cursor: Optional[str] = None, limit: int = 50,
+              include_results: bool = False) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Return a newest-first page of entries in [start, end) and the cursor of the next page"""
+        clauses, params = self._window_clause(start, end, user)
+        if cursor:
+            clauses.append('(ts, id) < (?, ?)')
+            params.extend(decode_cursor(cursor))
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        columns = ', '.join(EMISSION_COLUMNS) + (', results' if include_results else '')
+
+        # Walks idx_calculations_ts (or idx_calculations_user_ts) backwards
+        rows = self._connection().execute(
+            f"SELECT id, ts, timestamp, user, {columns} FROM calculations {where} "
+            f"ORDER BY ts DESC, id DESC LIMIT ?",
+            (*params, limit + 1)
+        ).fetchall()
+
+        items = []
+        for row in rows[:limit]:
+            entry_id, _, timestamp, user_id = row[:4]
+            record = _summary_record(entry_id, timestamp, user_id, row[4:4 + len(EMISSION_COLUMNS)])
+            if include_results:
+                record['results'] = json_codec.loads(row[-1])
+            items.append(record)
+
+        next_cursor = encode_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+        return items, next_cursor
+
+    def aggregate(self, start: Optional[float] = None, end: Optional[float] = None, user: Optional[str] = None,
+                  percentiles: Iterable[float] = DEFAULT_PERCENTILES) -> Dict[str, Any]:
+        """Sums and percentiles of emissions per category for entries in [start, end)"""
+        clauses, params = self._window_clause(start, end, user)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        cursor = self._connection().execute(
+            f"SELECT {', '.join(EMISSION_COLUMNS)} FROM calculations {where}", params
+        )
+
+        count = 0
+        columns: Dict[str, List[float]] = {column: [] for column in EMISSION_COLUMNS}
+        for row in cursor:
+            count += 1
+            for column, value in zip(EMISSION_COLUMNS, row):
+                if value is not None:
+                    columns[column].append(value)
+        return summarize_columns(count, columns, percentiles)
+
+def open_history_store(backend: Optional[str], data_dir: str):
+    """Create the history store selected by HISTORY_BACKEND ('jsonl' or 'sqlite')"""
+    backend = (backend or 'jsonl').lower()
+    if backend == 'sqlite':
+        path = os.getenv('HISTORY_DB', os.path.join(data_dir, 'calculations_history.db'))
+        logger.info(f"Using SQLite history store at {path}")
+        return SqliteHistoryStore(path)
+    if backend != 'jsonl':
+        logger.warning(f"Unknown HISTORY_BACKEND '{backend}', using the JSONL history log")
+    return JsonlHistoryStore(
+        os.path.join(data_dir, 'calculations_history.jsonl'),
+        segment_period=os.getenv('HISTORY_SEGMENT_PERIOD', 'month'),
+        segment_codec=os.getenv('HISTORY_SEGMENT_CODEC', DEFAULT_CODEC)
+    )
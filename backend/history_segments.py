@@ -0,0 +1,295 @@
+"""
+Time-based segments for the JSONL calculation history.
+
+Compaction rolls entries out of the active log (calculations_history.jsonl) into
+sealed, compressed segment files, one per period (day, week or month), once that
+period is over. The active log stays the newest segment, so reads of recent
+history never open a compressed file.
+
+Segments live in history_segments/ next to the log:
+
+    index.json                   segment id and time ranges
+    2026-01-000001.jsonl.zst     sealed segment (zstd, or .gz when zstandard is missing)
+
+Within a segment, identical payloads (an entry's inputs and its results'
+entry_details) are stored once: the first occurrence is written as a
+{"payload": <hash>, "data": ...} line and entries refer to it by content hash.
+Every segment decodes on its own.
+
+Entries carry their calculation number as "id"; entries written before ids
+were reserved up front are numbered by their position in the full history.
+Once compacted, the active log starts with a {"history_base": N} header line,
+N being the number of lines rolled out so far. The header is replaced
+atomically together with the log, so segments sealed past that point (left by
+a compaction interrupted before it replaced the log) are ignored and rewritten
+on the next run. Appenders hold a shared flock on <log>.lock and compaction
+holds it exclusively, so numbering never races with a rotation.
+"""
+import fcntl
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import json_codec
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger('carbon_emissions')
+
+INDEX_FILE = 'index.json'
+BASE_HEADER_PREFIX = b'{"history_base":'
+SEGMENT_PERIODS = ('day', 'week', 'month')
+CODEC_EXTENSIONS = {'zstd': '.zst', 'gzip': '.gz'}
+DEFAULT_CODEC = 'zstd' if zstandard is not None else 'gzip'
+COMPRESSION_LEVEL = 9
+
+def segments_dir(log_path: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(log_path)), 'history_segments')
+
+@contextmanager
+def history_lock(log_path: str, exclusive: bool = False, blocking: bool = True):
+    """flock the history's lock file; yields False if non-blocking and already held"""
+    fd = os.open(f"{log_path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+    finally:
+        os.close(fd)
+
+def validate_segment_options(period: str, codec: str):
+    """Raise ValueError for an unknown segment period or an unusable codec"""
+    if period not in SEGMENT_PERIODS:
+        raise ValueError(f"Unknown segment period '{period}', expected one of {SEGMENT_PERIODS}")
+    if codec not in CODEC_EXTENSIONS:
+        raise ValueError(f"Unknown segment codec '{codec}', expected one of {tuple(CODEC_EXTENSIONS)}")
+    if codec == 'zstd' and zstandard is None:
+        raise ValueError("zstd segments need the zstandard package")
+
+def period_key(timestamp: str, period: str) -> str:
+    """Segment period of an ISO timestamp (ISO strings order like their periods)"""
+    moment = datetime.fromisoformat(timestamp)
+    if period == 'day':
+        return moment.date().isoformat()
+    if period == 'week':
+        year, week, _ = moment.isocalendar()
+        return f"{year}-W{week:02d}"
+    return moment.strftime('%Y-%m')
+
+def read_index(log_path: str) -> Dict[str, Any]:
+    """Load index.json (an empty index when history was never compacted)"""
+    try:
+        with open(os.path.join(segments_dir(log_path), INDEX_FILE), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'segments': []}
+
+def parse_base_header(line: bytes) -> Optional[int]:
+    """Base count from the active log's header line, or None if line is an entry"""
+    if not line.startswith(BASE_HEADER_PREFIX):
+        return None
+    try:
+        return int(json.loads(line)['history_base'])
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+        return None
+
+def base_header(base: int) -> bytes:
+    return BASE_HEADER_PREFIX + str(base).encode('ascii') + b'}\n'
+
+def read_log_base(fd: int) -> Optional[int]:
+    """Base count from the header of the active log open as fd (None if it has none)"""
+    return parse_base_header(os.pread(fd, 64, 0).split(b'\n', 1)[0])
+
+def sealed_segments(index: Dict[str, Any], base: int) -> List[Dict[str, Any]]:
+    """Segments holding the entries rolled out before an active log with header base"""
+    return [segment for segment in index['segments'] if segment['sealed_lines'] <= base]
+
+def entry_id(entry: Dict[str, Any], base: int, line_number: int) -> int:
+    """An entry's calculation number: its id, or its position for entries written without one"""
+    return entry.get('id') or base + line_number
+
+def _write_json_atomic(path: str, data: Any):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def payload_hash(data: Any) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def _open_writer(path: str, codec: str):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).stream_writer(open(path, 'wb'), closefd=True)
+    return gzip.open(path, 'wb', compresslevel=COMPRESSION_LEVEL)
+
+def _open_reader(path: str):
+    if path.endswith(CODEC_EXTENSIONS['zstd']):
+        if zstandard is None:
+            raise ValueError(f"Reading {path} needs the zstandard package")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True))
+    return gzip.open(path, 'rb')
+
+def write_segment(path: str, entries: List[Tuple[int, Dict[str, Any]]], codec: str) -> int:
+    """Write (id, entry) pairs to a compressed segment, storing repeated payloads once"""
+    seen = set()
+    tmp_path = f"{path}.tmp"
+    with _open_writer(tmp_path, codec) as f:
+        def store(data: Any) -> str:
+            ref = payload_hash(data)
+            if ref not in seen:
+                seen.add(ref)
+                f.write(json_codec.dumps_line({'payload': ref, 'data': data}))
+            return ref
+
+        for entry_id, entry in entries:
+            record = dict(entry, id=entry_id)
+            if 'inputs' in record:
+                record['inputs_ref'] = store(record.pop('inputs'))
+            results = record.get('results')
+            if isinstance(results, dict) and 'entry_details' in results:
+                results = record['results'] = dict(results)
+                results['entry_details_ref'] = store(results.pop('entry_details'))
+            f.write(json_codec.dumps_line(record))
+    os.replace(tmp_path, path)
+    return len(seen)
+
+def read_segment(path: str) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """Stream (id, entry) pairs from a segment with payload references resolved"""
+    payloads: Dict[str, Any] = {}
+    with _open_reader(path) as f:
+        for line in f:
+            record = json_codec.loads(line)
+            if 'payload' in record:
+                payloads[record['payload']] = record['data']
+                continue
+            if 'inputs_ref' in record:
+                record['inputs'] = payloads[record.pop('inputs_ref')]
+            results = record.get('results')
+            if isinstance(results, dict) and 'entry_details_ref' in results:
+                results['entry_details'] = payloads[results.pop('entry_details_ref')]
+            yield record.pop('id'), record
+
+def _rollable_prefix(lines: List[bytes], period: str, current: str) -> Tuple[int, List[Tuple[str, int, Dict[str, Any]]]]:
+    """Find the leading lines that belong to finished periods
+
+    Returns how many lines to roll and (period, line number, entry) for each
+    readable entry among them. Unreadable lines are dropped with a warning.
+    """
+    rolled: List[Tuple[str, int, Dict[str, Any]]] = []
+    count = 0
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            count = line_number
+            continue
+        try:
+            entry = json_codec.loads(line)
+            key = period_key(entry['timestamp'], period)
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+            logger.warning(f"Dropping unreadable history line {line_number} during compaction")
+            count = line_number
+            continue
+        if key >= current:
+            break
+        rolled.append((key, line_number, entry))
+        count = line_number
+    return count, rolled
+
+def needs_compaction(log_path: str, period: str, now: Optional[datetime] = None) -> bool:
+    """Cheap check: does the active log start with an entry from a finished period?"""
+    try:
+        with open(log_path, 'rb') as f:
+            line = f.readline()
+            if parse_base_header(line) is not None:
+                line = f.readline()
+        return period_key(json.loads(line)['timestamp'], period) < period_key((now or datetime.now()).isoformat(), period)
+    except (OSError, json.JSONDecodeError, KeyError, TypeError, ValueError):
+        return False
+
+def compact_log(log_path: str, period: str = 'month', codec: str = DEFAULT_CODEC,
+                now: Optional[datetime] = None, blocking: bool = True) -> List[Dict[str, Any]]:
+    """Roll entries from finished periods out of the active log into sealed segments
+
+    Returns the index records of the segments written (none if another process
+    holds the lock and blocking is False).
+    """
+    validate_segment_options(period, codec)
+    directory = segments_dir(log_path)
+    os.makedirs(directory, exist_ok=True)
+    current = period_key((now or datetime.now()).isoformat(), period)
+
+    with history_lock(log_path, exclusive=True, blocking=blocking) as locked:
+        if not locked or not os.path.exists(log_path):
+            return []
+
+        with open(log_path, 'rb') as f:
+            lines = f.readlines()
+        if lines and not lines[-1].endswith(b'\n'):
+            lines[-1] += b'\n'
+        base = parse_base_header(lines[0]) if lines else None
+        if base is None:
+            base = 0
+        else:
+            lines = lines[1:]
+
+        count, rolled = _rollable_prefix(lines, period, current)
+        if count == 0:
+            return []
+
+        # Consecutive entries of the same period form one segment
+        runs: List[List[Tuple[str, int, Dict[str, Any]]]] = []
+        for item in rolled:
+            if runs and runs[-1][0][0] == item[0]:
+                runs[-1].append(item)
+            else:
+                runs.append([item])
+
+        written = []
+        for run in runs:
+            key = run[0][0]
+            entries = [(entry_id(entry, base, line_number), entry) for _, line_number, entry in run]
+            ids = [number for number, _ in entries]
+            name = f"{key}-{base + run[0][1]:06d}.jsonl{CODEC_EXTENSIONS[codec]}"
+            path = os.path.join(directory, name)
+            payloads = write_segment(path, entries, codec)
+            timestamps = sorted(entry['timestamp'] for _, _, entry in run)
+            written.append({
+                'file': name, 'period': key, 'codec': codec,
+                'first_id': min(ids), 'last_id': max(ids), 'count': len(run), 'sealed_lines': base + count,
+                'start': timestamps[0], 'end': timestamps[-1],
+                'payloads': payloads, 'bytes': os.path.getsize(path),
+            })
+
+        # Segments first, then the index, then the active log: until the log is
+        # replaced its old header keeps the new segments out of every read
+        _write_json_atomic(os.path.join(directory, INDEX_FILE), {
+            'segments': sealed_segments(read_index(log_path), base) + written,
+        })
+
+        tmp_path = f"{log_path}.compact.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(base_header(base + count))
+            f.writelines(lines[count:])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, log_path)
+
+    if written:
+        logger.info(f"Compacted {len(rolled)} history entries into {len(written)} segments")
+    return written
@@ -0,0 +1,201 @@
+"""
+Write-behind persistence for calculation history.
+
+save_calculation reserves the entry's calculation number from the history store
+(a short locked counter update) and queues the entry; a background thread encodes
+and writes queued entries in batches, so requests respond without waiting on disk
+I/O. The number in the response is the entry's id in history whenever the write lands.
+
+HISTORY_FSYNC_EVERY sets how often written entries are fsynced:
+
+    1       after every batch, before the writer takes the next one (the default)
+    N       once N entries were written since the last fsync
+    Tms     at most T milliseconds after an entry was written, e.g. 250ms
+    0       never explicitly, flushing is left to the OS
+
+Queued entries are flushed when the process exits (atexit, and gunicorn's
+worker_exit hook in gunicorn_config.py).
+
+A failed write is retried with only the entries whose ids are not in the store
+yet, since it may have landed in part. Entries that still fail after
+WRITE_ATTEMPTS writes are appended, ids included, to a dead-letter JSONL file
+next to the store (<store>.dead-letter.jsonl) and counted in greeney_history_dropped_entries_total, so it can be replayed with
+store.append_many once the store is writable again.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import json_codec
+from metrics import count_history_dropped
+
+logger = logging.getLogger('carbon_emissions')
+
+MAX_BATCH_SIZE = 256
+MAX_QUEUED_ENTRIES = 10000
+WRITE_ATTEMPTS = 3
+
+_STOP = object()
+
+def parse_fsync_policy(value: str) -> Tuple[int, Optional[float]]:
+    """Parse HISTORY_FSYNC_EVERY into (every N entries, every T seconds)"""
+    value = str(value).strip().lower()
+    if value.endswith('ms'):
+        milliseconds = float(value[:-2])
+        if milliseconds <= 0:
+            raise ValueError("HISTORY_FSYNC_EVERY interval must be positive")
+        return 0, milliseconds / 1000
+    entries = int(value)
+    if entries < 0:
+        raise ValueError("HISTORY_FSYNC_EVERY must not be negative")
+    return entries, None
+
+class HistoryWriter:
+    """Background writer that batches history entries into a store"""
+
+    def __init__(self, store, fsync_every: str = '1', max_batch: int = MAX_BATCH_SIZE,
+                 max_queued: int = MAX_QUEUED_ENTRIES, dead_letter_path: Optional[str] = None):
+        self.store = store
+        self.dead_letter_path = dead_letter_path or f"{store.path}.dead-letter.jsonl"
+        self.sync_entries, self.sync_interval = parse_fsync_policy(fsync_every)
+        self.max_batch = max_batch
+        self._queue: "queue.Queue[Any]" = queue.Queue(maxsize=max_queued)
+        self._unsynced = 0
+        self._first_unsynced = None
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, entry: Dict[str, Any]) -> int:
+        """Number the entry and queue it for writing; returns its calculation number"""
+        return self.submit_many([entry])[0]
+
+    def submit_many(self, entries: List[Dict[str, Any]]) -> List[int]:
+        """Number entries with one reservation and queue them; returns their calculation numbers
+
+        After close() the entries are written directly instead.
+        """
+        first = self.store.reserve_ids(len(entries))
+        numbered = [dict(entry, id=first + i) for i, entry in enumerate(entries)]
+        with self._close_lock:
+            # Checked and queued under the lock, so close() cannot drain the queue in between
+            if not self._closed:
+                # Blocks only when the writer is far behind, applying backpressure
+                for entry in numbered:
+                    self._queue.put(entry)
+                return [entry['id'] for entry in numbered]
+        return self.store.append_many(numbered)
+
+    def flush(self):
+        """Block until every queued entry has been written"""
+        self._queue.join()
+
+    def close(self):
+        """Write out queued entries, fsync, and stop the writer (idempotent)"""
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+        # Entries queued just before closing may have landed behind the stop marker
+        leftover = []
+        while True:
+            try:
+                leftover.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if leftover:
+            self.store.append_many(leftover)
+            self.store.sync()
+
+    def _next_batch(self) -> List[Any]:
+        """Wait for entries (or a pending interval fsync) and drain up to max_batch"""
+        timeout = None
+        if self._unsynced and self.sync_interval is not None:
+            timeout = max(self._first_unsynced + self.sync_interval - time.monotonic(), 0)
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.max_batch and batch[-1] is not _STOP:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            stopping = bool(batch) and batch[-1] is _STOP
+            entries = batch[:-1] if stopping else batch
+            try:
+                if entries:
+                    self._write(entries)
+                if self._sync_due() or (stopping and self._unsynced):
+                    self._sync()
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stopping:
+                return
+
+    def _write(self, entries: List[Dict[str, Any]]):
+        for attempt in range(1, WRITE_ATTEMPTS + 1):
+            try:
+                if attempt > 1:
+                    # The failed attempt may have written part of the batch: retry only the rest
+                    stored = self.store.existing_ids(entry['id'] for entry in entries)
+                    entries = [entry for entry in entries if entry['id'] not in stored]
+                if entries:
+                    self.store.append_many(entries)
+                break
+            except Exception as e:
+                if attempt == WRITE_ATTEMPTS:
+                    ids = ', '.join(str(entry['id']) for entry in entries)
+                    logger.error(f"Dropping history entries {ids} after {attempt} failed writes: {str(e)}", exc_info=True)
+                    self._dead_letter(entries)
+                    return
+                logger.warning(f"History write failed (attempt {attempt}), retrying: {str(e)}")
+                time.sleep(0.1 * attempt)
+
+        if not self._unsynced:
+            self._first_unsynced = time.monotonic()
+        self._unsynced += len(entries)
+
+    def _dead_letter(self, entries: List[Dict[str, Any]]):
+        """Keep entries the store would not take in the dead-letter file"""
+        count_history_dropped(len(entries))
+        data = b''.join(json_codec.dumps_line(entry) for entry in entries)
+        try:
+            fd = os.open(self.dead_letter_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.error(f"Could not write dropped history entries to {self.dead_letter_path}: {str(e)}")
+            return
+        logger.error(f"Wrote {len(entries)} dropped history entries to {self.dead_letter_path}")
+
+    def _sync_due(self) -> bool:
+        if not self._unsynced:
+            return False
+        if self.sync_interval is not None:
+            return time.monotonic() - self._first_unsynced >= self.sync_interval
+        return self.sync_entries > 0 and self._unsynced >= self.sync_entries
+
+    def _sync(self):
+        try:
+            self.store.sync()
+        except Exception as e:
+            logger.error(f"History fsync failed: {str(e)}", exc_info=True)
+        self._unsynced = 0
+        self._first_unsynced = None
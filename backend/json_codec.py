@@ -0,0 +1,109 @@
+"""
+JSON encoding for API responses and calculation history.
+
+Uses orjson when it is installed and the standard library otherwise. Both
+produce compact UTF-8 JSON (no indentation, no ASCII escaping), and either
+decoder reads what the other wrote. Values orjson cannot encode (integers
+beyond 64 bits, exotic types) fall back to the standard library. NaN and
+infinity, which are not valid JSON, are written as null by orjson.
+
+init_app() plugs the codec into Flask so jsonify and request.get_json use it:
+through a JSON provider (app.json) on Flask 2.2+, and through app.json_encoder
+and app.json_decoder on older versions.
+"""
+import json
+import logging
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger('carbon_emissions')
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    logger.warning("orjson library not installed. Falling back to the standard json module.")
+
+try:
+    from flask.json.provider import DefaultJSONProvider
+except ImportError:
+    # Flask < 2.2 has no pluggable JSON provider; jsonify uses app.json_encoder instead
+    DefaultJSONProvider = None
+    from flask.json import JSONDecoder as FlaskJSONDecoder, JSONEncoder as FlaskJSONEncoder
+
+CODEC = 'orjson' if orjson is not None else 'json'
+
+def _stdlib_dumps(obj: Any, sort_keys: bool = False, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+    """Encode obj as compact UTF-8 JSON bytes"""
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, sort_keys=sort_keys,
+                      default=default).encode('utf-8')
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj: Any, sort_keys: bool = False, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+        """Encode obj as compact UTF-8 JSON bytes"""
+        option = _OPTIONS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        if default is not None:
+            # Let default format dates the way the stdlib encoder would see them
+            option |= orjson.OPT_PASSTHROUGH_DATETIME
+        try:
+            return orjson.dumps(obj, default=default, option=option)
+        except orjson.JSONEncodeError:
+            return _stdlib_dumps(obj, sort_keys, default)
+
+    loads = orjson.loads
+else:
+    dumps = _stdlib_dumps
+    loads = json.loads
+
+def dumps_line(obj: Any) -> bytes:
+    """Encode obj as one newline-terminated JSONL/NDJSON line"""
+    return dumps(obj) + b'\n'
+
+if DefaultJSONProvider is not None:
+    class OrjsonProvider(DefaultJSONProvider):
+        """Flask JSON provider backed by json_codec (keeps Flask's sort_keys and type defaults)"""
+
+        def dumps(self, obj: Any, **kwargs: Any) -> str:
+            if kwargs:
+                # Callers asking for stdlib options (indent, cls, ...) get the stdlib encoder
+                return super().dumps(obj, **kwargs)
+            return dumps(obj, sort_keys=self.sort_keys, default=self.default).decode('utf-8')
+
+        def loads(self, s, **kwargs: Any) -> Any:
+            if kwargs:
+                return super().loads(s, **kwargs)
+            return loads(s)
+
+        def response(self, *args: Any, **kwargs: Any):
+            obj = self._prepare_response_obj(args, kwargs)
+            if self.compact is False or (self.compact is None and self._app.debug):
+                body = super().dumps(obj, indent=2, sort_keys=self.sort_keys).encode('utf-8')
+            else:
+                body = dumps(obj, sort_keys=self.sort_keys, default=self.default)
+            return self._app.response_class(body + b'\n', mimetype=self.mimetype)
+else:
+    OrjsonProvider = None
+
+    class OrjsonEncoder(FlaskJSONEncoder):
+        """Flask < 2.2 JSON encoder backed by json_codec (keeps Flask's sort_keys and type defaults)"""
+
+        def encode(self, o: Any) -> str:
+            if self.indent is not None:
+                # Pretty-printed responses (debug, JSONIFY_PRETTYPRINT_REGULAR) keep the stdlib encoder
+                return super().encode(o)
+            return dumps(o, sort_keys=self.sort_keys, default=self.default).decode('utf-8')
+
+    class OrjsonDecoder(FlaskJSONDecoder):
+        """Flask < 2.2 JSON decoder backed by json_codec"""
+
+        def decode(self, s: str, _w: Any = None) -> Any:
+            return loads(s)
+
+def init_app(app) -> None:
+    """Make the app's jsonify and request JSON parsing use this codec"""
+    if OrjsonProvider is not None:
+        app.json = OrjsonProvider(app)
+    else:
+        app.json_encoder = OrjsonEncoder
+        app.json_decoder = OrjsonDecoder
@@ -0,0 +1,190 @@
+"""
+Coordination helpers for the external Google lookups made by calculator.py.
+
+SingleFlight makes concurrent callers asking for the same key share one
+in-flight call instead of each issuing their own request. Inside a
+lookup_scope() (one calculate_emissions call) completed results are also
+remembered, so repeated entries in a single payload resolve once, and entries
+left unresolved are counted so callers can tell complete results from partial.
+Results the memoize predicate rejects (transient failures) are not remembered,
+so they are retried on the next entry rather than for the rest of the scope.
+
+LookupCache keeps resolved lookups across requests. Failures are stored
+apart from successes with shorter TTLs, so known-bad inputs fail fast
+without crowding out good results.
+"""
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+# Outcomes a lookup result can be cached under
+OUTCOME_OK = 'ok'
+OUTCOME_PERMANENT = 'permanent'  # e.g. NOT_FOUND: retrying will not help
+OUTCOME_TRANSIENT = 'transient'  # e.g. network or quota errors: retry soon
+
+_local = threading.local()
+
+@contextmanager
+def lookup_scope():
+    """Remember completed lookups for the duration of the block (re-entrant)
+
+    Yields the scope's stats, e.g. {'unresolved': 0}.
+    """
+    if getattr(_local, 'results', None) is not None:
+        # Already inside a scope (e.g. calculate_emissions recursing), reuse it
+        yield _local.stats
+        return
+
+    _local.results = {}
+    _local.stats = {'unresolved': 0}
+    try:
+        yield _local.stats
+    finally:
+        _local.results = None
+        _local.stats = None
+
+def note_unresolved():
+    """Count an entry of the active lookup scope that could not be fully resolved"""
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats['unresolved'] += 1
+
+def _scope_results() -> Optional[Dict[Hashable, Any]]:
+    """Return the result memo of the active lookup scope, if any"""
+    return getattr(_local, 'results', None)
+
+class _Call:
+    """A single in-flight call that other callers can wait on"""
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """Coalesce concurrent calls that share the same key into one call"""
+
+    def __init__(self, memoize: Optional[Callable[[Any], bool]] = None):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        # Whether a result may be remembered in the active lookup scope (all of them when None)
+        self._memoize = memoize
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run fn(*args, **kwargs) once per key among concurrent callers and share the result"""
+        scope = _scope_results()
+        if scope is not None and key in scope:
+            return scope[key]
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if leader:
+            try:
+                call.result = fn(*args, **kwargs)
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.event.set()
+        else:
+            call.event.wait()
+
+        if call.error is not None:
+            raise call.error
+
+        if scope is not None and (self._memoize is None or self._memoize(call.result)):
+            scope[key] = call.result
+        return call.result
+
+def normalize_key(value: Any) -> str:
+    """Normalize a lookup argument (case and whitespace) for use in a key"""
+    if value is None:
+        return ''
+    return ' '.join(str(value).split()).lower()
+
+class _TTLStore:
+    """Bounded LRU mapping whose entries expire after a per-entry TTL"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable, now: float) -> Tuple[bool, Any]:
+        item = self._data.get(key)
+        if item is None:
+            return False, None
+        expires, value = item
+        if expires <= now:
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    def set(self, key: Hashable, value: Any, expires: float):
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class LookupCache:
+    """TTL cache for lookup results with failures kept apart from successes"""
+
+    def __init__(self, maxsize: int = 2048, ttl: float = 86400,
+                 negative_ttl: float = 3600, transient_ttl: float = 60,
+                 negative_maxsize: Optional[int] = None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.transient_ttl = transient_ttl
+        self._lock = threading.Lock()
+        self._positive = _TTLStore(maxsize)
+        self._negative = _TTLStore(negative_maxsize or maxsize)
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """Return (hit, value) for key, checking successes before failures"""
+        now = time.monotonic()
+        with self._lock:
+            hit, value = self._positive.get(key, now)
+            if not hit:
+                hit, value = self._negative.get(key, now)
+            return hit, value
+
+    def set(self, key: Hashable, value: Any, outcome: str):
+        """Store value under key with the TTL that matches its outcome"""
+        now = time.monotonic()
+        with self._lock:
+            if outcome == OUTCOME_OK:
+                if self.ttl > 0:
+                    self._negative.pop(key)
+                    self._positive.set(key, value, now + self.ttl)
+            else:
+                ttl = self.negative_ttl if outcome == OUTCOME_PERMANENT else self.transient_ttl
+                if ttl > 0:
+                    self._positive.pop(key)
+                    self._negative.set(key, value, now + ttl)
+
+    def clear(self):
+        with self._lock:
+            self._positive.clear()
+            self._negative.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._positive) + len(self._negative)
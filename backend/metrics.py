@@ -0,0 +1,184 @@
+"""
+Prometheus metrics for the API, served by app.py at /metrics.
+
+    greeney_request_duration_seconds{endpoint,method,status}   request latency
+    greeney_stage_duration_seconds{stage}                       per-stage latency
+    greeney_google_api_calls_total{method,status}               Google API calls
+    greeney_cache_requests_total{cache,result}                  cache hits/misses
+    greeney_history_dropped_entries_total                       history entries the writer gave up on
+
+Stages: gmail_list, gmail_get, receipt_parse, geocode, places_search,
+distance_matrix, flight_lookup, calculation, history_save, google_throttle.
+Google stages only time calls that reach Google, so cached lookups don't show
+up there; google_throttle is the time Maps calls waited for the rate limit.
+
+Between begin_timings() and end_timings() the stage times of the current thread
+are also summed per stage, for the Server-Timing header of a single request.
+
+With several gunicorn workers set PROMETHEUS_MULTIPROC_DIR: each worker writes
+its samples to files there and /metrics merges them (gunicorn_config.py clears
+the directory at startup and marks exited workers dead).
+
+prometheus_client is optional; without it every metric is a no-op.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from admission import google_bucket
+
+logger = logging.getLogger('carbon_emissions')
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+    )
+except ImportError:
+    Counter = Histogram = None
+    logger.warning("prometheus_client library not installed. /metrics will be unavailable.")
+
+# Requests span a cached lookup (~ms) up to a Gmail scan with many Google calls (~minutes)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Stage a Google API method is timed under
+GOOGLE_METHOD_STAGES = {
+    'geocode': 'geocode',
+    'places_nearby': 'places_search',
+    'places': 'places_search',
+    'place': 'places_search',
+    'distance_matrix': 'distance_matrix',
+    'gmail_list': 'gmail_list',
+    'gmail_get': 'gmail_get',
+}
+
+# Google Maps methods, which share the per-worker rate limit (Gmail has its own quota)
+MAPS_METHODS = {'geocode', 'places_nearby', 'places', 'place', 'distance_matrix'}
+
+_local = threading.local()
+
+class _NoopMetric:
+    """Stands in for a metric when prometheus_client is missing"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+if Histogram is not None:
+    REQUEST_LATENCY = Histogram(
+        'greeney_request_duration_seconds', 'HTTP request latency',
+        ('endpoint', 'method', 'status'), buckets=REQUEST_BUCKETS
+    )
+    STAGE_LATENCY = Histogram(
+        'greeney_stage_duration_seconds', 'Latency of a processing stage',
+        ('stage',), buckets=STAGE_BUCKETS
+    )
+    GOOGLE_CALLS = Counter(
+        'greeney_google_api_calls', 'Google API calls by method and response status',
+        ('method', 'status')
+    )
+    CACHE_REQUESTS = Counter(
+        'greeney_cache_requests', 'Cache lookups by cache and result (hit or miss)',
+        ('cache', 'result')
+    )
+    HISTORY_DROPPED = Counter(
+        'greeney_history_dropped_entries', 'History entries not written to the store after repeated failures'
+    )
+else:
+    REQUEST_LATENCY = STAGE_LATENCY = GOOGLE_CALLS = CACHE_REQUESTS = HISTORY_DROPPED = _NoopMetric()
+
+def metrics_enabled() -> bool:
+    return Histogram is not None
+
+def begin_timings():
+    """Start summing this thread's stage times (one request)"""
+    _local.timings = {}
+
+def end_timings() -> Dict[str, float]:
+    """Stop summing stage times and return seconds per stage"""
+    timings = getattr(_local, 'timings', None) or {}
+    _local.timings = None
+    return timings
+
+def _record_stage(stage: str, seconds: float):
+    STAGE_LATENCY.labels(stage).observe(seconds)
+    timings: Optional[Dict[str, float]] = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+@contextmanager
+def observe_stage(stage: str):
+    """Time the block under the given stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record_stage(stage, time.perf_counter() - start)
+
+def observe_request(endpoint: str, method: str, status: int, seconds: float):
+    REQUEST_LATENCY.labels(endpoint, method, str(status)).observe(seconds)
+
+def count_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+def count_history_dropped(entries: int):
+    HISTORY_DROPPED.inc(entries)
+
+def _response_status(result: Any) -> str:
+    """Status of a Google API response (geocode returns a bare list of results)"""
+    if isinstance(result, dict):
+        return str(result.get('status', 'OK'))
+    if isinstance(result, list):
+        return 'OK' if result else 'ZERO_RESULTS'
+    return 'OK'
+
+def _error_status(error: Exception) -> str:
+    # googlemaps ApiError carries the API status, googleapiclient HttpError the HTTP one
+    status = getattr(error, 'status', None) or getattr(getattr(error, 'resp', None), 'status', None)
+    return str(status) if status else type(error).__name__
+
+def google_call(method: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Make a Google API call, timing it under its stage and counting it by status
+
+    Maps calls first take a token from the rate limit; a call refused by it
+    raises RateLimited and is counted with status RATE_LIMITED.
+    """
+    if method in MAPS_METHODS:
+        try:
+            waited = google_bucket.acquire()
+        except Exception as e:
+            GOOGLE_CALLS.labels(method, _error_status(e)).inc()
+            raise
+        if waited:
+            _record_stage('google_throttle', waited)
+    start = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+    except Exception as e:
+        GOOGLE_CALLS.labels(method, _error_status(e)).inc()
+        raise
+    finally:
+        _record_stage(GOOGLE_METHOD_STAGES[method], time.perf_counter() - start)
+    GOOGLE_CALLS.labels(method, _response_status(result)).inc()
+    return result
+
+def render_metrics() -> Tuple[bytes, str]:
+    """Exposition of all metrics, merged across workers in multiprocess mode"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+def mark_process_dead(pid: int):
+    """Drop an exited worker's live gauges from the multiprocess directory"""
+    if Histogram is not None and os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Migrate the legacy data/calculations_history.json (one top-level JSON array) into
+the history store selected by HISTORY_BACKEND.
+
+The array is parsed incrementally with json.JSONDecoder.raw_decode, so memory stays
+bounded by the largest single entry however big the file is. Entries are inserted
+in batches under calculation numbers reserved from the store. After every batch a
+checkpoint (source byte offset, reserved numbers, running checksum) is saved, so an
+interrupted run resumes where it stopped without duplicating entries.
+
+The run ends with a verification report comparing entry counts and checksums of
+the source file and the migrated entries in the store.
+
+Usage: python migrate_history.py [--source FILE] [--backend jsonl|sqlite] [--batch-size N] [--restart] [--verify-only]
+"""
+import argparse
+import codecs
+import hashlib
+import json
+import os
+import sys
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from history import open_history_store
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+DEFAULT_SOURCE = os.path.join(DATA_DIR, 'calculations_history.json')
+CHECKPOINT_FILE = 'migrate_history.checkpoint.json'
+READ_SIZE = 1 << 16
+CHECKSUM_MODULUS = 1 << 256
+
+class JsonArrayReader:
+    """Stream the elements of a top-level JSON array from a binary file
+
+    Yields (end_offset, element) where end_offset is the byte offset just past
+    the element; passing it back as offset resumes after that element.
+    """
+
+    def __init__(self, f, offset: Optional[int] = None, read_size: int = READ_SIZE):
+        self._f = f
+        self._read_size = read_size
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._eof = False
+        # Byte offset of self._buffer[0] in the file
+        self._offset = offset or 0
+        self._resumed = offset is not None
+        f.seek(self._offset)
+
+    def _fill(self, size: int) -> bool:
+        """Decode up to size more bytes into the buffer; False at end of file"""
+        data = self._f.read(size)
+        if not data:
+            self._buffer += self._utf8.decode(b'', final=True)
+            self._eof = True
+            return False
+        self._buffer += self._utf8.decode(data)
+        return True
+
+    def _consume(self, end: int):
+        """Drop buffer[:end], advancing the byte offset past it"""
+        self._offset += len(self._buffer[:end].encode('utf-8'))
+        self._buffer = self._buffer[end:]
+
+    def _next_token(self) -> Optional[str]:
+        """Skip whitespace and return the next character without consuming it"""
+        while True:
+            stripped = self._buffer.lstrip()
+            self._consume(len(self._buffer) - len(stripped))
+            if self._buffer:
+                return self._buffer[0]
+            if not self._fill(self._read_size):
+                return None
+
+    def __iter__(self) -> Iterator[Tuple[int, Any]]:
+        after_element = self._resumed
+        if not self._resumed:
+            if self._next_token() != '[':
+                raise ValueError("History file is not a JSON array")
+            self._consume(1)
+
+        while True:
+            token = self._next_token()
+            if token is None:
+                raise ValueError(f"History file ends inside the array (byte {self._offset})")
+            if token == ']':
+                return
+            if token == ',':
+                if not after_element:
+                    raise ValueError(f"Unexpected ',' at byte {self._offset}")
+                self._consume(1)
+                after_element = False
+                continue
+            if after_element:
+                raise ValueError(f"Expected ',' or ']' at byte {self._offset}")
+
+            try:
+                element, end = self._decoder.raw_decode(self._buffer)
+                # A scalar cut off by the buffer end can parse as a shorter one
+                complete = end < len(self._buffer) or self._eof or isinstance(element, (dict, list))
+            except json.JSONDecodeError:
+                complete = False
+            if not complete:
+                # Read as much again as is buffered, so a large entry costs O(size)
+                if not self._fill(max(self._read_size, len(self._buffer))):
+                    raise ValueError(f"Unreadable history entry at byte {self._offset}")
+                continue
+
+            self._consume(end)
+            after_element = True
+            yield self._offset, element
+
+def entry_checksum(entry: Dict[str, Any]) -> int:
+    """Order-independent checksum contribution of one entry (its id excluded)"""
+    data = {key: value for key, value in entry.items() if key != 'id'}
+    digest = hashlib.sha256(json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')).digest()
+    return int.from_bytes(digest, 'big')
+
+def add_range(ranges: List[List[int]], first: int, last: int):
+    """Record migrated ids first..last, merging with the previous range when adjacent"""
+    if ranges and ranges[-1][1] + 1 == first:
+        ranges[-1][1] = last
+    else:
+        ranges.append([first, last])
+
+def in_ranges(ranges: List[List[int]], number: int) -> bool:
+    return any(first <= number <= last for first, last in ranges)
+
+def save_checkpoint(path: str, state: Dict[str, Any]):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def new_checkpoint(source: str) -> Dict[str, Any]:
+    st = os.stat(source)
+    return {
+        'source': os.path.abspath(source), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+        'offset': None, 'entries': 0, 'checksum': '0', 'ids': [], 'pending': None, 'complete': False,
+    }
+
+def migrate(source: str, store, checkpoint_path: str, state: Dict[str, Any], batch_size: int):
+    """Copy source entries into store in batches, checkpointing after each"""
+    checksum = int(state['checksum'], 16)
+    with open(source, 'rb') as f:
+        reader = iter(JsonArrayReader(f, state['offset']))
+        while True:
+            pending = state['pending']
+            count = pending['count'] if pending else batch_size
+            batch = []
+            for end_offset, entry in reader:
+                batch.append((end_offset, entry))
+                if len(batch) == count:
+                    break
+            if not batch:
+                break
+
+            if pending:
+                # Resuming a batch that may have been partly written before the interruption
+                first = pending['first']
+                numbered = [dict(entry, id=first + i) for i, (_, entry) in enumerate(batch)]
+                existing = store.existing_ids(entry['id'] for entry in numbered)
+            else:
+                first = store.reserve_ids(len(batch))
+                numbered = [dict(entry, id=first + i) for i, (_, entry) in enumerate(batch)]
+                existing = set()
+                # Write-ahead: record the numbers before any entry lands in the store
+                state['pending'] = {'first': first, 'count': len(batch)}
+                save_checkpoint(checkpoint_path, state)
+
+            store.append_many([entry for entry in numbered if entry['id'] not in existing])
+            store.sync()
+
+            for _, entry in batch:
+                checksum = (checksum + entry_checksum(entry)) % CHECKSUM_MODULUS
+            add_range(state['ids'], first, first + len(batch) - 1)
+            state.update(offset=batch[-1][0], entries=state['entries'] + len(batch),
+                         checksum=format(checksum, 'x'), pending=None)
+            save_checkpoint(checkpoint_path, state)
+            print(f"Migrated {state['entries']} entries (through byte {state['offset']})")
+
+    state['complete'] = True
+    save_checkpoint(checkpoint_path, state)
+
+def verify(source: str, store, state: Dict[str, Any]) -> bool:
+    """Compare counts and checksums of the source file and the migrated entries"""
+    source_count, source_checksum, source_emissions = 0, 0, 0.0
+    with open(source, 'rb') as f:
+        for _, entry in JsonArrayReader(f):
+            source_count += 1
+            source_checksum = (source_checksum + entry_checksum(entry)) % CHECKSUM_MODULUS
+            source_emissions += (entry.get('results') or {}).get('total_emissions') or 0
+
+    store_count, store_checksum, store_emissions = 0, 0, 0.0
+    for entry in store.iter_entries():
+        if in_ranges(state['ids'], entry.get('id', 0)):
+            store_count += 1
+            store_checksum = (store_checksum + entry_checksum(entry)) % CHECKSUM_MODULUS
+            store_emissions += (entry.get('results') or {}).get('total_emissions') or 0
+
+    ok = source_count == store_count and source_checksum == store_checksum
+    ranges = ', '.join(f"{first}-{last}" for first, last in state['ids']) or 'none'
+    print("Verification report")
+    print(f"  source:   {source_count} entries, checksum {source_checksum:064x}, total_emissions {source_emissions:.4f}")
+    print(f"  migrated: {store_count} entries, checksum {store_checksum:064x}, total_emissions {store_emissions:.4f}")
+    print(f"  ids:      {ranges}")
+    print(f"  result:   {'OK' if ok else 'MISMATCH'}")
+    return ok
+
+def migrated_ids(state: Dict[str, Any]) -> Iterator[int]:
+    for first, last in state['ids']:
+        yield from range(first, last + 1)
+
+def main():
+    # HISTORY_BACKEND (the --backend default) usually lives in .env
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Migrate the legacy JSON history array into the history store")
+    parser.add_argument('--source', default=DEFAULT_SOURCE, help="legacy calculations_history.json")
+    parser.add_argument('--backend', default=os.getenv('HISTORY_BACKEND', 'jsonl'), choices=('jsonl', 'sqlite'))
+    parser.add_argument('--data-dir', default=DATA_DIR, help="directory of the target history store")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--restart', action='store_true',
+                        help="ignore an existing checkpoint and migrate again (refused while the store holds its entries)")
+    parser.add_argument('--verify-only', action='store_true', help="only print the verification report")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.source):
+        print(f"No legacy history at {args.source}")
+        return 1
+
+    store = open_history_store(args.backend, args.data_dir)
+    checkpoint_path = os.path.join(args.data_dir, CHECKPOINT_FILE)
+    state = None
+    if os.path.exists(checkpoint_path) and args.restart and not args.verify_only:
+        with open(checkpoint_path, 'r') as f:
+            previous = json.load(f)
+        # Migrating again would store every entry a second time under new numbers
+        present = store.existing_ids(migrated_ids(previous))
+        if present:
+            print(f"The store still holds {len(present)} entries of the previous migration; "
+                  f"migrate into an empty --data-dir instead of using --restart")
+            return 1
+    if os.path.exists(checkpoint_path) and not args.restart:
+        with open(checkpoint_path, 'r') as f:
+            state = json.load(f)
+        st = os.stat(args.source)
+        if state['source'] != os.path.abspath(args.source) or (state['size'], state['mtime_ns']) != (st.st_size, st.st_mtime_ns):
+            print(f"{checkpoint_path} belongs to a different or modified source file; rerun with --restart")
+            return 1
+        if not state['complete'] and not args.verify_only:
+            print(f"Resuming after {state['entries']} entries")
+    elif args.verify_only:
+        print(f"No migration checkpoint in {args.data_dir}")
+        return 1
+    else:
+        state = new_checkpoint(args.source)
+
+    if not state['complete'] and not args.verify_only:
+        migrate(args.source, store, checkpoint_path, state, args.batch_size)
+
+    return 0 if verify(args.source, store, state) else 2
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""
+Per-request timing breakdown and on-demand profiling.
+
+server_timing_header() groups the stage times metrics.py summed for a request
+into the stages of the Server-Timing response header:
+
+    gmail    Gmail list/get calls
+    parse    receipt parsing and conversion to calculator input
+    maps     Google Maps calls (geocode, Places, Distance Matrix) and rate-limit waits
+    calc     calculate_emissions, which includes maps
+    persist  history save
+    total    the whole request
+
+RequestProfiler runs a request under cProfile when it is called with
+?profile=1 and an X-Profile-Token header matching PROFILE_TOKEN (profiling is
+off while PROFILE_TOKEN is unset). The raw stats (.prof, for pstats/snakeviz)
+and a text report of the top PROFILE_TOP_N functions by cumulative time are
+stored in data/profiles/.
+"""
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+import threading
+from datetime import datetime
+from typing import Dict, Optional
+
+logger = logging.getLogger('carbon_emissions')
+
+PROFILE_TOP_N = 30
+
+SERVER_TIMING_STAGES = {
+    'gmail': ('gmail_list', 'gmail_get'),
+    'parse': ('receipt_parse',),
+    'maps': ('geocode', 'places_search', 'distance_matrix', 'google_throttle'),
+    'calc': ('calculation',),
+    'persist': ('history_save',),
+}
+
+def server_timing_header(timings: Dict[str, float], total: float) -> str:
+    """Server-Timing value for a request's per-stage seconds (stages not reached are left out)"""
+    parts = []
+    for name, stages in SERVER_TIMING_STAGES.items():
+        if any(stage in timings for stage in stages):
+            seconds = sum(timings.get(stage, 0.0) for stage in stages)
+            parts.append(f"{name};dur={seconds * 1000:.1f}")
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ', '.join(parts)
+
+class RequestProfiler:
+    """Profile single requests on demand and store their hottest functions"""
+
+    def __init__(self, token: Optional[str], output_dir: str, top_n: int = PROFILE_TOP_N):
+        self.token = token
+        self.output_dir = output_dir
+        self.top_n = top_n
+        # Only one profiler can be active per process
+        self._busy = threading.Lock()
+
+    def authorized(self, provided: Optional[str]) -> bool:
+        return bool(self.token) and provided is not None and hmac.compare_digest(provided, self.token)
+
+    def start(self) -> Optional[cProfile.Profile]:
+        """Start profiling the current request; None if another request is being profiled"""
+        if not self._busy.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiling tool is already active in this process
+            self._busy.release()
+            return None
+        return profile
+
+    def finish(self, profile: cProfile.Profile, label: str) -> str:
+        """Stop profiling and store the stats; returns the profile's name"""
+        try:
+            profile.disable()
+        finally:
+            self._busy.release()
+
+        name = f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{label}"
+        os.makedirs(self.output_dir, exist_ok=True)
+        profile.dump_stats(os.path.join(self.output_dir, f"{name}.prof"))
+
+        report = io.StringIO()
+        pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(self.top_n)
+        with open(os.path.join(self.output_dir, f"{name}.txt"), 'w') as f:
+            f.write(report.getvalue())
+        logger.info(f"Stored request profile {name} in {self.output_dir}")
+        return name
@@ -1,18 +1,33 @@
 import os.path
 import base64
 import json
+import logging
 import re
 import quopri
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+from calculator import parse_receipt_date
+from lookup_cache import normalize_key
+from metrics import google_call, observe_stage
+
+logger = logging.getLogger('carbon_emissions')
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
-import re
+
+# Airport codes recognised in flight confirmation emails
+# (build_airport_table.py precomputes distances between all of them)
+VALID_AIRPORTS = {
+    'ATL', 'LAX', 'ORD', 'DFW', 'DEN', 'JFK', 'SFO', 'SEA', 'LAS', 'MCO',
+    'MIA', 'PHX', 'EWR', 'IAH', 'BOS', 'MSP', 'DTW', 'PHL', 'LGA', 'CLT',
+    'BWI', 'SLC', 'SAN', 'IAD', 'DCA', 'MDW', 'TPA', 'PDX', 'HOU', 'BNA',
+    'AUS', 'STL', 'OAK', 'MCI', 'RDU', 'SJC', 'SMF', 'IND', 'CLE', 'PIT',
+    'SAT', 'CVG', 'CMH', 'SNA', 'MKE', 'BDL', 'JAX', 'RSW', 'BUF', 'PVD',
+    'OMA', 'CHS', 'MSY', 'TUL', 'ABQ', 'ALB', 'ROC', 'DAL', 'SDF', 'SYR',
+    'GRR', 'BHM', 'PBI', 'ORF', 'BOI', 'OKC', 'RIC', 'LIT', 'ONT', 'MHT',
+    'PSP', 'FLL', 'DAY', 'GSO', 'FAT', 'ELP', 'TUS', 'ICT', 'BUR', 'ISP',
+    'LBB', 'COS', 'GEG', 'MSN', 'HSV', 'CID', 'CAE', 'PNS', 'DSM', 'SAV',
+    'SBA', 'TYS', 'PWM', 'ECP', 'MYR', 'BZN', 'EUG', 'LGB', 'XNA', 'BTR',
+}
 
 def extract_uber_eats_info(email_text):
     """Extract restaurant name and delivery address from Uber Eats receipts"""
@@ -106,19 +121,6 @@ def extract_lyft_ride_info(email_text):
 
 def extract_flight_info(email_text):
     """Extract flight information from airline confirmation emails"""
-    VALID_AIRPORTS = {
-        'ATL', 'LAX', 'ORD', 'DFW', 'DEN', 'JFK', 'SFO', 'SEA', 'LAS', 'MCO',
-        'MIA', 'PHX', 'EWR', 'IAH', 'BOS', 'MSP', 'DTW', 'PHL', 'LGA', 'CLT',
-        'BWI', 'SLC', 'SAN', 'IAD', 'DCA', 'MDW', 'TPA', 'PDX', 'HOU', 'BNA',
-        'AUS', 'STL', 'OAK', 'MCI', 'RDU', 'SJC', 'SMF', 'IND', 'CLE', 'PIT',
-        'SAT', 'CVG', 'CMH', 'SNA', 'MKE', 'BDL', 'JAX', 'RSW', 'BUF', 'PVD',
-        'OMA', 'CHS', 'MSY', 'TUL', 'ABQ', 'ALB', 'ROC', 'DAL', 'SDF', 'SYR',
-        'GRR', 'BHM', 'PBI', 'ORF', 'BOI', 'OKC', 'RIC', 'LIT', 'ONT', 'MHT',
-        'PSP', 'FLL', 'DAY', 'GSO', 'FAT', 'ELP', 'TUS', 'ICT', 'BUR', 'ISP',
-        'LBB', 'COS', 'GEG', 'MSN', 'HSV', 'CID', 'CAE', 'PNS', 'DSM', 'SAV',
-        'SBA', 'TYS', 'PWM', 'ECP', 'MYR', 'BZN', 'EUG', 'LGB', 'XNA', 'BTR',
-    }
-    
     valid_codes = []
     for code in re.findall(r'\b([A-Z]{3})\b', email_text):
         if code in VALID_AIRPORTS:
@@ -153,6 +155,68 @@ def extract_receipt_info(email_text):
     else:
         return {"error": "Unknown receipt type"}
 
+def receipt_fingerprint(receipt):
+    """Identify the trip or order a receipt belongs to: (type, normalized place or route, date)"""
+    receipt_type = receipt.get('type', '').lower()
+    
+    if receipt_type in ('uber eats', 'door dash order'):
+        subject = (normalize_key(receipt.get('restaurant')), normalize_key(receipt.get('delivery_address')))
+    elif receipt_type == 'flight':
+        subject = tuple(
+            (normalize_key(segment.get('origin')), normalize_key(segment.get('destination')))
+            for segment in receipt.get('segments', [])
+        )
+    elif receipt_type == 'lyft ride':
+        subject = (normalize_key(receipt.get('pickup_location')), normalize_key(receipt.get('dropoff_location')),
+                   str(receipt.get('time', '')))
+    elif receipt.get('pickup_location') or receipt.get('dropoff_location'):
+        subject = (normalize_key(receipt.get('pickup_location')), normalize_key(receipt.get('dropoff_location')),
+                   str(receipt.get('distance', '')), str(receipt.get('time', '')))
+    elif receipt.get('thread_id'):
+        # Uber receipts carry no route: two same-day rides of equal distance and
+        # time (e.g. a round trip) only match within one email thread
+        subject = (str(receipt.get('distance', '')), str(receipt.get('time', '')), receipt['thread_id'])
+    else:
+        return None
+    
+    receipt_date = receipt.get('date')
+    parsed_date = parse_receipt_date(receipt_date) if isinstance(receipt_date, str) else None
+    if parsed_date:
+        when = parsed_date.isoformat()
+    elif receipt.get('thread_id'):
+        # Without a date, only receipts from the same thread can be the same order
+        when = f"thread:{receipt['thread_id']}"
+    else:
+        return None
+    
+    return (receipt_type, subject, when)
+
+def deduplicate_receipts(receipts, group_by_thread=False):
+    """Collapse confirmation/update/receipt emails that describe the same trip or order
+    
+    Receipts are matched by receipt_fingerprint, keeping the first one seen. With
+    group_by_thread, receipts of the same type in one Gmail thread are also collapsed.
+    Undated receipts outside any thread are never merged.
+    """
+    seen = set()
+    unique = []
+    for receipt in receipts:
+        keys = []
+        fingerprint = receipt_fingerprint(receipt)
+        if fingerprint:
+            keys.append(fingerprint)
+        if group_by_thread and receipt.get('thread_id'):
+            keys.append(('thread', receipt.get('type', '').lower(), receipt['thread_id']))
+        
+        if any(key in seen for key in keys):
+            continue
+        seen.update(keys)
+        unique.append(receipt)
+    
+    if len(unique) < len(receipts):
+        logger.info("Collapsed %d duplicate receipts", len(receipts) - len(unique))
+    return unique
+
 def simple_get_body(msg):
     """A simpler approach to get the email body, might not work for all emails"""
     payload = msg.get('payload', {})
@@ -199,6 +263,12 @@ def process_email_info(auth_token):
     """Shows basic usage of the Gmail API.
     Lists the user's Gmail labels.
     """
+    # The Google client libraries take a few hundred ms to import; only the
+    # Gmail endpoint needs them, so they stay off the app's startup path
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.discovery import build
+    from googleapiclient.errors import HttpError
+
     try:
         creds = Credentials(
             token=auth_token.get('access_token'),
@@ -210,7 +280,7 @@ def process_email_info(auth_token):
 
         # Call the Gmail API
         service = build("gmail", "v1", credentials=creds)
-        results = service.users().messages().list(userId="me").execute()
+        results = google_call('gmail_list', service.users().messages().list(userId="me").execute)
         messages = results.get("messages", [])
 
         if not messages:
@@ -220,14 +290,15 @@ def process_email_info(auth_token):
         receipt_data = []
         for message in messages:
             # see https://developers.google.com/workspace/gmail/api/reference/rest/v1/users.messages#Message
-            result = service.users().messages().get(userId="me",id=message['id']).execute()
+            result = google_call('gmail_get', service.users().messages().get(userId="me",id=message['id']).execute)
             # stuff is already in json but this should make more sense
             snippet = result['snippet'].lower() 
             
             #poggers regex
             if re.search(r'doordash|uber receipt|lyft|confirmation|booking',snippet):
-                body_text = simple_get_body(result)
-                info = extract_receipt_info(body_text)
+                with observe_stage('receipt_parse'):
+                    body_text = simple_get_body(result)
+                    info = extract_receipt_info(body_text)
                 
                 if info == {} or "error" in info:
                     continue
@@ -236,6 +307,10 @@ def process_email_info(auth_token):
                 if date_match:
                     info['date'] = date_match.group(1).strip()
                 
+                # Keep the thread so duplicate receipts for one order/trip can be collapsed
+                if message.get('threadId'):
+                    info['thread_id'] = message['threadId']
+                
                 receipt_data.append(info)
         
         return receipt_data
@@ -0,0 +1,73 @@
+"""
+Sampled, deferred logging for the per-candidate and per-segment paths of a calculation.
+
+Inside a log_scope() (one calculate_emissions call) detail() messages are only
+formatted and written for a sampled share of calculations (LOG_SAMPLE_RATE,
+all of them when the root logger is at DEBUG) and only if INFO is enabled.
+Arguments are passed logging-style, so unsampled messages are never formatted.
+
+Hot paths count what they did with count() and add_time(); when the outermost
+scope exits, one summary record carries those counters, e.g.
+
+    Calculation summary: candidates=42 candidates_skipped=30 restaurant_searches=3 ... elapsed_ms=812.4
+
+The counters are also attached to the record as extra={'summary': {...}} for
+structured log handlers.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict
+
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.01))
+
+_local = threading.local()
+
+class _Summary:
+    """Summary counters rendered as key=value pairs only when a record is formatted"""
+    __slots__ = ('counters',)
+
+    def __init__(self, counters: Dict[str, Any]):
+        self.counters = counters
+
+    def __str__(self):
+        return ' '.join(f"{key}={value:.1f}" if isinstance(value, float) else f"{key}={value}"
+                        for key, value in sorted(self.counters.items()))
+
+@contextmanager
+def log_scope(name: str = 'Calculation'):
+    """Sample detail logging and collect counters for the block (re-entrant)"""
+    if getattr(_local, 'counters', None) is not None:
+        yield
+        return
+
+    root = logging.getLogger()
+    _local.counters = {}
+    _local.sampled = root.isEnabledFor(logging.DEBUG) or random.random() < LOG_SAMPLE_RATE
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        counters = _local.counters
+        _local.counters = None
+        _local.sampled = False
+        if counters and root.isEnabledFor(logging.INFO):
+            counters['elapsed_ms'] = (time.perf_counter() - start) * 1000
+            logging.info("%s summary: %s", name, _Summary(counters), extra={'summary': counters})
+
+def detail(msg: str, *args):
+    """Log a candidate/segment/delivery-level INFO message if the current scope is sampled"""
+    if getattr(_local, 'sampled', False):
+        logging.info(msg, *args)
+
+def count(name: str, amount: float = 1):
+    counters = getattr(_local, 'counters', None)
+    if counters is not None:
+        counters[name] = counters.get(name, 0) + amount
+
+def add_time(name: str, seconds: float):
+    """Add seconds to the scope's '<name>_ms' counter"""
+    count(f"{name}_ms", seconds * 1000.0)
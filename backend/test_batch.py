@@ -0,0 +1,62 @@
+"""Tests for the columnar batch emissions engine"""
+import random
+
+import numpy as np
+import pytest
+
+import calculator
+from batch import CATEGORIES, calculate_emissions_batch, calculate_emissions_columns
+
+AIRPORTS = ['SFO', 'JFK', 'LAX', 'ORD', 'SEA', 'PDX']
+
+def _payload(rng):
+    """A standard or quickstart-format payload whose entries need no Google lookups"""
+    if rng.random() < 0.2:
+        return [{'type': 'uber_ride', 'distance': round(rng.uniform(0.5, 30), 2), 'time': f"{rng.randint(3, 60)} min"}
+                for _ in range(rng.randint(1, 4))]
+    payload = {}
+    if rng.random() < 0.8:
+        payload['uber_rides'] = [{'distance': rng.choice([round(rng.uniform(0.5, 30), 2), '7.25', 'n/a']),
+                                  'time': f"{rng.randint(3, 60)} minutes"}
+                                 for _ in range(rng.randint(1, 6))]
+    if rng.random() < 0.5:
+        payload['lyft'] = [{'distance': round(rng.uniform(0.5, 20), 1)} if rng.random() < 0.7
+                           else {'time': f"{rng.randint(5, 45)} minutes"}
+                           for _ in range(rng.randint(1, 3))]
+    for category in ('uber_eats', 'doordash'):
+        if rng.random() < 0.4:
+            payload[category] = [{'distance': round(rng.uniform(0.3, 8), 2)} for _ in range(rng.randint(1, 3))]
+    if rng.random() < 0.4:
+        origin, destination, stop = rng.sample(AIRPORTS, 3)
+        payload['flights'] = [rng.choice([
+            {'airport_a': origin, 'airport_b': destination},
+            {'segments': [{'origin': origin, 'destination': stop}, {'origin': stop, 'destination': destination}]},
+        ])]
+    return payload or {'uber_rides': [{'distance': 1}]}
+
+def test_batch_results_equal_calculate_emissions():
+    rng = random.Random(29)
+    payloads = {f"user{n}": _payload(rng) for n in range(200)}
+    results, entries = calculate_emissions_batch(payloads)
+
+    assert list(results) == list(payloads)
+    for user, payload in payloads.items():
+        assert results[user] == calculator.calculate_emissions(payload, calculator.DETAIL_SUMMARY), user
+    assert len(entries) == entries.groupby('user_id', observed=True).size().sum()
+    assert set(entries['category'].unique()) <= set(CATEGORIES)
+
+def test_columns_match_payload_totals():
+    users = ['a', 'b', 'a', 'c', 'b']
+    categories = ['uber_rides', 'lyft', 'flights', 'doordash', 'lyft']
+    distances = [4.2, np.nan, 2586.0, 3.1, 2.0]
+    results, entries = calculate_emissions_columns(users, categories, distances, minutes=[14, 20, 0, 0, 5])
+
+    assert results['a'] == calculator.calculate_emissions({
+        'uber_rides': [{'distance': 4.2}], 'flights': [{'distance': 2586.0}]}, calculator.DETAIL_SUMMARY)
+    assert results['b'] == calculator.calculate_emissions({
+        'lyft': [{'time': '20 minutes'}, {'distance': 2.0}]}, calculator.DETAIL_SUMMARY)
+    assert list(entries['distance']) == [4.2, 10.0, 2586.0, 3.1, 2.0]
+
+def test_unknown_category_is_rejected():
+    with pytest.raises(ValueError):
+        calculate_emissions_columns(['a'], ['bicycle'], [1.0])
@@ -0,0 +1,96 @@
+"""Tests for the per-entry result cache and lookup outcomes in calculator.py"""
+import pytest
+
+import calculator
+from admission import RateLimited, google_bucket
+from lookup_cache import OUTCOME_PERMANENT, OUTCOME_TRANSIENT
+
+def _fake_flight_distance(failing):
+    calls = []
+
+    def calculate_flight_distance(origin, destination):
+        calls.append((origin, destination))
+        if (origin, destination) in failing:
+            return {'status': 'ERROR', 'error': 'Geocoding timed out'}
+        return {'status': 'OK', 'distance_miles': 100.0,
+                'origin_info': {'code': origin}, 'destination_info': {'code': destination}}
+    return calculate_flight_distance, calls
+
+def test_flight_with_failed_segment_is_not_cached(monkeypatch):
+    fake, calls = _fake_flight_distance({('ZZB', 'ZZC')})
+    monkeypatch.setattr(calculator, 'calculate_flight_distance', fake)
+    calculator._entry_results.clear()
+    data = {'flights': [{'segments': [{'origin': 'ZZA', 'destination': 'ZZB'},
+                                      {'origin': 'ZZB', 'destination': 'ZZC'}]}]}
+
+    stats = {}
+    results = calculator.calculate_emissions(data, stats=stats)
+    assert stats == {'unresolved': 1}
+    assert results['flight_distance'] == 100.0
+    assert len(calculator._entry_results) == 0
+
+    # The failed leg is retried on the next calculation rather than served from cache
+    calculator.calculate_emissions(data, stats=stats)
+    assert stats == {'unresolved': 1}
+    assert len(calls) == 4
+
+def test_resolved_flight_is_cached(monkeypatch):
+    fake, calls = _fake_flight_distance(set())
+    monkeypatch.setattr(calculator, 'calculate_flight_distance', fake)
+    calculator._entry_results.clear()
+    data = {'flights': [{'segments': [{'origin': 'ZZA', 'destination': 'ZZB'},
+                                      {'origin': 'ZZB', 'destination': 'ZZC'}]}]}
+
+    stats = {}
+    calculator.calculate_emissions(data, stats=stats)
+    calculator.calculate_emissions(data, stats=stats)
+    assert stats == {'unresolved': 0}
+    assert len(calls) == 2
+
+class _PlacesClient:
+    """Maps client whose Places searches raise error, or find nothing when error is None"""
+
+    def __init__(self, error=None):
+        self.error = error
+
+    def geocode(self, address):
+        return [{'geometry': {'location': {'lat': 45.5, 'lng': -122.6}}}]
+
+    def _search(self, **kwargs):
+        if self.error is not None:
+            raise self.error
+        return {'results': []}
+
+    places_nearby = places = _search
+
+@pytest.fixture
+def no_rate_limit(monkeypatch):
+    monkeypatch.setattr(google_bucket, 'rate', 0)
+
+@pytest.mark.parametrize('error, status', [
+    (TimeoutError("Places timed out"), 'ERROR'),
+    (RateLimited("Google API rate limit"), 'RATE_LIMITED'),
+])
+def test_failed_places_search_is_transient(error, status, no_rate_limit):
+    calculator._lookup_results.clear()
+    result = calculator.find_nearest_restaurant_location('Zz Burgers', '1 Main St, Portland', _PlacesClient(error))
+    assert result['status'] == status
+    assert calculator._lookup_outcome(result) == OUTCOME_TRANSIENT
+
+def test_places_search_without_results_is_not_found(no_rate_limit):
+    calculator._lookup_results.clear()
+    result = calculator.find_nearest_restaurant_location('Zz Burgers', '1 Main St, Portland', _PlacesClient())
+    assert result['status'] == 'NOT_FOUND'
+    assert calculator._lookup_outcome(result) == OUTCOME_PERMANENT
+
+@pytest.mark.parametrize('detail_level', [calculator.DETAIL_SUMMARY, calculator.DETAIL_ENTRY])
+def test_trimmed_full_results_match_the_detail_level(detail_level):
+    data = {
+        'uber_rides': [{'distance': 4.2, 'time': '14', 'date': 'Mar 3, 2026'}, {'distance': 11}],
+        'lyft': [{'distance': 3.5}],
+        'uber_eats': [{'distance': 2.1, 'restaurant': 'Zz Burgers'}],
+        'flights': [{'airport_a': 'SFO', 'airport_b': 'JFK'}],
+    }
+    full = calculator.calculate_emissions(data, calculator.DETAIL_FULL)
+    assert calculator.trim_results(full, detail_level) == calculator.calculate_emissions(data, detail_level)
+    assert 'entry_details' in full
@@ -0,0 +1,64 @@
+"""Tests for calculation numbering in the JSONL history store and the SQLite schema"""
+import json
+import multiprocessing
+import os
+
+import pytest
+
+from history import EMISSION_COLUMNS, JsonlHistoryStore, SqliteHistoryStore
+
+def _entry(n):
+    return {'timestamp': f"2026-04-01T12:00:{n % 60:02d}", 'inputs': {}, 'results': {'total_emissions': n}}
+
+def _append_from_process(path, count, batch):
+    store = JsonlHistoryStore(path, segment_codec='gzip')
+    for start in range(0, count, batch):
+        store.append_many([_entry(n) for n in range(start, min(start + batch, count))])
+
+@pytest.fixture
+def store(tmp_path):
+    return JsonlHistoryStore(str(tmp_path / 'calculations_history.jsonl'), segment_codec='gzip')
+
+def test_reserve_ids_is_consecutive(store):
+    assert store.reserve_ids() == 1
+    assert store.reserve_ids(5) == 2
+    assert store.reserve_ids() == 7
+
+def test_append_many_numbers_entries_without_ids(store):
+    assert store.append_many([_entry(1), dict(_entry(2), id=40), _entry(3)]) == [1, 40, 2]
+    assert [entry['id'] for entry in store.iter_entries()] == [1, 40, 2]
+    assert store.append(_entry(4)) == 3
+
+def test_sequence_recovers_from_existing_log(store):
+    store.append_many([_entry(n) for n in range(3)])
+    store.append(dict(_entry(3), id=10))
+    os.remove(store.sequence_path)
+    fresh = JsonlHistoryStore(store.path, segment_codec='gzip')
+    assert fresh.reserve_ids() == 11
+
+@pytest.mark.parametrize('batch', [1, 7])
+def test_concurrent_processes_get_unique_ids(store, batch):
+    processes, per_process = 4, 500
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=_append_from_process, args=(store.path, per_process, batch))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    with open(store.path, 'rb') as f:
+        ids = [json.loads(line)['id'] for line in f]
+    total = processes * per_process
+    assert len(ids) == total
+    assert sorted(ids) == list(range(1, total + 1))
+    assert store.reserve_ids() == total + 1
+
+@pytest.mark.parametrize('column', EMISSION_COLUMNS)
+def test_sqlite_emission_columns_are_indexed(tmp_path, column):
+    store = SqliteHistoryStore(str(tmp_path / 'calculations_history.db'))
+    plan = store._connection().execute(
+        f"EXPLAIN QUERY PLAN SELECT id FROM calculations WHERE {column} > ? ORDER BY {column}", (1.0,)
+    ).fetchall()
+    assert any(f"idx_calculations_{column}" in row[-1] for row in plan), plan
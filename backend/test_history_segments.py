@@ -0,0 +1,114 @@
+"""Tests for compacting the JSONL history into sealed segments"""
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+import history_segments
+from history import JsonlHistoryStore
+from history_segments import compact_log, needs_compaction, read_index, segments_dir
+
+NOW = datetime(2026, 4, 15)
+
+def _entry(timestamp, total, user='u1'):
+    return {'timestamp': timestamp, 'user': user, 'inputs': {'uber_rides': [{'distance': total}]},
+            'results': {'total_emissions': total, 'uber_emissions': total, 'entry_details': {'uber_rides': []}}}
+
+@pytest.fixture
+def store(tmp_path):
+    store = JsonlHistoryStore(str(tmp_path / 'calculations_history.jsonl'), segment_codec='gzip')
+    # Two entries in each of January, February and March; April is the current period
+    for month in (1, 2, 3, 4):
+        for day in (10, 20):
+            store.append(_entry(f"2026-{month:02d}-{day}T12:00:00", month * 100 + day))
+    return store
+
+def _compact(store):
+    return compact_log(store.path, 'month', 'gzip', now=NOW)
+
+def _ids(store):
+    return [entry['id'] for entry in store.iter_entries()]
+
+def test_compaction_rolls_finished_periods(store):
+    assert needs_compaction(store.path, 'month', NOW)
+    written = _compact(store)
+
+    assert [segment['period'] for segment in written] == ['2026-01', '2026-02', '2026-03']
+    assert [(segment['first_id'], segment['last_id']) for segment in written] == [(1, 2), (3, 4), (5, 6)]
+    assert read_index(store.path)['segments'] == written
+    with open(store.path, 'rb') as f:
+        lines = f.read().splitlines()
+    assert lines[0] == b'{"history_base":6}'
+    assert [json.loads(line)['id'] for line in lines[1:]] == [7, 8]
+
+    assert not needs_compaction(store.path, 'month', NOW)
+    assert _compact(store) == []
+
+def test_reads_span_segments_and_active_log(store):
+    before = list(store.iter_entries())
+    _compact(store)
+    assert list(store.iter_entries()) == before
+
+    reader = JsonlHistoryStore(store.path, segment_codec='gzip')
+    page, cursor = reader.query(limit=3, include_results=True)
+    assert [item['id'] for item in page] == [8, 7, 6]
+    assert [item['results']['total_emissions'] for item in page] == [420, 410, 320]
+    page, cursor = reader.query(limit=3, cursor=cursor, include_results=True)
+    assert [item['id'] for item in page] == [5, 4, 3]
+    assert page[0]['results']['entry_details'] == {'uber_rides': []}
+    page, cursor = reader.query(limit=3, cursor=cursor)
+    assert [item['id'] for item in page] == [2, 1]
+    assert cursor is None
+
+    summary = reader.aggregate()
+    assert summary['count'] == 8
+    assert summary['categories']['total']['sum'] == sum(month * 200 + 30 for month in (1, 2, 3, 4))
+
+def test_ids_continue_after_compaction(store):
+    _compact(store)
+    assert store.append(_entry('2026-04-25T12:00:00', 1)) == 9
+
+    # Without the sequence file the next id is recovered from the segments and the log
+    os.remove(store.sequence_path)
+    assert JsonlHistoryStore(store.path, segment_codec='gzip').append(_entry('2026-04-26T12:00:00', 1)) == 10
+    assert _ids(store) == list(range(1, 11))
+
+def test_entries_without_ids_keep_their_position(tmp_path):
+    path = str(tmp_path / 'calculations_history.jsonl')
+    with open(path, 'w') as f:
+        for month in (1, 2, 4):
+            f.write(json.dumps({'timestamp': f"2026-{month:02d}-01T00:00:00", 'results': {}}) + '\n')
+    compact_log(path, 'month', 'gzip', now=NOW)
+
+    store = JsonlHistoryStore(path, segment_codec='gzip')
+    assert _ids(store) == [1, 2, 3]
+    assert store.append(_entry('2026-04-02T00:00:00', 1)) == 4
+
+def test_interrupted_compaction_is_ignored_and_redone(store, monkeypatch):
+    before = list(store.iter_entries())
+    replace = os.replace
+
+    def crash_before_log_replace(src, dst):
+        if dst == store.path:
+            raise OSError("simulated crash")
+        replace(src, dst)
+
+    monkeypatch.setattr(history_segments.os, 'replace', crash_before_log_replace)
+    with pytest.raises(OSError):
+        _compact(store)
+    monkeypatch.undo()
+
+    # Segments and index were written, but the old log (without a header) still holds every entry
+    assert len(read_index(store.path)['segments']) == 3
+    assert os.listdir(segments_dir(store.path))
+    assert list(store.iter_entries()) == before
+    reader = JsonlHistoryStore(store.path, segment_codec='gzip')
+    assert [item['id'] for item in reader.query(limit=20)[0]] == list(range(8, 0, -1))
+    assert reader.aggregate()['count'] == 8
+
+    # The next run rewrites the stale segments instead of adding duplicates
+    written = _compact(store)
+    assert read_index(store.path)['segments'] == written
+    assert list(store.iter_entries()) == before
+    assert store.append(_entry('2026-04-25T12:00:00', 1)) == 9
@@ -0,0 +1,162 @@
+"""Tests for the write-behind HistoryWriter"""
+import json
+import threading
+
+import pytest
+
+import history_writer
+from history import JsonlHistoryStore
+from history_writer import HistoryWriter, parse_fsync_policy
+
+def _entry(n):
+    return {'timestamp': f"2026-04-01T12:00:{n % 60:02d}", 'inputs': {}, 'results': {'total_emissions': n}}
+
+class _CountingStore(JsonlHistoryStore):
+    """JSONL store that records its writes and syncs, and can be made to fail"""
+
+    def __init__(self, path):
+        super().__init__(path, segment_codec='gzip')
+        self.writes = []
+        self.syncs = 0
+        self.failing = False
+
+    def append_many(self, entries):
+        if self.failing:
+            raise OSError("disk full")
+        self.writes.append(len(entries))
+        return super().append_many(entries)
+
+    def sync(self):
+        self.syncs += 1
+        super().sync()
+
+@pytest.fixture
+def store(tmp_path):
+    return _CountingStore(str(tmp_path / 'calculations_history.jsonl'))
+
+@pytest.fixture
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(history_writer.time, 'sleep', lambda seconds: None)
+
+def _ids(store):
+    return [entry['id'] for entry in store.iter_entries()]
+
+def test_parse_fsync_policy():
+    assert parse_fsync_policy('1') == (1, None)
+    assert parse_fsync_policy('0') == (0, None)
+    assert parse_fsync_policy('250ms') == (0, 0.25)
+    with pytest.raises(ValueError):
+        parse_fsync_policy('-1')
+    with pytest.raises(ValueError):
+        parse_fsync_policy('0ms')
+
+def test_submitted_entries_are_written_in_order(store):
+    writer = HistoryWriter(store)
+    numbers = [writer.submit(_entry(n)) for n in range(50)]
+    numbers += writer.submit_many([_entry(n) for n in range(50, 60)])
+    writer.flush()
+
+    assert numbers == list(range(1, 61))
+    assert _ids(store) == numbers
+    assert sum(store.writes) == 60
+    assert store.syncs >= 1
+    writer.close()
+
+def test_close_writes_queued_entries_and_later_submits_go_direct(store):
+    writer = HistoryWriter(store, fsync_every='0')
+    for n in range(20):
+        writer.submit(_entry(n))
+    writer.close()
+    writer.close()
+    assert _ids(store) == list(range(1, 21))
+
+    assert writer.submit(_entry(20)) == 21
+    assert writer.submit_many([_entry(21), _entry(22)]) == [22, 23]
+    assert _ids(store) == list(range(1, 24))
+
+def test_fsync_every_n_entries(store):
+    writer = HistoryWriter(store, fsync_every='10')
+    syncs = []
+    for start in range(0, 15, 5):
+        writer.submit_many([_entry(n) for n in range(start, start + 5)])
+        writer.flush()
+        syncs.append(store.syncs)
+    assert syncs == [0, 1, 1]
+    writer.close()
+    # The remaining 5 entries are synced on close
+    assert store.syncs == 2
+
+def test_failed_writes_go_to_the_dead_letter_file(store, no_retry_delay, monkeypatch):
+    dropped = []
+    monkeypatch.setattr(history_writer, 'count_history_dropped', dropped.append)
+    writer = HistoryWriter(store)
+
+    store.failing = True
+    numbers = writer.submit_many([_entry(n) for n in range(3)])
+    writer.flush()
+    store.failing = False
+    writer.submit(_entry(3))
+    writer.close()
+
+    assert sum(dropped) == 3
+    assert _ids(store) == [4]
+    with open(writer.dead_letter_path, 'rb') as f:
+        dead = [json.loads(line) for line in f]
+    assert [entry['id'] for entry in dead] == numbers
+    assert dead[0]['results'] == {'total_emissions': 0}
+
+    # Replaying the dead letters restores the entries under their reserved numbers
+    store.append_many(dead)
+    assert sorted(_ids(store)) == [1, 2, 3, 4]
+
+def test_write_succeeding_on_retry_is_not_dropped(store, no_retry_delay, monkeypatch):
+    dropped = []
+    monkeypatch.setattr(history_writer, 'count_history_dropped', dropped.append)
+    failures = iter([True, False])
+    append_many = store.append_many
+
+    def flaky(entries):
+        if next(failures, False):
+            raise OSError("temporarily unavailable")
+        return append_many(entries)
+
+    store.append_many = flaky
+    writer = HistoryWriter(store)
+    writer.submit(_entry(0))
+    writer.close()
+    assert dropped == []
+    assert _ids(store) == [1]
+
+def test_retry_after_partial_write_does_not_duplicate_entries(store, no_retry_delay, monkeypatch):
+    dropped = []
+    monkeypatch.setattr(history_writer, 'count_history_dropped', dropped.append)
+    failures = iter([True])
+    append_many = store.append_many
+
+    def torn(entries):
+        if next(failures, False):
+            # Two entries land, the third is cut off mid-line
+            append_many(entries[:2])
+            with open(store.path, 'ab') as f:
+                f.write(json.dumps(entries[2]).encode()[:10])
+            raise OSError("No space left on device")
+        return append_many(entries)
+
+    store.append_many = torn
+    writer = HistoryWriter(store)
+    writer.submit_many([_entry(n) for n in range(5)])
+    writer.close()
+    assert dropped == []
+    assert _ids(store) == [1, 2, 3, 4, 5]
+
+def test_submits_racing_close_are_not_lost(store):
+    writer = HistoryWriter(store, fsync_every='0')
+    numbers = []
+    threads = [threading.Thread(target=lambda: numbers.extend(writer.submit(_entry(n)) for n in range(50)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    writer.close()
+    for thread in threads:
+        thread.join()
+    assert sorted(_ids(store)) == sorted(numbers) == list(range(1, 201))
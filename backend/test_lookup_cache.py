@@ -0,0 +1,204 @@
+"""Tests for SingleFlight, lookup_scope and LookupCache"""
+import threading
+import time
+
+import pytest
+
+import lookup_cache
+from lookup_cache import (
+    LookupCache, OUTCOME_OK, OUTCOME_PERMANENT, OUTCOME_TRANSIENT, SingleFlight, lookup_scope, note_unresolved
+)
+
+class _CountingEvent(threading.Event):
+    """Event that counts its waiters, so a test knows when followers are parked"""
+
+    def __init__(self):
+        super().__init__()
+        self.waiters = 0
+
+    def wait(self, timeout=None):
+        self.waiters += 1
+        return super().wait(timeout)
+
+class _ObservedCall(lookup_cache._Call):
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__()
+        self.event = _CountingEvent()
+
+@pytest.fixture
+def flight(monkeypatch):
+    monkeypatch.setattr(lookup_cache, '_Call', _ObservedCall)
+    return SingleFlight()
+
+def _coalesced(flight, result=None, error=None, followers=4):
+    """Call flight.do from 1 + followers threads while the leader's call is running"""
+    release, started, calls, outcomes = threading.Event(), threading.Event(), [], []
+
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        if error is not None:
+            raise error
+        return result
+
+    def caller():
+        try:
+            outcomes.append(('ok', flight.do('key', fn)))
+        except Exception as e:
+            outcomes.append(('error', e))
+
+    threads = [threading.Thread(target=caller) for _ in range(followers + 1)]
+    threads[0].start()
+    assert started.wait(5)
+    call = flight._calls['key']
+    for thread in threads[1:]:
+        thread.start()
+    for _ in range(5000):
+        if call.event.waiters == followers:
+            break
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    return calls, outcomes
+
+def test_concurrent_callers_share_one_call(flight):
+    calls, outcomes = _coalesced(flight, result={'status': 'OK'})
+    assert len(calls) == 1
+    assert outcomes == [('ok', {'status': 'OK'})] * 5
+    assert flight._calls == {}
+
+def test_leader_error_reaches_followers(flight):
+    error = TimeoutError("geocode timed out")
+    calls, outcomes = _coalesced(flight, error=error)
+    assert len(calls) == 1
+    assert outcomes == [('error', error)] * 5
+    # The failed call is not remembered: the next caller tries again
+    assert flight.do('key', lambda: 'retried') == 'retried'
+
+def test_different_keys_do_not_coalesce():
+    flight = SingleFlight()
+    assert flight.do('a', lambda: 1) == 1
+    assert flight.do('b', lambda: 2) == 2
+
+def test_scope_memoizes_results():
+    flight = SingleFlight()
+    calls = []
+
+    def fn(value):
+        calls.append(value)
+        return value * 2
+
+    with lookup_scope():
+        assert flight.do('key', fn, 1) == 2
+        assert flight.do('key', fn, 1) == 2
+    assert calls == [1]
+
+    # Outside a scope completed calls are not remembered
+    flight.do('key', fn, 1)
+    flight.do('key', fn, 1)
+    assert calls == [1, 1, 1]
+
+def test_scope_skips_results_the_predicate_rejects():
+    flight = SingleFlight(memoize=lambda result: result['status'] != 'TIMEOUT')
+    statuses = iter(['TIMEOUT', 'OK', 'NOT_FOUND'])
+    calls = []
+
+    def fn(key):
+        calls.append(key)
+        return {'status': next(statuses)}
+
+    with lookup_scope():
+        # The transient failure is retried by the next caller, the success is remembered
+        assert flight.do('a', fn, 'a') == {'status': 'TIMEOUT'}
+        assert flight.do('a', fn, 'a') == {'status': 'OK'}
+        assert flight.do('a', fn, 'a') == {'status': 'OK'}
+        assert flight.do('b', fn, 'b') == {'status': 'NOT_FOUND'}
+        assert flight.do('b', fn, 'b') == {'status': 'NOT_FOUND'}
+    assert calls == ['a', 'a', 'b']
+
+def test_scope_is_reentrant_and_counts_unresolved():
+    flight = SingleFlight()
+    calls = []
+    with lookup_scope() as outer:
+        flight.do('key', calls.append, 1)
+        with lookup_scope() as inner:
+            assert inner is outer
+            flight.do('key', calls.append, 1)
+            note_unresolved()
+        note_unresolved()
+        assert outer == {'unresolved': 2}
+    assert calls == [1]
+    # Outside a scope there is nothing to count
+    note_unresolved()
+
+def test_scope_memo_is_per_thread():
+    flight = SingleFlight()
+    calls = []
+    with lookup_scope():
+        flight.do('key', calls.append, 'main')
+        thread = threading.Thread(target=lambda: flight.do('key', calls.append, 'other'))
+        thread.start()
+        thread.join(5)
+    assert calls == ['main', 'other']
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(lookup_cache.time, 'monotonic', clock)
+    return clock
+
+def test_ttl_expiry(clock):
+    cache = LookupCache(ttl=10)
+    cache.set('key', 'value', OUTCOME_OK)
+    clock.now += 9.9
+    assert cache.get('key') == (True, 'value')
+    clock.now += 0.1
+    assert cache.get('key') == (False, None)
+    assert len(cache) == 0
+
+def test_negative_ttls_by_outcome(clock):
+    cache = LookupCache(ttl=100, negative_ttl=50, transient_ttl=5)
+    cache.set('missing', {'status': 'NOT_FOUND'}, OUTCOME_PERMANENT)
+    cache.set('flaky', {'status': 'TIMEOUT'}, OUTCOME_TRANSIENT)
+
+    clock.now += 5
+    assert cache.get('flaky') == (False, None)
+    assert cache.get('missing') == (True, {'status': 'NOT_FOUND'})
+    clock.now += 45
+    assert cache.get('missing') == (False, None)
+
+def test_success_replaces_failure(clock):
+    cache = LookupCache(ttl=100, transient_ttl=5)
+    cache.set('key', {'status': 'TIMEOUT'}, OUTCOME_TRANSIENT)
+    cache.set('key', {'status': 'OK'}, OUTCOME_OK)
+    clock.now += 50
+    assert cache.get('key') == (True, {'status': 'OK'})
+    assert len(cache) == 1
+
+def test_zero_ttl_disables_caching(clock):
+    cache = LookupCache(ttl=0, negative_ttl=0, transient_ttl=0)
+    cache.set('a', 1, OUTCOME_OK)
+    cache.set('b', 2, OUTCOME_PERMANENT)
+    assert cache.get('a') == (False, None)
+    assert cache.get('b') == (False, None)
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = LookupCache(maxsize=2)
+    cache.set('a', 1, OUTCOME_OK)
+    cache.set('b', 2, OUTCOME_OK)
+    cache.get('a')
+    cache.set('c', 3, OUTCOME_OK)
+    assert cache.get('b') == (False, None)
+    assert cache.get('a') == (True, 1)
+    assert cache.get('c') == (True, 3)
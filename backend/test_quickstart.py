@@ -0,0 +1,25 @@
+"""Tests for collapsing duplicate receipts"""
+from quickstart import deduplicate_receipts
+
+def _uber_ride(thread_id, **extra):
+    return dict({'type': 'Uber Ride', 'distance': '3.1', 'time': '12', 'date': 'apr 3, 2026',
+                 'thread_id': thread_id}, **extra)
+
+def test_receipts_of_one_ride_collapse():
+    receipts = [_uber_ride('t1'), _uber_ride('t1')]
+    assert deduplicate_receipts(receipts) == [receipts[0]]
+
+def test_round_trip_rides_are_kept():
+    # Same day, distance and time, but separate trips (separate threads)
+    receipts = [_uber_ride('t1'), _uber_ride('t2')]
+    assert deduplicate_receipts(receipts) == receipts
+
+def test_rides_with_routes_match_on_route():
+    there = _uber_ride('t1', pickup_location='Home', dropoff_location='Office')
+    back = _uber_ride('t2', pickup_location='Office', dropoff_location='Home')
+    again = _uber_ride('t3', pickup_location='home ', dropoff_location='OFFICE')
+    assert deduplicate_receipts([there, back, again]) == [there, back]
+
+def test_undated_rides_outside_threads_are_never_merged():
+    receipts = [{'type': 'Uber Ride', 'distance': '3.1', 'time': '12'}] * 2
+    assert deduplicate_receipts(receipts) == receipts
@@ -1,6 +1,19 @@
+import { createHmac } from 'node:crypto';
 import { auth } from '@/lib/auth';
 import { NextRequest, NextResponse } from 'next/server';
 
+// The backend only trusts X-User-Id when it is signed with the shared USER_ID_SECRET
+function userHeaders(userId: string | undefined): Record<string, string> {
+    const secret = process.env.USER_ID_SECRET;
+    if (!secret || !userId) {
+        return {};
+    }
+    return {
+        'X-User-Id': userId,
+        'X-User-Signature': createHmac('sha256', secret).update(userId).digest('hex'),
+    };
+}
+
 export async function GET(request: NextRequest) {
     const session = await auth(); // Ensure the user is authenticated
     if (!session) {
@@ -24,6 +37,7 @@ export async function GET(request: NextRequest) {
                 headers: {
                     'Content-Type': 'application/json',
                     'Access-Control-Allow-Origin': '*', // Allow CORS for local testing, remove in production
+                    ...userHeaders(session.user.id), // Per-user admission limits and history in the backend
                 },
                 body: JSON.stringify({
                     access_token: session.accessToken,